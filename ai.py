@@ -0,0 +1,153 @@
+# Copyright (c) 2014 Per Lindstrand
+
+import collections
+import logging
+import time
+
+import numpy as np
+
+LOG = logging.getLogger(__name__)
+
+PENDING = -1
+
+
+class AIConfig(object):
+
+    # seconds of thinking allowed per tick, the rest is deferred
+    TICK_BUDGET = .002
+    # enemies closer than LOD_DISTANCES[i] to a player think every
+    # LOD_PERIODS[i] ticks, the ones further away every LOD_PERIODS[-1]
+    LOD_DISTANCES = (16., 48., 128.)
+    LOD_PERIODS = (1, 4, 16, 64)
+    LOD_REFRESH_TICKS = 8
+    BUDGET_CHECK_INTERVAL = 32
+
+
+class AIScheduler(object):
+
+    def __init__(self, tick_budget=AIConfig.TICK_BUDGET):
+        self.tick_budget = tick_budget
+        self.tick = 0
+        self.enemies = {}
+        self.wheel_size = max(AIConfig.LOD_PERIODS)
+        self.wheel = [[] for i in range(self.wheel_size)]
+        self.pending = collections.deque()
+        # one-shot cap on the decisions of the next tick, set by replays
+        # to reproduce the effect of the time budget deterministically
+        self.decision_limit = None
+        self.lod_queue = collections.deque()
+        # counters
+        self.decisions = 0
+        self.deferred = 0
+        self.total_decisions = 0
+        self.budget_overruns = 0
+
+    def _schedule(self, enemy, due):
+        enemy.ai_due = due
+        self.wheel[due % self.wheel_size].append(enemy)
+
+    def _next_due(self, enemy):
+        # enemies keep a fixed phase within their period so the work of
+        # each LOD ring is spread evenly over its ticks
+        period = enemy.ai_period
+        return self.tick + 1 + (enemy.entity.id - self.tick - 1) % period
+
+    def add_enemy(self, enemy):
+        enemy.ai_period = AIConfig.LOD_PERIODS[-1]
+        self.enemies[enemy.entity.id] = enemy
+        self.lod_queue.append(enemy)
+        self._schedule(enemy, self._next_due(enemy))
+
+    def remove_enemy(self, enemy):
+        if self.enemies.pop(enemy.entity.id, None) is not None:
+            # stale wheel entries are skipped when their bucket comes up
+            enemy.ai_due = None
+
+    def update_lod(self, player_ents, count=None):
+        # refresh the LOD ring of the next count enemies in round-robin
+        # order, all of them by default
+        queue = self.lod_queue
+        if count is None or count > len(queue):
+            count = len(queue)
+        enemies = []
+        for i in range(count):
+            enemy = queue.popleft()
+            if enemy.ai_due is not None:
+                enemies.append(enemy)
+                queue.append(enemy)
+        count = len(enemies)
+        if not count:
+            return
+        xs = np.fromiter((e.entity.x for e in enemies), np.float64, count)
+        ys = np.fromiter((e.entity.y for e in enemies), np.float64, count)
+        if player_ents:
+            best = np.full(count, np.inf)
+            nearest = np.zeros(count, dtype=np.intp)
+            for i, ent in enumerate(player_ents):
+                dist_sq = (xs - ent.x) ** 2 + (ys - ent.y) ** 2
+                closer = dist_sq < best
+                best[closer] = dist_sq[closer]
+                nearest[closer] = i
+            rings = np.searchsorted(
+                np.square(AIConfig.LOD_DISTANCES), best, side='right')
+            targets = [player_ents[i] for i in nearest.tolist()]
+        else:
+            rings = np.full(count, len(AIConfig.LOD_DISTANCES))
+            targets = [None] * count
+        periods = np.take(AIConfig.LOD_PERIODS, rings).tolist()
+        for enemy, period, target in zip(enemies, periods, targets):
+            enemy.target = target
+            if period != enemy.ai_period:
+                enemy.ai_period = period
+                due = self._next_due(enemy)
+                if enemy.ai_due is not None and due < enemy.ai_due:
+                    self._schedule(enemy, due)
+
+    def update(self, player_ents, dt):
+        self.tick += 1
+        refresh_ticks = AIConfig.LOD_REFRESH_TICKS
+        self.update_lod(
+            player_ents,
+            (len(self.lod_queue) + refresh_ticks - 1) // refresh_ticks)
+
+        slot = self.tick % self.wheel_size
+        bucket = self.wheel[slot]
+        self.wheel[slot] = []
+        tick = self.tick
+        pending = self.pending
+        for enemy in bucket:
+            if enemy.ai_due == tick:
+                enemy.ai_due = PENDING
+                pending.append(enemy)
+
+        start = time.perf_counter()
+        decisions = 0
+        check = AIConfig.BUDGET_CHECK_INTERVAL
+        budget = self.tick_budget
+        limit = self.decision_limit
+        self.decision_limit = None
+        while pending and decisions != limit:
+            enemy = pending.popleft()
+            if enemy.ai_due is None:
+                continue
+            enemy.think(dt)
+            self._schedule(enemy, tick + enemy.ai_period)
+            decisions += 1
+            if (budget is not None and decisions % check == 0 and
+                time.perf_counter() - start > budget):
+                break
+        self.decisions = decisions
+        self.deferred = len(pending)
+        self.total_decisions += decisions
+        if pending:
+            self.budget_overruns += 1
+
+    def get_stats(self):
+        return {
+            'tick': self.tick,
+            'enemies': len(self.enemies),
+            'decisions': self.decisions,
+            'deferred': self.deferred,
+            'total_decisions': self.total_decisions,
+            'budget_overruns': self.budget_overruns,
+        }
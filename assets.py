@@ -0,0 +1,273 @@
+# Copyright (c) 2014 Per Lindstrand
+
+import collections
+import concurrent.futures
+import json
+import logging
+import time
+
+import pyglet
+from pyglet.gl import *
+
+import shader
+
+LOG = logging.getLogger(__name__)
+
+
+class AssetConfig(object):
+
+    WORKER_THREADS = 2
+    # seconds per frame spent on gl uploads, at least one upload per frame
+    # happens regardless so loading always makes progress
+    UPLOAD_BUDGET = .004
+    # unreferenced assets are evicted, least recently used first, while the
+    # estimated gpu memory is above this
+    GPU_MEMORY_BUDGET = 256 * 1024 * 1024
+    # for entity models that don't name one
+    DEFAULT_MESH = 'cube.mesh'
+
+
+class AssetState(object):
+
+    LOADING     = 0
+    READY       = 1
+    FAILED      = 2
+
+
+class Asset(object):
+
+    def __init__(self, kind, path):
+        self.kind = kind
+        self.path = path
+        self.state = AssetState.LOADING
+        self.refs = 0
+        # cpu side result of the decode, dropped after the upload
+        self.data = None
+        # the gl side object, None until READY
+        self.resource = None
+        self.gpu_bytes = 0
+        self.load_time = 0.
+
+    def is_ready(self):
+        return self.state == AssetState.READY
+
+
+def read_file(filename):
+    with open(filename, 'r') as file:
+        return file.read()
+
+
+def decode_texture(path):
+    return pyglet.image.load(path)
+
+
+def upload_texture(manager, asset):
+    image = asset.data
+    tex = image.get_texture()
+    glBindTexture(tex.target, tex.id)
+    glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+    glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
+    glBindTexture(tex.target, 0)
+    asset.gpu_bytes = tex.width * tex.height * 4
+    return tex
+
+
+def delete_texture(tex):
+    glDeleteTextures(1, byref(GLuint(tex.id)))
+
+
+def decode_shader(path):
+    vert_fname, frag_fname = path
+    return read_file(vert_fname), read_file(frag_fname)
+
+
+def upload_shader(manager, asset):
+    vert_source, frag_source = asset.data
+    return shader.Shader(
+        vertex_shader_source=vert_source,
+        fragment_shader_source=frag_source)
+
+
+def delete_shader(program):
+    glDeleteProgram(program.handle)
+
+
+def decode_models(path):
+    return json.loads(read_file(path))
+
+
+def upload_models(manager, asset):
+    # the models hold references to their textures and meshes until evicted
+    models = asset.data
+    for model in models.values():
+        model['texture'] = manager.acquire_texture(model['texture'])
+        model['mesh'] = manager.acquire_mesh(
+            model.get('mesh', AssetConfig.DEFAULT_MESH))
+    return models
+
+
+def delete_models(models):
+    pass
+
+
+def release_models(manager, models):
+    for model in models.values():
+        manager.release(model['texture'])
+        manager.release(model['mesh'])
+
+
+LOADERS = {
+    # kind: (decode on a worker, upload on the main thread, delete)
+    'texture': (decode_texture, upload_texture, delete_texture),
+    'shader': (decode_shader, upload_shader, delete_shader),
+    'models': (decode_models, upload_models, delete_models),
+}
+
+
+class AssetManager(object):
+
+    # one place that loads every texture, shader and model file once, no
+    # matter how many renderers ask for it. files are read and decoded on a
+    # thread pool, the gl work happens in update() on the main thread
+
+    def __init__(self, workers=AssetConfig.WORKER_THREADS,
+                 upload_budget=AssetConfig.UPLOAD_BUDGET,
+                 memory_budget=AssetConfig.GPU_MEMORY_BUDGET):
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers)
+        self.upload_budget = upload_budget
+        self.memory_budget = memory_budget
+        # (kind, path) -> Asset, in least recently released order
+        self.assets = collections.OrderedDict()
+        # decoded assets waiting for their upload, filled by the workers
+        self.decoded = collections.deque()
+        self.loading = 0
+        self.gpu_bytes = 0
+        self.frames = 0
+        self.uploads = 0
+        self.evictions = 0
+        self.start_time = time.perf_counter()
+        self.first_frame_time = None
+        self.loaded_time = None
+
+    def acquire(self, kind, path):
+        key = (kind, path)
+        asset = self.assets.get(key)
+        if asset is None:
+            asset = self.assets[key] = Asset(kind, path)
+            self.load(asset)
+        asset.refs += 1
+        return asset
+
+    def acquire_texture(self, path):
+        return self.acquire('texture', path)
+
+    def acquire_shader(self, vert_fname, frag_fname):
+        return self.acquire('shader', (vert_fname, frag_fname))
+
+    def acquire_mesh(self, path):
+        # the loader for meshes is registered by rendering
+        return self.acquire('mesh', path)
+
+    def acquire_models(self, path):
+        return self.acquire('models', path)
+
+    def release(self, asset):
+        asset.refs -= 1
+        if asset.refs <= 0:
+            asset.refs = 0
+            # unreferenced assets stay cached until memory gets tight, the
+            # most recently released ones go last
+            self.assets.move_to_end((asset.kind, asset.path))
+
+    def load(self, asset):
+        self.loading += 1
+        self.loaded_time = None
+        decode = LOADERS[asset.kind][0]
+        future = self.executor.submit(decode, asset.path)
+        future.add_done_callback(
+            lambda future: self.decoded.append((asset, future)))
+
+    def update(self):
+        # call once per frame from the thread owning the gl context
+        start = time.perf_counter()
+        uploads = 0
+        while self.decoded:
+            if uploads and time.perf_counter() - start > self.upload_budget:
+                break
+            asset, future = self.decoded.popleft()
+            self.upload(asset, future, start)
+            uploads += 1
+        self.uploads = uploads
+        if self.gpu_bytes > self.memory_budget:
+            self.evict()
+        self.frames += 1
+
+    def upload(self, asset, future, start):
+        self.loading -= 1
+        error = future.exception()
+        if error is None:
+            asset.data = future.result()
+            try:
+                asset.resource = LOADERS[asset.kind][1](self, asset)
+                asset.state = AssetState.READY
+            except Exception as exc:
+                error = exc
+            asset.data = None
+        if error is not None:
+            LOG.error('Failed to load %s %r: %s', asset.kind, asset.path,
+                      error)
+            asset.state = AssetState.FAILED
+        asset.load_time = time.perf_counter() - self.start_time
+        self.gpu_bytes += asset.gpu_bytes
+        if not self.loading and self.loaded_time is None:
+            self.loaded_time = time.perf_counter() - self.start_time
+            LOG.info('All assets loaded after %.3f s, %.1f MB on the gpu',
+                     self.loaded_time, self.gpu_bytes / 1048576.)
+
+    def evict(self):
+        for key, asset in list(self.assets.items()):
+            if self.gpu_bytes <= self.memory_budget:
+                break
+            if asset.refs or asset.state not in (
+                    AssetState.READY, AssetState.FAILED):
+                continue
+            self.unload(asset)
+            del self.assets[key]
+            self.evictions += 1
+
+    def unload(self, asset):
+        if asset.resource is not None:
+            if asset.kind == 'models':
+                release_models(self, asset.resource)
+            LOADERS[asset.kind][2](asset.resource)
+        self.gpu_bytes -= asset.gpu_bytes
+        asset.resource = None
+        asset.gpu_bytes = 0
+
+    def end_frame(self):
+        # call after a frame has been drawn
+        if self.first_frame_time is None:
+            self.first_frame_time = time.perf_counter() - self.start_time
+            LOG.info('First frame after %.3f s, %d assets still loading',
+                     self.first_frame_time, self.loading)
+
+    def get_stats(self):
+        states = collections.Counter(
+            asset.state for asset in self.assets.values())
+        return {
+            'assets': len(self.assets),
+            'loading': self.loading,
+            'ready': states[AssetState.READY],
+            'failed': states[AssetState.FAILED],
+            'gpu_bytes': self.gpu_bytes,
+            'uploads': self.uploads,
+            'evictions': self.evictions,
+            'first_frame_time': self.first_frame_time,
+            'loaded_time': self.loaded_time,
+        }
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        for asset in self.assets.values():
+            self.unload(asset)
+        self.assets.clear()
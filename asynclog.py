@@ -0,0 +1,157 @@
+# Copyright (c) 2014 Per Lindstrand
+
+import logging
+import logging.handlers
+import queue
+import threading
+
+LOG = logging.getLogger(__name__)
+
+
+class AsyncLogConfig(object):
+
+    # loggers of the server side modules, __main__ is a server run as a
+    # script
+    LOGGERS = ('__main__', 'server', 'supervisor', 'match', 'networking',
+               'replication', 'timers', 'profiler')
+    # records waiting for the writer thread, the ones that don't fit are
+    # dropped and counted rather than blocking the tick
+    QUEUE_SIZE = 10000
+    # records per second let through per call site, with a burst on top
+    # for the summaries that log a line per client or metric. the rest
+    # are counted and summed up in one record at most every interval
+    RATE_LIMIT = 10.
+    BURST = 100
+    SUMMARY_INTERVAL = 1.
+
+
+class CallSite(object):
+
+    __slots__ = ('tokens', 'last', 'suppressed', 'since', 'record')
+
+    def __init__(self, tokens, now):
+        self.tokens = tokens
+        self.last = now
+        # suppressed since the last summary, from when, and the last one of
+        # them that the summary takes the place of
+        self.suppressed = 0
+        self.since = now
+        self.record = None
+
+
+class RateLimitedQueueHandler(logging.handlers.QueueHandler):
+
+    # hands records to a QueueListener thread instead of writing them, so a
+    # burst of the same message doesn't block the caller on i/o. each call
+    # site has a token bucket, records it has no token for are only
+    # counted until a "suppressed" summary goes out for them
+
+    def __init__(self, record_queue, rate=AsyncLogConfig.RATE_LIMIT,
+                 burst=AsyncLogConfig.BURST,
+                 interval=AsyncLogConfig.SUMMARY_INTERVAL):
+        super(RateLimitedQueueHandler, self).__init__(record_queue)
+        self.rate = rate
+        self.burst = burst
+        self.interval = interval
+        self.sites = {}
+        # call sites with suppressed records and no summary yet
+        self.pending = set()
+        self.sites_lock = threading.Lock()
+        self.suppressed = 0
+        self.dropped = 0
+
+    def handle(self, record):
+        key = (record.pathname, record.lineno)
+        now = record.created
+        with self.sites_lock:
+            site = self.sites.get(key)
+            if site is None:
+                site = self.sites[key] = CallSite(self.burst, now)
+            else:
+                site.tokens = min(
+                    site.tokens + (now - site.last) * self.rate, self.burst)
+                site.last = now
+            if site.tokens < 1.:
+                if not site.suppressed:
+                    site.since = now
+                site.suppressed += 1
+                site.record = record
+                self.pending.add(key)
+                self.suppressed += 1
+                return False
+            site.tokens -= 1.
+            if site.suppressed and now - site.since >= self.interval:
+                self.summarize(key, site)
+        return super(RateLimitedQueueHandler, self).handle(record)
+
+    def summarize(self, key, site):
+        # replaces the last suppressed record of the site, the caller holds
+        # the sites lock
+        record = site.record
+        record.args = (site.suppressed, record.getMessage())
+        record.msg = 'Suppressed %d messages like: %s'
+        site.suppressed = 0
+        site.record = None
+        self.pending.discard(key)
+        super(RateLimitedQueueHandler, self).handle(record)
+
+    def flush_summaries(self, now):
+        # summaries of the call sites that went quiet, the busy ones get
+        # theirs along with a record that is let through
+        if not self.pending:
+            return
+        with self.sites_lock:
+            for key in list(self.pending):
+                site = self.sites[key]
+                if now - site.since >= self.interval:
+                    self.summarize(key, site)
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class AsyncLogging(object):
+
+    # routes the loggers through a RateLimitedQueueHandler to the handlers
+    # the root logger had, e.g. from logging.conf, written by one
+    # background thread
+
+    def __init__(self, loggers=AsyncLogConfig.LOGGERS,
+                 queue_size=AsyncLogConfig.QUEUE_SIZE,
+                 rate=AsyncLogConfig.RATE_LIMIT, burst=AsyncLogConfig.BURST,
+                 interval=AsyncLogConfig.SUMMARY_INTERVAL, handlers=None):
+        if handlers is None:
+            handlers = logging.getLogger().handlers
+        self.queue = queue.Queue(queue_size)
+        self.handler = RateLimitedQueueHandler(
+            self.queue, rate, burst, interval)
+        self.listener = logging.handlers.QueueListener(
+            self.queue, *handlers, respect_handler_level=True)
+        self.loggers = [logging.getLogger(name) for name in loggers]
+
+    def start(self):
+        self.listener.start()
+        for logger in self.loggers:
+            logger.addHandler(self.handler)
+            logger.propagate = False
+
+    def flush(self, now):
+        self.handler.flush_summaries(now)
+
+    def stop(self):
+        # writes out what is queued, summaries included
+        self.flush(float('inf'))
+        for logger in self.loggers:
+            logger.removeHandler(self.handler)
+            logger.propagate = True
+        self.listener.stop()
+
+    def get_stats(self):
+        return {
+            'queued': self.queue.qsize(),
+            'suppressed': self.handler.suppressed,
+            'dropped': self.handler.dropped,
+        }
@@ -0,0 +1,1187 @@
+# Copyright (c) 2014 Per Lindstrand
+
+import argparse
+import collections
+import ctypes
+import fnmatch
+import functools
+import io
+import json
+import logging
+import os
+import random
+import socket
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import asynclog
+import chunkbuild
+import governor
+import history
+import lockstep
+import mesh
+import match
+import meshconv
+import minimap
+import navigation
+import netsim
+import networking
+import profiler
+import replay
+import spatial
+import steering
+import terrain
+import timers
+import visibility
+import world
+
+LOG = logging.getLogger(__name__)
+
+TICK_TIME = 1. / 30.
+
+# name -> setup(args), the setup builds the scenario and returns a step
+# function timed once per tick and a function returning extra stats, kept
+# under 'stats' in the results apart from the runner's own keys
+SCENARIOS = collections.OrderedDict()
+
+
+def scenario(name, *counts):
+    def register(setup):
+        for count in counts or (None,):
+            if count is None:
+                SCENARIOS[name] = setup
+            else:
+                SCENARIOS['%s_%d' % (name, count)] = functools.partial(
+                    setup, count=count)
+        return setup
+    return register
+
+
+def no_stats():
+    return {}
+
+
+def scatter(rand, count, size):
+    return rand.random_sample(count) * size, rand.random_sample(count) * size
+
+
+def add_players(sim, rand, count, size):
+    for i in range(count):
+        player = world.Player(sim.spawn_entity(
+            rand.random_sample() * size, rand.random_sample() * size))
+        sim.add_player(player)
+    return sim.players
+
+
+def drive_players(players, rand):
+    for player in players:
+        if rand.random_sample() < .05:
+            player.action_flags = int(rand.randint(0, 1 << 10)) & ~1
+        player.set_rotation(rand.uniform(-np.pi, np.pi))
+
+
+def formation(count, spacing):
+    side = int(np.ceil(np.sqrt(count)))
+    return ((np.arange(count) % side) * spacing,
+            (np.arange(count) // side) * spacing)
+
+
+#
+# simulation scenarios
+#
+
+@scenario('idle_crowd', 1000, 10000, 50000)
+def setup_idle_crowd(args, count):
+    rand = np.random.RandomState(args.seed)
+    sim = world.Simulation()
+    sim.spawn_entities(*scatter(rand, count, np.sqrt(count) * 2.))
+    return functools.partial(sim.update, TICK_TIME), no_stats
+
+
+@scenario('moving_army', 1000, 10000, 50000)
+def setup_moving_army(args, count, prof=None):
+    rand = np.random.RandomState(args.seed)
+    size = np.sqrt(count) * 4.
+    sim = world.Simulation()
+    if prof:
+        sim.profiler = prof
+    players = add_players(sim, rand, 8, size)
+    for x, y in zip(*(column.tolist()
+                      for column in scatter(rand, count, size))):
+        sim.spawn_enemy(x, y, team=1)
+
+    def step():
+        drive_players(players, rand)
+        sim.update(TICK_TIME)
+
+    def stats():
+        return {'ai_decisions': sim.ai.total_decisions,
+                'ai_budget_overruns': sim.ai.budget_overruns}
+    return step, stats
+
+
+@scenario('profiled_army', 10000)
+def setup_profiled_army(args, count):
+    # compare against moving_army_10000 for the cost of the instrumentation
+    prof = profiler.Profiler()
+    step, _ = setup_moving_army(args, count, prof)
+
+    def profiled_step():
+        step()
+        prof.end_tick()
+
+    def stats():
+        return dict((name, summary['p50'])
+                    for name, summary in prof.get_stats().items()
+                    if name.endswith('_ns'))
+    return profiled_step, stats
+
+
+@scenario('dense_melee', 1000, 10000)
+def setup_dense_melee(args, count):
+    sim = world.Simulation()
+    xs, ys = formation(count, 1.5)
+    attacking = world.EntityFlags.ATTACKING
+    sim.spawn_entities(xs, ys * 2., radii=.4, rotations=np.pi * .5,
+                       flags=attacking, teams=1)
+    sim.spawn_entities(xs, ys * 2. + 1., radii=.4, rotations=-np.pi * .5,
+                       flags=attacking, teams=2)
+    # nobody dies so every tick has the same amount of fighting
+    sim.combat.health[:] = 1e12
+
+    def stats():
+        return {'swings': sim.combat.swings, 'hits': sim.combat.hits}
+    return functools.partial(sim.update, TICK_TIME), stats
+
+
+@scenario('maze_army', 50000)
+def setup_maze_army(args, count):
+    # everybody heads for the middle of a walled maze and slides along the
+    # walls on the way
+    rand = np.random.RandomState(args.seed)
+    size = args.map_size
+    grid = terrain.generate_maze(size, size, seed=args.seed)
+    goal = size // 2 + 2
+    open_ys, open_xs = np.nonzero(~grid.get_blocking())
+    picks = rand.randint(len(open_xs), size=count)
+    sim = world.Simulation(grid)
+    ents = sim.spawn_entities(
+        open_xs[picks] + rand.uniform(-.1, .1, count),
+        open_ys[picks] + rand.uniform(-.1, .1, count), radii=.3)
+    nav = navigation.Navigator(grid)
+    nav.get_flow_field(goal, goal).build_all()
+    # a few much faster units to exercise the sub-stepping
+    fast = ents[::100]
+    speed = world.SimulationConfig.PLAYER_MOVE_SPEED
+    prof = sim.profiler = profiler.Profiler()
+
+    def step():
+        nav.steer_entities(goal, goal, ents, speed)
+        for ent in fast:
+            ent.vel_x *= 8.
+            ent.vel_y *= 8.
+        sim.update(TICK_TIME)
+        prof.end_tick()
+
+    def stats():
+        xs, ys = sim.get_entity_arrays(('x', 'y'))
+        txs = np.floor(xs + .5).astype(np.intp)
+        tys = np.floor(ys + .5).astype(np.intp)
+        summary = prof.get_stats()
+        return {
+            'collisions': summary['sim.terrain_collisions']['p50'],
+            'collision_ms': summary['sim.collision_ns']['p50'] / 1e6,
+            # must stay 0, nobody may end up inside a wall
+            'in_walls': int(grid.get_blocking()[tys, txs].sum()),
+        }
+    return step, stats
+
+
+@scenario('choke_point', 50000)
+def setup_choke_point(args, count):
+    # count units packed on one side of a wall head for a goal behind it
+    # through an 8 tile gap, following the flow field with crowd steering
+    # keeping them apart
+    rand = np.random.RandomState(args.seed)
+    size = 256
+    grid = terrain.TerrainGrid(size, size)
+    wall_x = size // 2
+    gap = np.arange(size // 2 - 4, size // 2 + 4)
+    wall_ys = np.setdiff1d(np.arange(size), gap)
+    grid.set_tiles(np.full(wall_ys.size, wall_x), wall_ys,
+                   world.TileType.GRASS, world.TileFlags.BLOCKING)
+    goal = (size - 16, size // 2)
+    nav = navigation.Navigator(grid)
+    field = nav.get_flow_field(*goal)
+    field.build_all()
+    sim = world.Simulation(grid)
+    sim.steering = steering.SteeringSystem()
+    ents = sim.spawn_entities(rand.uniform(8., wall_x - 8., count),
+                              rand.uniform(8., size - 8., count), radii=.4)
+    ids = np.array([ent.id for ent in ents], dtype=np.int64)
+    prof = sim.profiler = profiler.Profiler()
+    lookahead = steering.SteeringConfig.ARRIVAL_RADIUS
+
+    def step():
+        xs, ys = sim.get_entity_arrays(('x', 'y'))
+        dir_x, dir_y = field.sample(xs, ys)
+        # a point ahead along the flow, the goal itself once close
+        goal_xs = xs + dir_x * lookahead
+        goal_ys = ys + dir_y * lookahead
+        close = np.hypot(xs - goal[0], ys - goal[1]) < lookahead
+        goal_xs[close] = goal[0]
+        goal_ys[close] = goal[1]
+        sim.steering.set_goals(ids, goal_xs, goal_ys)
+        sim.update(TICK_TIME)
+        prof.end_tick()
+
+    def stats():
+        xs, ys = sim.get_entity_arrays(('x', 'y'))
+        grid_index = spatial.SpatialGrid(1.)
+        grid_index.build(xs, ys)
+        qi, ni = grid_index.query_pairs(xs, ys, .4)
+        dist = np.hypot(xs[qi] - xs[ni], ys[qi] - ys[ni])
+        summary = prof.get_stats()
+        return {
+            'through_gap': int((xs > wall_x).sum()),
+            # pairs less than a radius apart, stacked on each other
+            'stacked_pairs': int(((qi < ni) & (dist < .4)).sum()),
+            'steering_ms': summary['sim.steering_ns']['p50'] / 1e6,
+            'neighbor_pairs': summary['sim.steering_pairs']['p50'],
+        }
+    return step, stats
+
+
+@scenario('team_visibility', 20000)
+def setup_team_visibility(args, count):
+    # two teams of count units wandering over the map, roughly a tenth of
+    # them cross a tile boundary every tick
+    rand = np.random.RandomState(args.seed)
+    size = args.map_size
+    grid = terrain.generate_random_grid(
+        size, size, blocking_ratio=.05, seed=args.seed)
+    vis = visibility.VisibilityGrid(grid)
+    ids = np.arange(2 * count, dtype=np.int64) | (
+        1 << world.EntityAllocator.INDEX_BITS)
+    xs, ys = scatter(rand, 2 * count, size - 1)
+    teams = np.repeat([1, 2], count)
+    vis.update(ids, xs, ys, teams)
+    vel_xs = rand.uniform(-3., 3., 2 * count) * TICK_TIME
+    vel_ys = rand.uniform(-3., 3., 2 * count) * TICK_TIME
+
+    def step():
+        xs[:] = np.clip(xs + vel_xs, 0., size - 1)
+        ys[:] = np.clip(ys + vel_ys, 0., size - 1)
+        vis.update(ids, xs, ys, teams)
+
+    def stats():
+        return {
+            'moved': vis.moved,
+            'enemies_visible_to_1': int(
+                vis.get_visible_mask(1, ids[teams == 2]).sum()),
+            'tiles_visible_to_1': int(vis.get_visible_tiles(1).sum()),
+        }
+    return step, stats
+
+
+@scenario('rewind_hits', 10000)
+def setup_rewind_hits(args, count):
+    # count units wandering while 64 clients 50 to 250 ms behind each
+    # shoot at 16 of them and sweep one area attack per tick, checked
+    # against where the units were on their screens
+    rand = np.random.RandomState(args.seed)
+    size = args.map_size
+    past = history.PositionHistory()
+    ids = np.arange(count, dtype=np.int64) | (
+        1 << world.EntityAllocator.INDEX_BITS)
+    xs, ys = scatter(rand, count, size - 1)
+    radii = np.full(count, .5)
+    vel_xs = rand.uniform(-3., 3., count) * TICK_TIME
+    vel_ys = rand.uniform(-3., 3., count) * TICK_TIME
+    clock = {'now': 0.}
+    clients = 64
+    lags = rand.uniform(.05, .25, clients)
+    for i in range(past.ticks):
+        clock['now'] += TICK_TIME
+        xs[:] = np.clip(xs + vel_xs, 0., size - 1)
+        ys[:] = np.clip(ys + vel_ys, 0., size - 1)
+        past.record(clock['now'], ids, xs, ys, radii)
+    result = {}
+
+    def step():
+        clock['now'] += TICK_TIME
+        xs[:] = np.clip(xs + vel_xs, 0., size - 1)
+        ys[:] = np.clip(ys + vel_ys, 0., size - 1)
+        past.record(clock['now'], ids, xs, ys, radii)
+        start = time.perf_counter()
+        hits = 0
+        swept = 0
+        for lag in lags.tolist():
+            view_time = clock['now'] - lag
+            targets = rand.randint(count, size=16)
+            # aimed where the target was, give or take
+            aim_xs, aim_ys, aim_radii, found = past.get_positions(
+                view_time, ids[targets])
+            aim_xs = aim_xs + rand.uniform(-.6, .6, 16)
+            aim_ys = aim_ys + rand.uniform(-.6, .6, 16)
+            hits += int(past.check_hits(
+                view_time, ids[targets], aim_xs, aim_ys, .05).sum())
+            swept += past.query_circle(
+                view_time, xs[targets[0]], ys[targets[0]], 2.).size
+        result['query_us'] = (
+            (time.perf_counter() - start) * 1e6 / (2 * clients))
+        result['hits'] = hits
+        result['swept'] = swept
+
+    def stats():
+        history_stats = past.get_stats()
+        return {
+            'hits': result['hits'],
+            'swept': result['swept'],
+            'query_us': round(result['query_us'], 1),
+            'history_kb': history_stats['bytes'] // 1024,
+            'bytes_per_entity_second': round(
+                history_stats['bytes_per_entity_second']),
+        }
+    return step, stats
+
+
+@scenario('minimap_heatmap', 10000, 100000)
+def setup_minimap_heatmap(args, count):
+    # the cpu side of a minimap heatmap refresh, gathering the positions
+    # from the entities and binning them
+    rand = np.random.RandomState(args.seed)
+    size = args.map_size
+    sim = world.Simulation()
+    xs, ys = scatter(rand, count, size - 1)
+    sim.spawn_entities(xs, ys, teams=rand.randint(0, 4, count))
+    result = {}
+
+    def step():
+        xs, ys, teams = sim.get_entity_arrays(('x', 'y', 'team'))
+        result['heatmap'] = minimap.get_heatmap(xs, ys, teams, size, size)
+
+    def stats():
+        heatmap = result['heatmap']
+        return {
+            'cells': heatmap.shape[0] * heatmap.shape[1],
+            'opaque_cells': int((heatmap[:, :, 3] == 255).sum()),
+        }
+    return step, stats
+
+
+@scenario('projectile_storm', 10000, 100000)
+def setup_projectile_storm(args, count):
+    rand = np.random.RandomState(args.seed)
+    size = args.map_size
+    grid = terrain.generate_random_grid(
+        size, size, blocking_ratio=.02, seed=args.seed)
+    sim = world.Simulation(grid)
+    sim.spawn_entities(*scatter(rand, 10000, size))
+    sim.combat.health[:] = 1e12
+    ids, xs, ys, radii = sim.get_collidable_arrays()
+    store = sim.projectiles
+    speed = world.SimulationConfig.VERY_FAST_SPEED * 3.
+
+    def step():
+        # keep the number of projectiles in flight constant
+        missing = count - store.count
+        angles = rand.random_sample(missing) * 2. * np.pi
+        owners = rand.randint(0, ids.size, missing)
+        store.spawn_many(xs[owners], ys[owners], np.cos(angles) * speed,
+                         np.sin(angles) * speed, ids[owners])
+        sim.update(TICK_TIME)
+
+    def stats():
+        return {'live_projectiles': store.count}
+    return step, stats
+
+
+@scenario('ai_scheduler', 20000)
+def setup_ai_scheduler(args, count):
+    rand = np.random.RandomState(args.seed)
+    size = args.map_size
+    sim = world.Simulation()
+    players = [player.entity for player in add_players(sim, rand, 4, size)]
+    for x, y in zip(*(column.tolist()
+                      for column in scatter(rand, count, size))):
+        sim.spawn_enemy(x, y)
+    scheduler = sim.ai
+    scheduler.update_lod(players)
+
+    def stats():
+        return {'decisions_per_tick':
+                    scheduler.total_decisions / float(scheduler.tick),
+                'budget_overruns': scheduler.budget_overruns}
+    return functools.partial(scheduler.update, players, TICK_TIME), stats
+
+
+@scenario('spawn_formation', 50000)
+def setup_spawn_formation(args, count):
+    xs, ys = formation(count, 1.)
+
+    def step():
+        sim = world.Simulation()
+        sim.spawn_entities(xs, ys, radii=.4)
+    return step, no_stats
+
+
+@scenario('despawn_respawn', 50000)
+def setup_despawn_respawn(args, count):
+    rand = random.Random(args.seed)
+    xs, ys = formation(count, 1.)
+    sim = world.Simulation()
+    sim.spawn_entities(xs, ys)
+    half = count // 2
+
+    def step():
+        ids = [ent.id for ent in rand.sample(sim.entities, half)]
+        sim.despawn_entities(ids)
+        sim.spawn_entities(xs[:half], ys[:half])
+    return step, no_stats
+
+
+@scenario('replay', 2000)
+def setup_replay(args, count):
+    fd, path = tempfile.mkstemp(suffix='.bbr')
+    os.close(fd)
+    record_match(open(path, 'wb'), args.seed, enemies=count)
+    with open(path, 'rb') as fileobj:
+        data = fileobj.read()
+    os.remove(path)
+    results = []
+
+    def step():
+        match = replay.MatchReplay(io.BytesIO(data))
+        results.append(match.run())
+
+    def stats():
+        return {'log_bytes': len(data),
+                'speed_x_real_time': results[-1]['speed'],
+                'checksum_mismatches': results[-1]['mismatches']}
+    return step, stats
+
+
+def record_match(fileobj, seed, players=8, enemies=2000, ticks=300):
+    # synthetic match with random player input, as the server records it
+    rand = np.random.RandomState(seed)
+    sim = world.Simulation()
+    recorder = replay.MatchRecorder(fileobj, seed)
+    for player in add_players(sim, rand, players, 64.):
+        recorder.record_spawn(player.entity, replay.SpawnKind.PLAYER)
+    for x, y in zip(*(column.tolist()
+                      for column in scatter(rand, enemies, 256.))):
+        enemy = sim.spawn_enemy(x, y, team=1)
+        recorder.record_spawn(enemy.entity, replay.SpawnKind.ENEMY)
+    for i in range(ticks):
+        drive_players(sim.players, rand)
+        recorder.record_tick(TICK_TIME, sim.players)
+        sim.update(TICK_TIME)
+        recorder.record_update(sim)
+    recorder.close()
+
+
+#
+# subsystem scenarios
+#
+
+@scenario('entity_update', 10000)
+def setup_entity_update(args, count):
+    rand = np.random.RandomState(args.seed)
+    sim = world.Simulation()
+    ents = sim.spawn_entities(*scatter(rand, count, 100.))
+    for ent, vel in zip(ents, rand.random_sample(count).tolist()):
+        ent.acc_x = vel
+        ent.acc_y = -vel
+
+    def step():
+        for ent in ents:
+            ent.update(TICK_TIME)
+    return step, no_stats
+
+
+@scenario('player_update', 10000)
+def setup_player_update(args, count):
+    rand = np.random.RandomState(args.seed)
+    sim = world.Simulation()
+    players = [world.Player(ent) for ent in sim.spawn_entities(
+        *scatter(rand, count, 100.))]
+    drive_players(players, rand)
+
+    def step():
+        for player in players:
+            player.update(TICK_TIME)
+    return step, no_stats
+
+
+@scenario('profiler_calls', 100000)
+def setup_profiler_calls(args, count):
+    profilers = (('null', profiler.NULL_PROFILER),
+                 ('enabled', profiler.Profiler()))
+    call_ns = {}
+
+    def step():
+        for name, prof in profilers:
+            begin = time.perf_counter_ns()
+            for i in range(count):
+                start = prof.start()
+                prof.stop('bench_ns', start)
+            prof.end_tick()
+            call_ns[name] = (time.perf_counter_ns() - begin) / float(count)
+
+    def stats():
+        return dict(('%s_ns_per_call' % name, round(value, 1))
+                    for name, value in call_ns.items())
+    return step, stats
+
+
+def encode_entities(ents):
+    buf = networking.WriteBuffer(networking.Channel.MAX_PACKET_SIZE)
+    for ent in ents:
+        if not (buf.write_uint32(ent.id) and
+                buf.write_float(ent.x) and
+                buf.write_float(ent.y) and
+                buf.write_float(ent.rotation)):
+            break
+    return buf
+
+
+@scenario('write_buffer', 1000)
+def setup_write_buffer(args, count):
+    rand = np.random.RandomState(args.seed)
+    ents = world.Simulation().spawn_entities(*scatter(rand, 32, 100.))
+
+    def step():
+        for i in range(count):
+            encode_entities(ents)
+    return step, no_stats
+
+
+@scenario('read_buffer', 1000)
+def setup_read_buffer(args, count):
+    rand = np.random.RandomState(args.seed)
+    ents = world.Simulation().spawn_entities(*scatter(rand, 32, 100.))
+    data = encode_entities(ents).get_data()
+
+    def step():
+        for i in range(count):
+            buf = networking.ReadBuffer(data)
+            while buf.can_read(16):
+                buf.read_uint32()
+                buf.read_float()
+                buf.read_float()
+                buf.read_float()
+    return step, no_stats
+
+
+@scenario('compress_data', 1000)
+def setup_compress_data(args, count):
+    rand = random.Random(args.seed)
+    data = ' '.join('%d:%.2f,%.2f' % (i, rand.uniform(0., 256.),
+                                      rand.uniform(0., 256.))
+                    for i in range(32))
+    compressed = networking.compress_data(data)
+
+    def step():
+        for i in range(count):
+            networking.decompress_data(networking.compress_data(data))
+
+    def stats():
+        return {'raw_bytes': len(data), 'compressed_bytes': len(compressed)}
+    return step, stats
+
+
+@scenario('channel_traffic', 1000)
+def setup_channel_traffic(args, count):
+    # a lossy loopback link: 1 in 20 datagrams is dropped, 1 in 50 arrives
+    # twice, so the telemetry has something to count
+    rand = random.Random(args.seed)
+    socks = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+             for i in range(2)]
+    for sock in socks:
+        sock.bind(('127.0.0.1', 0))
+    server = networking.Channel(socks[0], socks[1].getsockname())
+    client = networking.Channel(socks[1], socks[0].getsockname())
+    data = ' '.join('%d:%.2f' % (i, rand.uniform(0., 256.))
+                    for i in range(32))
+
+    def transfer(sender, receiver):
+        sender.send_data()
+        datagram = receiver.sock.recv(networking.Channel.MAX_PACKET_SIZE)
+        roll = rand.random()
+        if roll < .05:
+            return
+        receiver.on_data_received(datagram)
+        if roll > .98:
+            receiver.on_data_received(datagram)
+        receiver.recv_packet()
+
+    def step():
+        for i in range(count):
+            server.send_packet(data, kind='state')
+            transfer(server, client)
+            if i % 4 == 0:
+                client.send_packet('input', kind='input')
+                transfer(client, server)
+
+    def stats():
+        stats = networking.aggregate_stats([server, client])
+        return dict((name, stats[name]) for name in (
+            'packets_sent', 'packets_lost', 'loss_rate', 'rtt_mean'))
+    return step, stats
+
+
+@scenario('mesh_load', 36, 100000)
+def setup_mesh_load(args, count):
+    # building the vertex buffer data from attribute lists the way the
+    # renderer used to, against reading a mesh file into it
+    rand = random.Random(args.seed)
+    xyz = [rand.uniform(-.5, .5) for i in range(count * 3)]
+    uvs = [rand.uniform(0., 1.) for i in range(count * 2)]
+    norms = [rand.uniform(-1., 1.) for i in range(count * 3)]
+    fname = os.path.join(tempfile.mkdtemp(), 'bench.mesh')
+    mesh.write_mesh(fname, *meshconv.interleave(xyz, uvs, norms))
+    times = {}
+
+    def step():
+        start = time.perf_counter()
+        data = []
+        xyz_it = iter(xyz)
+        uv_it = iter(uvs)
+        norm_it = iter(norms)
+        for i in range(count):
+            data.extend([
+                next(xyz_it), next(xyz_it), next(xyz_it),
+                next(uv_it), next(uv_it),
+                next(norm_it), next(norm_it), next(norm_it)])
+        (ctypes.c_float * len(data))(*data)
+        times['lists_us'] = (time.perf_counter() - start) * 1e6
+        start = time.perf_counter()
+        mesh.read_mesh(fname)
+        times['mesh_file_us'] = (time.perf_counter() - start) * 1e6
+
+    def stats():
+        return dict((name, round(value, 1)) for name, value in times.items())
+    return step, stats
+
+
+@scenario('client_burst', 100, 1000)
+def setup_client_burst(args, count):
+    # a server bursts count snapshots per frame at a ChannelThread while
+    # the render thread is busy for a frame, then the frame takes all of
+    # them. latency is from the server send to the frame seeing it
+    server_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server_sock.bind(('127.0.0.1', 0))
+    conn = networking.ChannelThread(server_sock.getsockname())
+    conn.start()
+    conn.send('hello')
+    client_addr = server_sock.recvfrom(networking.MAX_DATAGRAM_SIZE)[1]
+    server = networking.Channel(server_sock, client_addr)
+    latencies = []
+    frame = {}
+
+    def step():
+        for i in range(count):
+            server.send_packet('%.9f %s' % (time.perf_counter(), 'x' * 64))
+            server.send_data()
+        time.sleep(TICK_TIME)
+        start = time.perf_counter()
+        messages = conn.receive()
+        for recv_time, packet in messages:
+            sent = float(packet.split(b' ', 1)[0])
+            latencies.append(start - sent)
+        frame['received'] = len(messages)
+        frame['take_ms'] = (time.perf_counter() - start) * 1000.
+
+    def stats():
+        ordered = sorted(latencies)
+        return {
+            'received_last_frame': frame['received'],
+            'take_ms': round(frame['take_ms'], 3),
+            'latency_p50_ms': round(percentile(ordered, .5) * 1000., 3),
+            'latency_max_ms': round(ordered[-1] * 1000., 3),
+            'dropped': conn.inbox.dropped,
+        }
+    return step, stats
+
+
+class UploadedChunk(object):
+
+    def __init__(self, revision, texels):
+        self.revision = revision
+        self.texels = texels
+
+
+@scenario('chunk_streaming', 0, 2)
+def setup_chunk_streaming(args, count):
+    # the client zoomed out and panning fast across a 4096x4096 map, the
+    # chunks built by count workers or on the main thread for 0. a step is
+    # 10 frames at 60 fps, each timed over the chunk streaming plus 2 ms
+    # standing in for the rest of the frame, then sleeping until the next
+    # one while the workers get on with it. copying the texels stands in
+    # for the gl upload. a hitch is a frame over twice the median
+    size = 4096
+    grid = terrain.generate_random_grid(
+        size, size, [world.TileType.GRASS, world.TileType.SAND,
+                     world.TileType.WATER],
+        blocking_ratio=.1, seed=args.seed)
+    grid.get_blocking()
+    palette = np.random.RandomState(args.seed).randint(
+        0, 256, (256, 4)).astype(np.uint8)
+    frame_time = 1. / 60.
+    speed = 600.
+    reach = 160
+    chunks = {}
+
+    def build(cx, cy):
+        return chunkbuild.build_chunk(grid, cx, cy, palette, .5)
+
+    def upload(key, built):
+        chunks[key] = UploadedChunk(built.revision, built.texels.copy())
+
+    pool = chunkbuild.ChunkBuildPool(build, count)
+    budget = chunkbuild.ChunkBuildConfig.UPLOAD_BUDGET if count else 1e9
+    camera = {'x': float(reach), 'y': float(reach), 'dx': 1., 'dy': .6}
+    frames = []
+    drawn = [0, 0]
+
+    def frame():
+        start = time.perf_counter()
+        # bouncing off the edges of the map
+        for axis in ('x', 'y'):
+            value = camera[axis] + camera['d' + axis] * speed * frame_time
+            if not reach <= value <= size - reach:
+                camera['d' + axis] = -camera['d' + axis]
+                value = min(max(value, reach), size - reach)
+            camera[axis] = value
+        x = int(camera['x'])
+        y = int(camera['y'])
+        bounds = (x - reach, y - reach, x + reach, y + reach)
+        visible, window, wanted = chunkbuild.get_chunk_window(
+            grid, bounds, camera['x'], camera['y'], chunks)
+        pool.request(wanted)
+        pool.upload(upload, window, budget)
+        for key in list(chunks):
+            if key not in window:
+                del chunks[key]
+        drawn[0] += sum(key in chunks for key in visible)
+        drawn[1] += len(visible)
+        while time.perf_counter() - start < .002:
+            pass
+        elapsed = time.perf_counter() - start
+        frames.append(elapsed)
+        time.sleep(max(frame_time - elapsed, 0.))
+
+    def step():
+        for i in range(10):
+            frame()
+
+    def stats():
+        ordered = sorted(frames)
+        median = percentile(ordered, .5)
+        hitches = sum(elapsed > 2. * median for elapsed in frames)
+        pool_stats = pool.get_stats()
+        return {
+            'frames': len(frames),
+            'frame_p50_ms': round(median * 1000., 3),
+            'frame_p99_ms': round(percentile(ordered, .99) * 1000., 3),
+            'frame_max_ms': round(ordered[-1] * 1000., 3),
+            'hitches': hitches,
+            'hitch_rate': round(hitches / float(len(frames)), 4),
+            'drawn_ratio': round(drawn[0] / float(max(drawn[1], 1)), 4),
+            'builds': pool_stats['builds'],
+            'cancelled': pool_stats['cancelled'],
+        }
+    return step, stats
+
+
+@scenario('frame_governor', 10000)
+def setup_frame_governor(args, count):
+    # a FrameGovernor run over synthetic traces of count frames, a frame
+    # costing the load of the trace times the share of the work left at
+    # its quality level, plus a little noise. deterministic for a seed,
+    # the same decisions every step
+    level_costs = (1., .8, .6, .45, .35)
+    noise = np.random.RandomState(args.seed + 1).normal(1., .03, count)
+    traces = governor.get_frame_traces(args.seed, count)
+    result = {}
+
+    def step():
+        for name, loads in traces.items():
+            gov = governor.FrameGovernor()
+            target = gov.target
+            over = 0
+            levels = 0
+            for load, jitter in zip(loads.tolist(), noise.tolist()):
+                frame_time = target * load * level_costs[gov.level] * jitter
+                over += frame_time > target * governor.GovernorConfig.DROP_RATIO
+                levels += gov.level
+                gov.add_frame(frame_time)
+            ungoverned = target * loads * noise
+            result[name] = {
+                'drops': gov.drops,
+                'raises': gov.raises,
+                'final_level': gov.level,
+                'mean_level': round(levels / float(count), 3),
+                'over_target': round(over / float(count), 4),
+                'ungoverned_over_target': round(float(np.mean(
+                    ungoverned > target *
+                    governor.GovernorConfig.DROP_RATIO)), 4),
+            }
+
+    def stats():
+        return dict(('%s_%s' % (name, key), value)
+                    for name, trace in result.items()
+                    for key, value in trace.items())
+    return step, stats
+
+
+@scenario('lockstep', 1000, 10000)
+def setup_lockstep(args, count):
+    # 4 peers with 2 ticks of latency and 5% loss running count entities
+    # in lockstep. the bytes per tick stay the same whatever the count
+    peers = 4
+    game = lockstep.LockstepMatch(peers, count, args.seed, 2, .05)
+
+    def step():
+        game.step()
+
+    def stats():
+        ticks = max(peer.sim.tick for peer in game.peers)
+        while min(peer.sim.tick for peer in game.peers) < ticks:
+            # hold the others until the slowest caught up
+            game.step(ticks)
+        checksums = game.get_checksums()
+        return {
+            'ticks': ticks,
+            'bytes_per_peer_tick': round(
+                game.bytes / float(peers * game.frame), 1),
+            'stalls': sum(peer.stalls for peer in game.peers),
+            'desyncs': sum(peer.desync_tick is not None
+                           for peer in game.peers),
+            'checksums_equal': len(set(checksums)) == 1,
+        }
+    return step, stats
+
+
+@scenario('timer_wheel', 100000)
+def setup_timer_wheel(args, count):
+    # count timers active at all times, spread over a minute. fired ones
+    # schedule a new one and a percent per tick get pushed back like idle
+    # timeouts do
+    rand = random.Random(args.seed)
+    clock = {'now': 0.}
+    wheel = timers.TimerWheel(0.)
+    active = []
+
+    def on_fire(index):
+        active[index] = wheel.schedule(rand.uniform(0., 60.), on_fire, index)
+
+    for i in range(count):
+        active.append(wheel.schedule(rand.uniform(0., 60.), on_fire, i))
+    pushes = count // 100
+    result = {}
+
+    def step():
+        clock['now'] += TICK_TIME
+        for i in range(pushes):
+            wheel.reschedule(active[rand.randrange(count)],
+                             rand.uniform(0., 60.))
+        result['fired'] = wheel.advance(clock['now'])
+        result['timeout'] = wheel.get_timeout(clock['now'], 1.)
+
+    def stats():
+        return {
+            'active': len(wheel),
+            'fired_last_tick': result['fired'],
+            'timeout_ms': round(result['timeout'] * 1000., 3),
+        }
+    return step, stats
+
+
+@scenario('client_churn', 100)
+def setup_client_churn(args, count):
+    # count new clients per simulated second that send one packet and
+    # vanish. they time out, so the clients, their timers and channels
+    # level off at count times the timeout instead of growing
+    clock = {'now': time.time()}
+    game = netsim.create_match(args.seed)
+    packet = netsim.get_connect_packet()
+    next_addr = [0]
+    sizes = []
+
+    def step():
+        for i in range(count):
+            game.on_datagram(('10.0.0.1', next_addr[0]), packet)
+            next_addr[0] += 1
+        clock['now'] += 1.
+        game.timers.advance(clock['now'])
+        # a tick now and then, it clears the simulation's events
+        game.step()
+        game.send()
+        sizes.append(len(game.clients))
+
+    def stats():
+        return {
+            'clients': len(game.clients),
+            'clients_peak': max(sizes),
+            'timers': len(game.timers),
+            'entities': len(game.sim.entities),
+            'connected_total': next_addr[0],
+        }
+    return step, stats
+
+
+@scenario('loss_storm', 100)
+def setup_loss_storm(args, count):
+    # count clients each sending 8 packets per tick of which every other
+    # one is lost, so every packet that arrives logs the gap and is logged
+    # again by handle_packets. the same tick is timed with the match and
+    # networking loggers writing to a file directly, through asynclog and
+    # with debug logging off
+    fname = os.path.join(tempfile.mkdtemp(), 'loss_storm.log')
+    file_handler = logging.FileHandler(fname)
+    file_handler.setFormatter(logging.Formatter(
+        '%(asctime)s: %(name)s: %(levelname)s: %(message)s'))
+    writer = asynclog.AsyncLogging(('match', 'networking'),
+                                   handlers=[file_handler])
+    writer.listener.start()
+    loggers = [logging.getLogger(name) for name in ('match', 'networking')]
+    modes = collections.OrderedDict([
+        ('sync', (logging.DEBUG, file_handler)),
+        ('async', (logging.DEBUG, writer.handler)),
+        ('off', (logging.WARNING, file_handler)),
+    ])
+    game = netsim.create_match(args.seed)
+    sender = networking.Channel(netsim.NullSocket(), None)
+    sender.send_packet('input')
+    payload = sender.outbox[0][1]
+    addrs = [('10.0.0.1', port) for port in range(count)]
+    next_id = [0]
+    times = collections.defaultdict(list)
+
+    def tick():
+        for i in range(8):
+            packet = sender.frame_packet(next_id[0], payload, 0.)
+            for addr in addrs:
+                game.on_datagram(addr, packet)
+            next_id[0] += 2
+            game.handle_packets()
+        game.step()
+        game.send()
+
+    def step():
+        for name, (level, handler) in modes.items():
+            for logger in loggers:
+                logger.setLevel(level)
+                logger.handlers = [handler]
+                logger.propagate = False
+            start = time.perf_counter()
+            tick()
+            times[name].append(time.perf_counter() - start)
+        for logger in loggers:
+            logger.setLevel(logging.NOTSET)
+            logger.handlers = []
+            logger.propagate = True
+        writer.flush(time.time())
+
+    def stats():
+        stats = {}
+        for name, samples in times.items():
+            stats[name + '_p50_ms'] = round(
+                percentile(sorted(samples), .5) * 1000., 3)
+            stats[name + '_max_ms'] = round(max(samples) * 1000., 3)
+        stats.update(writer.get_stats())
+        return stats
+    return step, stats
+
+
+@scenario('congested_link', 1000, 10000)
+def setup_congested_link(args, count):
+    # count entities replicated over a link whose capacity halves and
+    # recovers every 5 simulated seconds. a step is one simulated second
+    rand = np.random.RandomState(args.seed)
+    arrays, own = netsim.get_replication_arrays(rand, count)
+    capacities = (48000., 24000.)
+    links = netsim.create_congested_links(capacities[0])
+    clock = {'tick': 0, 'seconds': 0}
+
+    def step():
+        capacity = capacities[(clock['seconds'] // 5) % 2]
+        clock['tick'] = netsim.run_congested_links(
+            links, capacity, 1., clock['tick'], arrays, own)
+        clock['seconds'] += 1
+
+    def stats():
+        stats = {'capacity': capacities[(clock['seconds'] - 1) // 5 % 2]}
+        for name, link in links.items():
+            stats[name + '_updates_per_sec'] = round(
+                link.delivered / float(clock['seconds']))
+            stats[name + '_loss_rate'] = round(link.get_loss_rate(), 4)
+            stats[name + '_rate'] = round(
+                link.replication.controller.rate)
+            stats[name + '_rtt_ms'] = round(
+                (link.server.stats.srtt or 0.) * 1000., 1)
+            stats[name + '_max_rtt_ms'] = round(link.max_rtt * 1000., 1)
+        return stats
+    return step, stats
+
+
+@scenario('terrain_generation', 256, 1024)
+def setup_terrain_generation(args, count):
+    def step():
+        terrain.generate_random_square_patch(count, [0, 1])
+        terrain.generate_random_grid(
+            count, count, [world.TileType.GRASS, world.TileType.SAND],
+            blocking_ratio=.1, seed=args.seed)
+    return step, no_stats
+
+
+@scenario('nav_integration', 1024)
+def setup_nav_integration(args, count):
+    grid = terrain.generate_random_grid(
+        count, count, [world.TileType.GRASS, world.TileType.SAND],
+        blocking_ratio=.1, seed=args.seed)
+    goal = count // 2
+    grid.set_tile(goal, goal, world.TileType.GRASS)
+    nav = navigation.Navigator(grid)
+
+    def step():
+        field = navigation.FlowField(goal, goal, grid)
+        field.integrate(nav.cost)
+        field.build_all()
+    return step, no_stats
+
+
+@scenario('nav_steering', 50000)
+def setup_nav_steering(args, count):
+    rand = np.random.RandomState(args.seed)
+    size = args.map_size
+    grid = terrain.generate_random_grid(
+        size, size, blocking_ratio=.1, seed=args.seed)
+    goal = size // 2
+    grid.set_tile(goal, goal, world.TileType.GRASS)
+    nav = navigation.Navigator(grid)
+    sim = world.Simulation()
+    ents = sim.spawn_entities(*scatter(rand, count, size - 1))
+    nav.get_flow_field(goal, goal).build_all()
+    speed = world.SimulationConfig.PLAYER_MOVE_SPEED
+    return functools.partial(
+        nav.steer_entities, goal, goal, ents, speed), no_stats
+
+
+#
+# running and reporting
+#
+
+def percentile(samples, fraction):
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def run_scenario(name, setup, args):
+    step, stats = setup(args)
+    for i in range(args.warmup):
+        step()
+    samples = []
+    for i in range(args.ticks):
+        start = time.perf_counter()
+        step()
+        samples.append(time.perf_counter() - start)
+    result = collections.OrderedDict()
+    total = sum(samples)
+    samples.sort()
+    result['ticks'] = len(samples)
+    result['ticks_per_sec'] = len(samples) / total if total else 0.
+    result['mean_ms'] = total / len(samples) * 1000.
+    result['p50_ms'] = percentile(samples, .5) * 1000.
+    result['p99_ms'] = percentile(samples, .99) * 1000.
+    result['max_ms'] = samples[-1] * 1000.
+    result['stats'] = stats()
+    if args.memory:
+        # separate pass, tracing allocations skews the timings
+        tracemalloc.start()
+        step, stats = setup(args)
+        for i in range(args.memory_ticks):
+            step()
+        result['peak_memory_kb'] = tracemalloc.get_traced_memory()[1] // 1024
+        tracemalloc.stop()
+    return result
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        ratio = result['p50_ms'] / max(base['p50_ms'], 1e-6)
+        status = 'ok'
+        if ratio > 1. + threshold:
+            status = 'REGRESSION'
+            regressions.append(name)
+        elif ratio < 1. - threshold:
+            status = 'improved'
+        print('%-28s p50 %9.3f ms vs %9.3f ms  %+6.1f%%  %s' % (
+            name, result['p50_ms'], base['p50_ms'], (ratio - 1.) * 100.,
+            status))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Big Battle benchmarks')
+    parser.add_argument('scenarios', nargs='*', default=['*'],
+                        help='scenario names or patterns, e.g. "idle_*"')
+    parser.add_argument('--list', action='store_true')
+    parser.add_argument('--ticks', type=int, default=50)
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--memory-ticks', type=int, default=3)
+    parser.add_argument('--no-memory', dest='memory', action='store_false')
+    parser.add_argument('--map-size', type=int, default=1024)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', metavar='FILE',
+                        help='write the results as JSON')
+    parser.add_argument('--baseline', metavar='FILE',
+                        help='JSON results to compare against')
+    parser.add_argument('--threshold', type=float, default=.1,
+                        help='relative p50 slowdown counted as regression')
+    args = parser.parse_args()
+
+    if args.list:
+        for name in SCENARIOS:
+            print(name)
+        return
+
+    names = [name for name in SCENARIOS
+             if any(fnmatch.fnmatch(name, pattern)
+                    for pattern in args.scenarios)]
+    if not names:
+        parser.error('no scenario matches %s' % ' '.join(args.scenarios))
+
+    results = collections.OrderedDict()
+    for name in names:
+        random.seed(args.seed)
+        result = run_scenario(name, SCENARIOS[name], args)
+        results[name] = result
+        print('%-28s %9.1f ticks/s  p50 %9.3f ms  p99 %9.3f ms  %s' % (
+            name, result['ticks_per_sec'], result['p50_ms'], result['p99_ms'],
+            '%8d KB' % result['peak_memory_kb'] if args.memory else ''))
+        sys.stdout.flush()
+
+    if args.output:
+        with open(args.output, 'w') as fileobj:
+            json.dump(results, fileobj, indent=2)
+    if args.baseline:
+        with open(args.baseline) as fileobj:
+            baseline = json.load(fileobj)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print('%d regressions: %s' % (
+                len(regressions), ', '.join(regressions)))
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
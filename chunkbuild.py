@@ -0,0 +1,205 @@
+# Copyright (c) 2014 Per Lindstrand
+
+import collections
+import logging
+import threading
+import time
+
+import numpy as np
+
+LOG = logging.getLogger(__name__)
+
+
+class ChunkBuildConfig(object):
+
+    WORKER_THREADS = 2
+    # seconds per frame spent on gl uploads of built chunks, at least one
+    # upload per frame happens regardless so the terrain fills in
+    UPLOAD_BUDGET = .002
+    # chunks around the visible ones that get built ahead of the camera
+    PREFETCH_CHUNKS = 1
+
+
+class ChunkBuild(object):
+
+    # what a worker hands over for the upload of one chunk
+
+    def __init__(self, revision, texels, vertices):
+        # terrain revision the chunk was built at
+        self.revision = revision
+        self.texels = texels
+        self.vertices = vertices
+
+
+def bake_chunk(terrain, cx, cy, palette, blocking_shade):
+    # one rgba texel per tile, in rows of increasing y
+    x0, y0, x1, y1 = terrain.chunk_bounds(cx, cy)
+    texels = palette[terrain.types[y0:y1, x0:x1]]
+    blocking = terrain.get_blocking()[y0:y1, x0:x1]
+    texels[blocking, :3] = texels[blocking, :3] * blocking_shade
+    return texels
+
+
+def get_chunk_vertices(terrain, cx, cy):
+    # interleaved u, v, x, y, z float32s of the chunk quad at the height of
+    # the cube tops, for glInterleavedArrays(GL_T2F_V3F)
+    x0, y0, x1, y1 = terrain.chunk_bounds(cx, cy)
+    return np.array([
+        (0., 0., x0 - .5, 0., y0 - .5),
+        (0., 1., x0 - .5, 0., y1 - .5),
+        (1., 1., x1 - .5, 0., y1 - .5),
+        (1., 0., x1 - .5, 0., y0 - .5),
+    ], dtype=np.float32)
+
+
+def build_chunk(terrain, cx, cy, palette, blocking_shade):
+    # the revision is read first, a chunk changed during the build is
+    # stale and gets built again
+    revision = terrain.revision
+    return ChunkBuild(revision,
+                      bake_chunk(terrain, cx, cy, palette, blocking_shade),
+                      get_chunk_vertices(terrain, cx, cy))
+
+
+def get_chunk_window(terrain, tile_bounds, cam_x, cam_y, chunks,
+                     prefetch=ChunkBuildConfig.PREFETCH_CHUNKS):
+    # (visible, window, wanted): the visible chunk keys in drawing order,
+    # those plus the prefetch margin around them, and the chunks of the
+    # window missing from chunks or stale, by distance to the camera
+    tile_min_x, tile_min_y, tile_max_x, tile_max_y = tile_bounds
+    size = terrain.chunk_size
+    min_cx = tile_min_x // size
+    min_cy = tile_min_y // size
+    max_cx = (tile_max_x - 1) // size
+    max_cy = (tile_max_y - 1) // size
+    visible = [(cx, cy) for cy in range(min_cy, max_cy + 1)
+               for cx in range(min_cx, max_cx + 1)]
+    window = set()
+    wanted = {}
+    revisions = terrain.chunk_revisions
+    for cy in range(max(min_cy - prefetch, 0),
+                    min(max_cy + prefetch + 1, terrain.chunks_y)):
+        for cx in range(max(min_cx - prefetch, 0),
+                        min(max_cx + prefetch + 1, terrain.chunks_x)):
+            key = (cx, cy)
+            window.add(key)
+            chunk = chunks.get(key)
+            if chunk is None or chunk.revision < revisions[cy, cx]:
+                dx = (cx + .5) * size - cam_x
+                dy = (cy + .5) * size - cam_y
+                wanted[key] = dx * dx + dy * dy
+    return visible, window, wanted
+
+
+class ChunkBuildPool(object):
+
+    # worker threads building terrain chunks, nearest to the camera first.
+    # request() replaces what is waiting with what the current frame wants,
+    # so chunks that scrolled away are dropped before a worker gets to
+    # them. finished builds wait in a deque for upload() on the main thread
+
+    def __init__(self, build, workers=ChunkBuildConfig.WORKER_THREADS):
+        # build(cx, cy) -> ChunkBuild, called on the workers
+        self.build = build
+        self.condition = threading.Condition()
+        # key -> priority, lower first
+        self.pending = {}
+        # keys on a worker or built and not uploaded yet
+        self.busy = set()
+        self.built = collections.deque()
+        self.closed = False
+        self.requested = 0
+        self.cancelled = 0
+        self.builds = 0
+        self.failures = 0
+        self.uploads = 0
+        self.threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self.run,
+                                      name='chunk-build-%d' % i)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def request(self, wanted):
+        # wanted is key -> priority of every chunk the frame still needs
+        with self.condition:
+            for key in list(self.pending):
+                if key not in wanted:
+                    del self.pending[key]
+                    self.cancelled += 1
+            for key, priority in wanted.items():
+                if key in self.busy:
+                    continue
+                if key not in self.pending:
+                    self.requested += 1
+                self.pending[key] = priority
+            if self.pending:
+                self.condition.notify(len(self.threads))
+        if not self.threads:
+            # no workers, everything gets built right away
+            while self.pending:
+                self.run_one(self.take_pending())
+
+    def take_pending(self):
+        key = min(self.pending, key=self.pending.get)
+        del self.pending[key]
+        self.busy.add(key)
+        return key
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    return
+                key = self.take_pending()
+            self.run_one(key)
+
+    def run_one(self, key):
+        try:
+            result = self.build(*key)
+        except Exception:
+            LOG.exception('Failed to build chunk %r', key)
+            result = None
+        self.built.append((key, result))
+
+    def upload(self, upload, window, budget=ChunkBuildConfig.UPLOAD_BUDGET):
+        # call once per frame from the thread owning the gl context, builds
+        # of chunks that left the window are dropped without an upload
+        start = time.perf_counter()
+        uploads = 0
+        while self.built:
+            if uploads and time.perf_counter() - start > budget:
+                break
+            key, result = self.built.popleft()
+            with self.condition:
+                self.busy.discard(key)
+            if result is None:
+                self.failures += 1
+                continue
+            self.builds += 1
+            if key not in window:
+                self.cancelled += 1
+                continue
+            upload(key, result)
+            uploads += 1
+        self.uploads = uploads
+
+    def get_stats(self):
+        return {
+            'pending': len(self.pending),
+            'built': len(self.built),
+            'requested': self.requested,
+            'cancelled': self.cancelled,
+            'builds': self.builds,
+            'failures': self.failures,
+            'uploads': self.uploads,
+        }
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.pending.clear()
+            self.condition.notify_all()
@@ -3,7 +3,6 @@
 import logging
 import logging.config
 import socket
-import select
 import sys
 import time
 import os
@@ -13,8 +12,12 @@ import pyglet
 from pyglet.window import key
 from pyglet.gl import *
 
+import assets
+import governor
 import networking
+import profiler
 import rendering
+import replication
 import terrain
 import world
 
@@ -22,6 +25,10 @@ LOG = logging.getLogger(__name__)
 
 WINDOW_WIDTH = 1024
 WINDOW_HEIGHT = 768
+CAMERA_MIN_SCALE = 3.
+CAMERA_MAX_SCALE = 200.
+CAMERA_ZOOM_STEP = 1.1
+STATS_LOG_INTERVAL = 10.
 
 
 class GameWindow(pyglet.window.Window):
@@ -32,22 +39,28 @@ class GameWindow(pyglet.window.Window):
         self.start_time = time.time()
         self.last_update = time.time()
         # networking
-        self.sock = None
-        self.chan = None
+        self.connection = None
         self.server_addr = None
         # XXX move to somewhere else!
-        self.shader_cache = rendering.ShaderCache()
-        self.world_rendering = rendering.WorldRendering(self.shader_cache)
-        self.terrain_rendering = rendering.TerrainRendering(self.shader_cache)
+        self.assets = assets.AssetManager()
+        self.world_rendering = rendering.WorldRendering(self.assets)
+        self.terrain_rendering = rendering.TerrainRendering(self.assets)
+        self.minimap_rendering = rendering.MinimapRendering()
         self.terrain_size = 256
-        self.terrain_grid = terrain.generate_random_square_patch(
-            self.terrain_size, [0,1])
+        self.terrain_grid = terrain.generate_random_grid(
+            self.terrain_size, self.terrain_size,
+            [world.TileType.GRASS, world.TileType.SAND])
         self.world_simulation = world.Simulation()
+        self.governor = governor.FrameGovernor()
+        # seconds from the network thread receiving a packet to the frame
+        # handling it, over the last packets
+        self.receive_latency = profiler.Histogram()
         self.camera = rendering.IsometricCamera(
             x=self.terrain_size * .5, y=self.terrain_size * .5, scale=6.)
         self.player_ent = self.world_simulation.spawn_entity(
             self.terrain_size * .5, self.terrain_size * .5)
         self.player = world.Player(self.player_ent)
+        self.world_simulation.add_player(self.player)
 
     def on_activate(self):
         self.active = True
@@ -66,10 +79,14 @@ class GameWindow(pyglet.window.Window):
             self.last_update = now
         frame_time = now - self.last_update
         self.last_update = now
+        if frame_time > 0. and self.governor.add_frame(frame_time):
+            self.apply_quality()
+        quality = self.governor.get_quality()
 
         # update game
-        self.player.update(frame_time)
+        self.poll_network()
         self.world_simulation.update(frame_time)
+        self.assets.update()
 
         # clear screen
         #self.clear()
@@ -97,14 +114,16 @@ class GameWindow(pyglet.window.Window):
             self.camera.y,
             self.camera.scale,
             self.terrain_grid,
-            self.terrain_size,
-            self.terrain_size)
+            quality['view_extent'])
         #self.world_rendering.draw_terrain_patch(
         #    0., 0.,
         #    self.terrain_grid,
         #    self.terrain_size,
         #    self.terrain_size)
-        self.world_rendering.draw_entities(self.world_simulation.entities)
+        full_detail_ents, low_detail_ents = governor.select_entities(
+            self.world_simulation.entities, self.camera.x, self.camera.y,
+            quality)
+        self.world_rendering.draw_entities(full_detail_ents, low_detail_ents)
 
         # hud drawing
         glMatrixMode(GL_PROJECTION)
@@ -115,8 +134,49 @@ class GameWindow(pyglet.window.Window):
         glDisable(GL_DEPTH_TEST)
         glDisable(GL_LIGHTING)
         glDisable(GL_LIGHT0)
-        # ...
+        self.minimap_rendering.update(
+            self.terrain_grid, self.world_simulation, now)
+        self.minimap_rendering.draw(
+            window_width, window_height,
+            self.camera.x, self.camera.y, self.camera.scale)
         #ui_renderer.draw(window_width, window_height)
+        self.assets.end_frame()
+
+    def apply_quality(self):
+        # the rest of the quality knobs are read every frame
+        if self.governor.get_quality()['msaa']:
+            glEnable(GL_MULTISAMPLE)
+        else:
+            glDisable(GL_MULTISAMPLE)
+
+    def get_stats(self):
+        stats = dict(('governor.' + name, value)
+                     for name, value in self.governor.get_stats().items())
+        stats.update(('assets.' + name, value)
+                     for name, value in self.assets.get_stats().items())
+        latency = self.receive_latency.summary()
+        if latency:
+            stats.update(('network.receive_latency_' + name, value)
+                         for name, value in latency.items())
+        return stats
+
+    def log_stats(self, dt):
+        latency = self.receive_latency.summary()
+        if latency:
+            LOG.info('Receive latency p50 %.1f ms  p99 %.1f ms  max %.1f ms, '
+                     'frame time %.1f ms',
+                     latency['p50'] * 1000., latency['p99'] * 1000.,
+                     latency['max'] * 1000.,
+                     self.governor.get_average() * 1000.)
+
+    def on_close(self):
+        if self.connection:
+            self.connection.close()
+        self.world_rendering.close()
+        self.terrain_rendering.close()
+        self.minimap_rendering.close()
+        self.assets.close()
+        super(GameWindow, self).on_close()
 
     def on_key(self, symbol, modifiers, pressed):
         if symbol == key.W:
@@ -157,55 +217,46 @@ class GameWindow(pyglet.window.Window):
         pass
 
     def on_mouse_scroll(self, x, y, scroll_x, scroll_y):
-        pass
+        scale = self.camera.scale * CAMERA_ZOOM_STEP ** -scroll_y
+        self.camera.scale = min(max(scale, CAMERA_MIN_SCALE), CAMERA_MAX_SCALE)
 
     def on_resize(self, width, height):
         glViewport(0, 0, width, height)
 
     def connect_to_server(self, addr, port):
         self.server_addr = (addr, port)
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.chan = networking.Channel(self.sock, self.server_addr)
-
-    def talk_to_server(self, dt):
-        if self.sock:
-            try:
-                # check if there's anything on the socket
-                readable, _, _ = select.select([self.sock], [], [], 0)
-                if readable:
-                    data, addr = self.sock.recvfrom(1024)
-                    if data:
-                        self.chan.on_data_received(data)
-                    else:
-                        # server disconnected
-                        LOG.info('Server disconnected')
-                        self.sock.close()
-                        self.sock = None
-                        return
-
-                # handle packets (echo)
-                packet = self.chan.recv_packet()
-                if packet:
-                    self.handle_packet(packet)
-
-                # check if the socket is writable
-                _, writable, _ = select.select([], [self.sock], [], 0)
-                if writable:
-                    if not self.chan.send_data():
-                        LOG.info('Server disconnected')
-                        self.sock.close()
-                        self.sock = None
-                        return
-
-            except socket.error:
-                LOG.exception('Socket error')
-                self.sock.close()
-                self.sock = None
+        self.connection = networking.ChannelThread(self.server_addr)
+        self.connection.start()
+
+    def poll_network(self):
+        # everything the network thread received since the last frame
+        if not self.connection:
+            return
+        if not self.connection.connected:
+            LOG.info('Lost connection to the server')
+            self.connection.close()
+            self.connection = None
+            return
+        now = time.perf_counter()
+        for recv_time, packet in self.connection.receive():
+            self.receive_latency.add(now - recv_time)
+            self.handle_packet(packet)
+
+    def tick(self, dt):
+        # the frame's work happens in on_draw
+        pass
 
     def send_hello(self, dt):
-        self.chan.send_packet('hello from %s' % socket.getfqdn())
+        if self.connection:
+            self.connection.send('hello from %s' % socket.getfqdn())
 
     def handle_packet(self, packet):
+        if not packet:
+            # keepalives and acks
+            return
+        if replication.read_snapshot(packet) is not None:
+            # entity updates, nothing draws them yet
+            return
         print('got', packet)
 
 
@@ -230,10 +281,13 @@ def main():
         vsync=False)
 
     pyglet_window.connect_to_server('127.0.0.1', 9009)
-    pyglet.clock.schedule_interval(
-        pyglet_window.talk_to_server, 1. / 60.)
+    # the event loop only redraws after a scheduled call or a window event,
+    # this keeps on_draw running every frame without any input
+    pyglet.clock.schedule_interval(pyglet_window.tick, 1. / 60.)
     pyglet.clock.schedule_interval(
         pyglet_window.send_hello, 1.)
+    pyglet.clock.schedule_interval(
+        pyglet_window.log_stats, STATS_LOG_INTERVAL)
 
     pyglet.app.run()
 
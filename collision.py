@@ -0,0 +1,131 @@
+# Copyright (c) 2014 Per Lindstrand
+
+import logging
+
+import numpy as np
+
+LOG = logging.getLogger(__name__)
+
+
+class CollisionConfig(object):
+
+    # longest move resolved in one go, well below half a tile so a circle
+    # can never get pushed out through the far side of a wall
+    MAX_STEP = .25
+    # distance kept to walls after a push so rounding can't put the circle
+    # back into the tile
+    SKIN = 1e-6
+
+
+def get_offsets(reach):
+    # tile offsets around the center tile, nearest first so edges are
+    # resolved before corners and units don't snag on wall seams
+    offsets = [(ox, oy)
+               for oy in range(-reach, reach + 1)
+               for ox in range(-reach, reach + 1)]
+    offsets.sort(key=lambda offset: offset[0] ** 2 + offset[1] ** 2)
+    return offsets
+
+
+def is_blocked(blocking, txs, tys):
+    # outside the map counts as blocked
+    height, width = blocking.shape
+    inside = (txs >= 0) & (txs < width) & (tys >= 0) & (tys < height)
+    blocked = ~inside
+    blocked[inside] = blocking[tys[inside], txs[inside]]
+    return blocked
+
+
+def push_out(blocking, xs, ys, radii, push_xs, push_ys):
+    # moves the circles out of all blocking tiles they overlap, in place,
+    # and adds the displacement to push_xs/push_ys
+    reach = max(1, int(np.ceil(radii.max())))
+    txs = np.floor(xs + .5).astype(np.intp)
+    tys = np.floor(ys + .5).astype(np.intp)
+    skin = CollisionConfig.SKIN
+    for ox, oy in get_offsets(reach):
+        bxs = txs + ox
+        bys = tys + oy
+        hits = np.flatnonzero(is_blocked(blocking, bxs, bys))
+        if not hits.size:
+            continue
+        bxs = bxs[hits]
+        bys = bys[hits]
+        x = xs[hits]
+        y = ys[hits]
+        r = radii[hits]
+        # closest point of the tile to the circle center
+        dx = x - np.clip(x, bxs - .5, bxs + .5)
+        dy = y - np.clip(y, bys - .5, bys + .5)
+        dist = np.sqrt(dx * dx + dy * dy)
+        overlap = np.flatnonzero(dist < r)
+        if not overlap.size:
+            continue
+        hits = hits[overlap]
+        bxs = bxs[overlap]
+        bys = bys[overlap]
+        x = x[overlap]
+        y = y[overlap]
+        r = r[overlap]
+        dx = dx[overlap]
+        dy = dy[overlap]
+        dist = dist[overlap]
+        outside = dist > 0.
+        new_x = np.empty_like(x)
+        new_y = np.empty_like(y)
+        scale = (r[outside] + skin) / dist[outside]
+        new_x[outside] = x[outside] - dx[outside] + dx[outside] * scale
+        new_y[outside] = y[outside] - dy[outside] + dy[outside] * scale
+        # the center is inside the tile, leave by the nearest edge
+        inside = ~outside
+        ux = x[inside] - bxs[inside]
+        uy = y[inside] - bys[inside]
+        along_x = np.abs(ux) >= np.abs(uy)
+        side_x = np.where(ux < 0., -1., 1.)
+        side_y = np.where(uy < 0., -1., 1.)
+        depth = .5 + r[inside] + skin
+        new_x[inside] = np.where(
+            along_x, bxs[inside] + side_x * depth, x[inside])
+        new_y[inside] = np.where(
+            along_x, y[inside], bys[inside] + side_y * depth)
+        push_xs[hits] += new_x - x
+        push_ys[hits] += new_y - y
+        xs[hits] = new_x
+        ys[hits] = new_y
+
+
+def resolve_movement(blocking, old_xs, old_ys, new_xs, new_ys, radii):
+    # moves circles from the old to the new positions in short steps,
+    # sliding along blocking tiles. returns the resolved positions, a mask
+    # of the circles that touched a wall and the summed push of each
+    count = len(old_xs)
+    xs = np.array(old_xs, dtype=np.float64)
+    ys = np.array(old_ys, dtype=np.float64)
+    radii = np.asarray(radii, dtype=np.float64)
+    push_xs = np.zeros(count)
+    push_ys = np.zeros(count)
+    if not count:
+        return xs, ys, np.zeros(count, dtype=bool), push_xs, push_ys
+    dxs = new_xs - xs
+    dys = new_ys - ys
+    steps = np.maximum(np.ceil(np.maximum(np.abs(dxs), np.abs(dys)) /
+                               CollisionConfig.MAX_STEP), 1.)
+    dxs /= steps
+    dys /= steps
+    for step in range(int(steps.max())):
+        if step:
+            active = np.flatnonzero(steps > step)
+        else:
+            active = np.arange(count)
+        step_xs = xs[active] + dxs[active]
+        step_ys = ys[active] + dys[active]
+        step_push_xs = np.zeros(len(active))
+        step_push_ys = np.zeros(len(active))
+        push_out(blocking, step_xs, step_ys, radii[active],
+                 step_push_xs, step_push_ys)
+        xs[active] = step_xs
+        ys[active] = step_ys
+        push_xs[active] += step_push_xs
+        push_ys[active] += step_push_ys
+    hit = (push_xs != 0.) | (push_ys != 0.)
+    return xs, ys, hit, push_xs, push_ys
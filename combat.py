@@ -0,0 +1,105 @@
+# Copyright (c) 2014 Per Lindstrand
+
+import logging
+import math
+
+import numpy as np
+
+import spatial
+
+LOG = logging.getLogger(__name__)
+
+
+class CombatConfig(object):
+
+    MAX_HEALTH = 100.
+    ATTACK_RANGE = 1.
+    # full width of the arc in front of the attacker
+    ATTACK_ARC = math.pi * .5
+    ATTACK_DAMAGE = 10.
+    ATTACK_COOLDOWN = .5
+    GRID_CELL_SIZE = 2.
+
+
+class CombatSystem(object):
+
+    # per entity state lives in arrays indexed by the index part of the
+    # entity id, so it survives the swap-removes of Simulation.entities
+
+    def __init__(self):
+        self.health = np.zeros(0)
+        self.ready_time = np.zeros(0)
+        self.grid = spatial.SpatialGrid(CombatConfig.GRID_CELL_SIZE)
+        # counters of the last resolve
+        self.swings = 0
+        self.hits = 0
+
+    def ensure_capacity(self, count):
+        capacity = self.health.size
+        if count <= capacity:
+            return
+        while capacity < count:
+            capacity = max(1024, capacity * 2)
+        for name in ('health', 'ready_time'):
+            array = getattr(self, name)
+            grown = np.zeros(capacity, dtype=array.dtype)
+            grown[:array.size] = array
+            setattr(self, name, grown)
+
+    def reset(self, indices):
+        indices = np.asarray(indices, dtype=np.intp)
+        if indices.size:
+            self.ensure_capacity(int(indices.max()) + 1)
+        self.health[indices] = CombatConfig.MAX_HEALTH
+        self.ready_time[indices] = 0.
+
+    def apply_damage(self, indices, damage):
+        # repeated indices accumulate
+        indices = np.asarray(indices, dtype=np.intp)
+        if indices.size:
+            np.subtract.at(self.health, indices, damage)
+
+    def resolve_melee(self, now, indices, xs, ys, radii, rotations, teams,
+                      attacking):
+        # every ready attacker hits the closest enemy in its arc, returns
+        # (attacker, target) positions into the given arrays
+        empty = np.zeros(0, dtype=np.intp)
+        self.swings = self.hits = 0
+        attackers = np.flatnonzero(
+            attacking & (self.ready_time[indices] <= now) &
+            (self.health[indices] > 0.))
+        if not attackers.size:
+            return empty, empty
+        self.swings = attackers.size
+        self.ready_time[indices[attackers]] = (
+            now + CombatConfig.ATTACK_COOLDOWN)
+
+        self.grid.build(xs, ys)
+        reach = CombatConfig.ATTACK_RANGE + radii.max()
+        qi, ti = self.grid.query_pairs(xs[attackers], ys[attackers], reach)
+        ai = attackers[qi]
+        keep = (teams[ti] != teams[ai]) & (self.health[indices[ti]] > 0.)
+        ai = ai[keep]
+        ti = ti[keep]
+        dx = xs[ti] - xs[ai]
+        dy = ys[ti] - ys[ai]
+        dist = np.sqrt(dx * dx + dy * dy)
+        in_range = dist - radii[ti] <= CombatConfig.ATTACK_RANGE
+        facing = (np.cos(rotations[ai]) * dx + np.sin(rotations[ai]) * dy)
+        in_arc = facing >= math.cos(CombatConfig.ATTACK_ARC * .5) * dist
+        keep = in_range & in_arc
+        ai = ai[keep]
+        ti = ti[keep]
+        dist = dist[keep]
+        # closest target per attacker, ties go to the earlier entity so the
+        # outcome only depends on the entity order
+        order = np.lexsort((ti, dist, ai))
+        ai = ai[order]
+        ti = ti[order]
+        first = np.ones(ai.size, dtype=bool)
+        first[1:] = ai[1:] != ai[:-1]
+        ai = ai[first]
+        ti = ti[first]
+        self.hits = ai.size
+        self.apply_damage(indices[ti], CombatConfig.ATTACK_DAMAGE)
+        return ai, ti
@@ -0,0 +1,165 @@
+# Copyright (c) 2014 Per Lindstrand
+
+import collections
+import heapq
+import logging
+import operator
+
+import numpy as np
+
+LOG = logging.getLogger(__name__)
+
+
+class GovernorConfig(object):
+
+    # seconds a frame should take
+    TARGET_FRAME_TIME = 1. / 60.
+    # frames in the rolling average, refilled after every change so a
+    # level is judged on its own frames
+    WINDOW = 30
+    # quality drops a level when the average is over the target times
+    # DROP_RATIO and rises a level when under it times RAISE_RATIO, the gap
+    # between the two keeps a level that is about right from flapping
+    DROP_RATIO = 1.1
+    RAISE_RATIO = .7
+    # frames a level is kept before it may rise again, doubled whenever a
+    # rise had to be taken back within that many frames, up to the max
+    RAISE_DELAY = 120
+    MAX_RAISE_DELAY = 3840
+    # best first. view_extent is the share of the camera's visible extent
+    # the terrain is drawn out to, entity distances are in world units,
+    # entities past full_detail_distance are drawn as plain cubes,
+    # max_entities of None draws every entity in range
+    LEVELS = (
+        {'view_extent': 1., 'entity_distance': 400.,
+         'full_detail_distance': 100., 'msaa': True, 'max_entities': None},
+        {'view_extent': .9, 'entity_distance': 200.,
+         'full_detail_distance': 60., 'msaa': True, 'max_entities': 20000},
+        {'view_extent': .8, 'entity_distance': 120.,
+         'full_detail_distance': 40., 'msaa': False, 'max_entities': 10000},
+        {'view_extent': .7, 'entity_distance': 80.,
+         'full_detail_distance': 20., 'msaa': False, 'max_entities': 5000},
+        {'view_extent': .6, 'entity_distance': 50.,
+         'full_detail_distance': 10., 'msaa': False, 'max_entities': 2000},
+    )
+
+
+def select_entities(ents, x, y, quality):
+    # (full detail, low detail) entities to draw around x, y, the nearest
+    # ones when there are more in range than the quality allows
+    max_dist_sq = quality['entity_distance'] ** 2
+    detail_dist_sq = quality['full_detail_distance'] ** 2
+    in_range = []
+    for ent in ents:
+        dx = ent.x - x
+        dy = ent.y - y
+        dist_sq = dx * dx + dy * dy
+        if dist_sq <= max_dist_sq:
+            in_range.append((dist_sq, ent))
+    cap = quality['max_entities']
+    if cap is not None and len(in_range) > cap:
+        in_range = heapq.nsmallest(cap, in_range, key=operator.itemgetter(0))
+    full = [ent for dist_sq, ent in in_range if dist_sq <= detail_dist_sq]
+    low = [ent for dist_sq, ent in in_range if dist_sq > detail_dist_sq]
+    return full, low
+
+
+def get_frame_traces(seed, frames):
+    # name -> load per frame, the frame time at the best quality in
+    # multiples of the target
+    rand = np.random.RandomState(seed)
+    t = np.arange(frames) / float(frames)
+    # a battle building up over the first half and breaking up again
+    battle = .6 + 2. * np.sin(np.pi * t) ** 2
+    # steady just over the drop ratio, one level down is enough and
+    # shouldn't flap back up
+    edge = 1.15 + rand.normal(0., .1, frames)
+    # light load with a few single frame spikes, e.g. loading hitches
+    spikes = np.full(frames, .5)
+    spikes[rand.randint(0, frames, frames // 100)] = 6.
+    return collections.OrderedDict(
+        [('battle', battle), ('edge', edge), ('spikes', spikes)])
+
+
+class FrameGovernor(object):
+
+    # steps the client's quality knobs down while the rolling frame time
+    # average is over the target and back up once there is room, one level
+    # at a time. nothing here knows about gl, the client applies
+    # get_quality() to its renderers
+
+    def __init__(self, target=GovernorConfig.TARGET_FRAME_TIME,
+                 window=GovernorConfig.WINDOW,
+                 levels=GovernorConfig.LEVELS):
+        self.target = target
+        self.levels = levels
+        self.samples = collections.deque(maxlen=window)
+        self.total = 0.
+        self.level = 0
+        self.raise_delay = GovernorConfig.RAISE_DELAY
+        # frames since the last change and whether it was a rise
+        self.frames_at_level = 0
+        self.raised = False
+        self.frames = 0
+        self.drops = 0
+        self.raises = 0
+        # (frame, old level, new level, average) of the last changes
+        self.decisions = collections.deque(maxlen=16)
+
+    def get_quality(self):
+        return self.levels[self.level]
+
+    def get_average(self):
+        if not self.samples:
+            return 0.
+        return self.total / len(self.samples)
+
+    def add_frame(self, frame_time):
+        # returns whether the level changed
+        self.frames += 1
+        self.frames_at_level += 1
+        if len(self.samples) == self.samples.maxlen:
+            self.total -= self.samples[0]
+        self.samples.append(frame_time)
+        self.total += frame_time
+        if len(self.samples) < self.samples.maxlen:
+            return False
+        average = self.total / len(self.samples)
+        if (average > self.target * GovernorConfig.DROP_RATIO and
+                self.level < len(self.levels) - 1):
+            if self.raised and self.frames_at_level <= self.raise_delay:
+                # the level it rose to doesn't hold, wait longer next time
+                self.raise_delay = min(self.raise_delay * 2,
+                                       GovernorConfig.MAX_RAISE_DELAY)
+            self.set_level(self.level + 1, average)
+            self.drops += 1
+            return True
+        if (average < self.target * GovernorConfig.RAISE_RATIO and
+                self.level > 0 and self.frames_at_level > self.raise_delay):
+            self.set_level(self.level - 1, average)
+            self.raises += 1
+            return True
+        return False
+
+    def set_level(self, level, average):
+        LOG.info('Frame time %.1f ms against %.1f ms, quality level %d -> %d',
+                 average * 1000., self.target * 1000., self.level, level)
+        self.decisions.append((self.frames, self.level, level, average))
+        self.raised = level < self.level
+        self.level = level
+        self.frames_at_level = 0
+        self.samples.clear()
+        self.total = 0.
+
+    def get_stats(self):
+        stats = {
+            'level': self.level,
+            'frame_time': self.get_average(),
+            'target': self.target,
+            'frames': self.frames,
+            'drops': self.drops,
+            'raises': self.raises,
+            'raise_delay': self.raise_delay,
+        }
+        stats.update(self.get_quality())
+        return stats
@@ -0,0 +1,171 @@
+# Copyright (c) 2014 Per Lindstrand
+
+import logging
+
+import numpy as np
+
+import world
+
+LOG = logging.getLogger(__name__)
+
+
+class HistoryConfig(object):
+
+    # ticks remembered, a bit over a second at 30 ticks per second
+    TICKS = 32
+    # stored as float32, plenty for maps of a few thousand tiles
+    DTYPE = np.float32
+
+
+class PositionHistory(object):
+
+    # positions and radii of the collidable entities of the last ticks in
+    # ring buffer arrays of [tick, entity index], so a hit test can look at
+    # the world the way a lagging client saw it. an id of 0 marks an entity
+    # that didn't exist or didn't collide at that tick
+
+    def __init__(self, ticks=HistoryConfig.TICKS, dtype=HistoryConfig.DTYPE):
+        self.ticks = ticks
+        self.dtype = dtype
+        self.times = np.zeros(ticks)
+        self.ids = np.zeros((ticks, 0), dtype=np.uint32)
+        self.xs = np.zeros((ticks, 0), dtype=dtype)
+        self.ys = np.zeros((ticks, 0), dtype=dtype)
+        self.radii = np.zeros((ticks, 0), dtype=dtype)
+        # row of the newest tick and how many rows are filled
+        self.head = -1
+        self.count = 0
+
+    def ensure_capacity(self, count):
+        capacity = self.ids.shape[1]
+        if count <= capacity:
+            return
+        while capacity < count:
+            capacity = max(1024, capacity * 2)
+        for name in ('ids', 'xs', 'ys', 'radii'):
+            array = getattr(self, name)
+            grown = np.zeros((self.ticks, capacity), dtype=array.dtype)
+            grown[:, :array.shape[1]] = array
+            setattr(self, name, grown)
+
+    def record(self, time, ids, xs, ys, radii):
+        # one tick of the collidable entities, overwrites the oldest
+        ids = np.asarray(ids, dtype=np.int64)
+        indices = (ids & world.EntityAllocator.INDEX_MASK).astype(np.intp)
+        if indices.size:
+            self.ensure_capacity(int(indices.max()) + 1)
+        row = (self.head + 1) % self.ticks
+        self.ids[row] = 0
+        self.ids[row, indices] = ids
+        self.xs[row, indices] = xs
+        self.ys[row, indices] = ys
+        self.radii[row, indices] = radii
+        self.times[row] = time
+        self.head = row
+        self.count = min(self.count + 1, self.ticks)
+
+    def get_span(self):
+        # (oldest, newest) time that can be rewound to
+        if not self.count:
+            return None
+        oldest = (self.head - self.count + 1) % self.ticks
+        return self.times[oldest], self.times[self.head]
+
+    def get_rows(self, time):
+        # the rows before and after the time and how far between them it
+        # is, times outside the history are clamped to it
+        rows = (np.arange(self.head - self.count + 1, self.head + 1) %
+                self.ticks)
+        times = self.times[rows]
+        after = int(np.searchsorted(times, time, side='right'))
+        if after == 0:
+            return rows[0], rows[0], 0.
+        if after == rows.size:
+            return rows[-1], rows[-1], 0.
+        before = after - 1
+        span = times[after] - times[before]
+        alpha = (time - times[before]) / span if span > 0. else 0.
+        return rows[before], rows[after], alpha
+
+    def sample(self, time, indices=slice(None)):
+        # (ids, xs, ys, radii) of the entity indices at the time, entities
+        # missing from one of the two ticks take the other one as is
+        row_a, row_b, alpha = self.get_rows(time)
+        ids_a = self.ids[row_a, indices]
+        ids_b = self.ids[row_b, indices]
+        xs_a = self.xs[row_a, indices]
+        ys_a = self.ys[row_a, indices]
+        radii_a = self.radii[row_a, indices]
+        if row_a == row_b or not alpha:
+            return ids_a, xs_a, ys_a, radii_a
+        xs_b = self.xs[row_b, indices]
+        ys_b = self.ys[row_b, indices]
+        radii_b = self.radii[row_b, indices]
+        # a respawned index has a new id, the newer entity wins
+        both = ids_a == ids_b
+        weight = np.where(both, alpha, (ids_b != 0).astype(self.dtype))
+        weight = weight.astype(self.dtype)
+        ids = np.where(ids_b != 0, ids_b, ids_a)
+        xs = xs_a + (xs_b - xs_a) * weight
+        ys = ys_a + (ys_b - ys_a) * weight
+        radii = radii_a + (radii_b - radii_a) * weight
+        return ids, xs, ys, radii
+
+    def get_positions(self, time, ids):
+        # (xs, ys, radii, found) of the ids at the time
+        ids = np.asarray(ids, dtype=np.int64)
+        indices = (ids & world.EntityAllocator.INDEX_MASK).astype(np.intp)
+        known = indices < self.ids.shape[1]
+        indices = np.where(known, indices, 0)
+        if not self.count:
+            empty = np.zeros(ids.size, dtype=self.dtype)
+            return empty, empty, empty, np.zeros(ids.size, dtype=bool)
+        found_ids, xs, ys, radii = self.sample(time, indices)
+        return xs, ys, radii, known & (found_ids == ids)
+
+    def check_hits(self, time, ids, xs, ys, radii):
+        # whether the circles touch the entities of the same position in
+        # ids where they were at the time, what Entity.is_colliding would
+        # have said back then
+        hit_xs, hit_ys, hit_radii, found = self.get_positions(time, ids)
+        dx = xs - hit_xs
+        dy = ys - hit_ys
+        dr = radii + hit_radii
+        return found & ((dx * dx + dy * dy) < (dr * dr))
+
+    def query_circle(self, time, x, y, radius):
+        # ids of every entity the circle touched at the time
+        if not self.count:
+            return np.zeros(0, dtype=np.int64)
+        # only entities whose x range between the two ticks gets close
+        # enough are interpolated
+        row_a, row_b, alpha = self.get_rows(time)
+        reach = radius + max(self.radii[row_a].max(), self.radii[row_b].max())
+        xs_a = self.xs[row_a]
+        xs_b = self.xs[row_b]
+        near = np.flatnonzero(
+            (np.minimum(xs_a, xs_b) < x + reach) &
+            (np.maximum(xs_a, xs_b) > x - reach))
+        ids, xs, ys, radii = self.sample(time, near)
+        dx = xs - x
+        dy = ys - y
+        dr = radii + radius
+        hit = (ids != 0) & ((dx * dx + dy * dy) < (dr * dr))
+        return ids[hit].astype(np.int64)
+
+    def get_stats(self):
+        # memory per entity per second of history follows from the tick
+        # spacing seen so far
+        row_bytes = (self.ids.itemsize + self.xs.itemsize +
+                     self.ys.itemsize + self.radii.itemsize)
+        span = self.get_span()
+        seconds = float(span[1] - span[0]) if span else 0.
+        ticks_per_second = (self.count - 1) / seconds if seconds else 0.
+        return {
+            'ticks': self.count,
+            'seconds': seconds,
+            'capacity': self.ids.shape[1],
+            'bytes': (self.ids.nbytes + self.xs.nbytes + self.ys.nbytes +
+                      self.radii.nbytes + self.times.nbytes),
+            'bytes_per_entity_second': row_bytes * ticks_per_second,
+        }
@@ -0,0 +1,105 @@
+# Copyright (c) 2014 Per Lindstrand
+
+# runs many bot filled matches through the supervisor as fast as they can
+# tick, once per worker count, and reports the total throughput:
+# python loadtest.py --workers 1,2,4 --matches 16
+
+import argparse
+import logging
+import math
+import multiprocessing
+import os
+import socket
+import time
+
+import supervisor
+
+LOG = logging.getLogger(__name__)
+
+
+def get_default_workers():
+    if hasattr(os, 'sched_getaffinity'):
+        cores = len(os.sched_getaffinity(0))
+    else:
+        cores = multiprocessing.cpu_count()
+    counts = [1]
+    while counts[-1] * 2 <= cores:
+        counts.append(counts[-1] * 2)
+    if counts[-1] != cores:
+        counts.append(cores)
+    return counts
+
+
+def run_load_test(workers, matches, bots, enemies, duration):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    ended = {}
+    host = supervisor.Supervisor(
+        sock, workers, int(math.ceil(matches / float(workers))),
+        on_match_ended=lambda match_id, load: ended.__setitem__(
+            match_id, load))
+    try:
+        for i in range(matches):
+            # tick rate 0 runs the matches flat out
+            host.start_match(seed=i, tick_rate=0, bots=bots,
+                             enemies=enemies, duration=duration)
+        deadline = time.time() + duration + 30.
+        while len(ended) < matches and time.time() < deadline:
+            host.poll(.1)
+            host.check_workers()
+    finally:
+        host.close()
+        sock.close()
+    loads = [load for load in ended.values() if load]
+    ticks = sum(load['ticks'] for load in loads)
+    entities = sum(load['ticks'] * load['entities'] for load in loads)
+    rates = sorted(load['ticks'] / load['uptime'] for load in loads)
+    return {
+        'workers': workers,
+        'matches': len(loads),
+        'ticks_per_sec': ticks / duration,
+        'entity_updates_per_sec': entities / duration,
+        'match_ticks_per_sec_min': rates[0] if rates else 0.,
+        'match_ticks_per_sec_max': rates[-1] if rates else 0.,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Multi-match load test')
+    parser.add_argument('--workers',
+                        help='comma separated worker counts to compare, '
+                             'powers of two up to the core count by default')
+    parser.add_argument('--matches', type=int, default=16)
+    parser.add_argument('--bots', type=int, default=4,
+                        help='bot players per match')
+    parser.add_argument('--enemies', type=int, default=200,
+                        help='ai enemies per match')
+    parser.add_argument('--duration', type=float, default=5.,
+                        help='seconds every match runs')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    if args.workers:
+        worker_counts = [int(count) for count in args.workers.split(',')]
+    else:
+        worker_counts = get_default_workers()
+
+    base = None
+    print('%8s %8s %12s %16s %8s %20s' % (
+        'workers', 'matches', 'ticks/s', 'entity upd/s', 'speedup',
+        'match ticks/s'))
+    for workers in worker_counts:
+        result = run_load_test(workers, args.matches, args.bots,
+                               args.enemies, args.duration)
+        if base is None:
+            base = result['ticks_per_sec']
+        print('%8d %8d %12.1f %16.0f %7.2fx %9.1f - %8.1f' % (
+            workers, result['matches'], result['ticks_per_sec'],
+            result['entity_updates_per_sec'],
+            result['ticks_per_sec'] / base if base else 0.,
+            result['match_ticks_per_sec_min'],
+            result['match_ticks_per_sec_max']))
+
+if __name__ == '__main__':
+    main()
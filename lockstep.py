@@ -0,0 +1,449 @@
+# Copyright (c) 2014 Per Lindstrand
+
+# lockstep mode: peers only exchange their input per tick and all run the
+# same simulation, in fixed point so every machine computes the same bits.
+# python lockstep.py --entities 10000 prints the checksum of a scripted
+# match, runs on different machines or processes have to print the same
+
+import argparse
+import collections
+import logging
+import math
+import random
+import struct
+import sys
+import zlib
+
+import numpy as np
+
+import world
+
+LOG = logging.getLogger(__name__)
+
+# values are integers in units of 1 / ONE
+FIXED_SHIFT = 16
+ONE = 1 << FIXED_SHIFT
+# angles are integers in units of a full turn / ANGLE_STEPS
+ANGLE_BITS = 12
+ANGLE_STEPS = 1 << ANGLE_BITS
+ANGLE_MASK = ANGLE_STEPS - 1
+QUARTER_TURN = ANGLE_STEPS // 4
+
+
+def to_fixed(value):
+    return int(round(value * ONE))
+
+
+def from_fixed(value):
+    return value / float(ONE)
+
+
+def mul(a, b):
+    # python ints floor on the shift, the same on every machine
+    return (a * b) >> FIXED_SHIFT
+
+
+def angle_from_radians(rotation):
+    # only done where the input is made, the angle is what gets sent
+    return int(round(rotation * ANGLE_STEPS / (2. * math.pi))) & ANGLE_MASK
+
+
+def angle_to_radians(angle):
+    return angle * 2. * math.pi / ANGLE_STEPS
+
+
+# rounded to 16 bits the tables come out the same from any libm
+SIN_TABLE = [to_fixed(math.sin(i * 2. * math.pi / ANGLE_STEPS))
+             for i in range(ANGLE_STEPS)]
+COS_TABLE = [SIN_TABLE[(i + QUARTER_TURN) & ANGLE_MASK]
+             for i in range(ANGLE_STEPS)]
+
+
+class LockstepConfig(object):
+
+    TICK_RATE = 30
+    # ticks between an input being made and being simulated, hides the
+    # latency up to about this many ticks
+    INPUT_DELAY = 3
+    # ticks between state checksums
+    HASH_INTERVAL = 30
+    # own checksums kept for comparing late ones of the peers
+    HASH_HISTORY = 16
+    # inputs a packet repeats at most, for peers that missed some
+    MAX_PACKET_INPUTS = 32
+    PLAYER_MOVE_SPEED = to_fixed(world.SimulationConfig.PLAYER_MOVE_SPEED)
+    ENTITY_FRICTION = to_fixed(world.SimulationConfig.ENTITY_FRICTION)
+    VERY_SLOW_SPEED = to_fixed(world.SimulationConfig.VERY_SLOW_SPEED)
+    VERY_FAST_SPEED = to_fixed(world.SimulationConfig.VERY_FAST_SPEED)
+
+
+class FixedEntity(object):
+
+    __slots__ = (
+        'id', 'x', 'y', 'acc_x', 'acc_y', 'vel_x', 'vel_y', 'radius',
+        'rotation', 'flags', 'team')
+
+    def __init__(self):
+        self.id = 0
+        self.x = 0
+        self.y = 0
+        self.acc_x = 0
+        self.acc_y = 0
+        self.vel_x = 0
+        self.vel_y = 0
+        self.radius = ONE // 2
+        self.rotation = 0
+        self.flags = 0
+        self.team = 0
+
+    def update(self, dt):
+        # world.Entity.update in fixed point
+        if (self.flags & world.EntityFlags.NO_MOVE) == 0:
+            self.vel_x += mul(self.acc_x, dt)
+            self.vel_y += mul(self.acc_y, dt)
+            self.x += mul(self.vel_x, dt)
+            self.y += mul(self.vel_y, dt)
+
+        friction = mul(LockstepConfig.ENTITY_FRICTION, dt)
+        self.vel_x = mul(self.vel_x, friction)
+        self.vel_y = mul(self.vel_y, friction)
+
+        very_slow = LockstepConfig.VERY_SLOW_SPEED
+        very_fast = LockstepConfig.VERY_FAST_SPEED
+        if self.vel_x < very_slow:
+            self.vel_x = 0
+        elif self.vel_x > very_fast:
+            self.vel_x = very_fast
+        if self.vel_y < very_slow:
+            self.vel_y = 0
+        elif self.vel_y > very_fast:
+            self.vel_y = very_fast
+
+
+class FixedPlayer(object):
+
+    def __init__(self, entity):
+        self.entity = entity
+        self.action_flags = 0
+
+    def set_input(self, action_flags, angle):
+        self.action_flags = action_flags
+        self.entity.rotation = angle & ANGLE_MASK
+
+    def update(self, dt):
+        # world.Player.update in fixed point, with the trigonometry from
+        # the tables
+        flags = self.action_flags
+        ent = self.entity
+        move_speed = LockstepConfig.PLAYER_MOVE_SPEED
+        vel_x = 0
+        vel_y = 0
+        if (flags & world.PlayerActionFlags.MOVE_NORTH) != 0:
+            vel_x -= move_speed
+            vel_y -= move_speed
+        if (flags & world.PlayerActionFlags.MOVE_SOUTH) != 0:
+            vel_x += move_speed
+            vel_y += move_speed
+        if (flags & world.PlayerActionFlags.MOVE_WEST) != 0:
+            vel_x -= move_speed
+            vel_y += move_speed
+        if (flags & world.PlayerActionFlags.MOVE_EAST) != 0:
+            vel_x += move_speed
+            vel_y -= move_speed
+        forward_x = mul(COS_TABLE[ent.rotation], move_speed)
+        forward_y = mul(SIN_TABLE[ent.rotation], move_speed)
+        side = (ent.rotation + QUARTER_TURN) & ANGLE_MASK
+        side_x = mul(COS_TABLE[side], move_speed)
+        side_y = mul(SIN_TABLE[side], move_speed)
+        if (flags & world.PlayerActionFlags.MOVE_FORWARD) != 0:
+            vel_x += forward_x
+            vel_y += forward_y
+        if (flags & world.PlayerActionFlags.MOVE_BACK) != 0:
+            vel_x -= forward_x
+            vel_y -= forward_y
+        if (flags & world.PlayerActionFlags.MOVE_LEFT) != 0:
+            vel_x -= side_x
+            vel_y -= side_y
+        if (flags & world.PlayerActionFlags.MOVE_RIGHT) != 0:
+            vel_x += side_x
+            vel_y += side_y
+        speed = math.isqrt(vel_x * vel_x + vel_y * vel_y)
+        if speed:
+            ent.vel_x = vel_x * move_speed // speed
+            ent.vel_y = vel_y * move_speed // speed
+        else:
+            ent.vel_x = 0
+            ent.vel_y = 0
+        if (flags & world.PlayerActionFlags.ATTACK) != 0:
+            ent.flags |= world.EntityFlags.ATTACKING
+        else:
+            ent.flags &= ~world.EntityFlags.ATTACKING
+
+
+class FixedSimulation(object):
+
+    # the movement of world.Simulation in fixed point, players and entities
+    # in spawn order so every peer updates them the same way
+
+    def __init__(self, tick_rate=LockstepConfig.TICK_RATE):
+        self.allocator = world.EntityAllocator()
+        self.entities = []
+        self.players = []
+        self.dt = ONE // tick_rate
+        self.tick = 0
+
+    def spawn_entity(self, x, y, radius=ONE // 2, rotation=0, flags=0,
+                     team=0):
+        # fixed point position and radius, rotation as an angle
+        ent = FixedEntity()
+        ent.id = self.allocator.allocate()
+        ent.x = x
+        ent.y = y
+        ent.radius = radius
+        ent.rotation = rotation & ANGLE_MASK
+        ent.flags = flags
+        ent.team = team
+        self.allocator.slots[ent.id & world.EntityAllocator.INDEX_MASK] = (
+            len(self.entities))
+        self.entities.append(ent)
+        return ent
+
+    def add_player(self, player):
+        self.players.append(player)
+
+    def update(self):
+        dt = self.dt
+        for player in self.players:
+            player.update(dt)
+        for ent in self.entities:
+            ent.update(dt)
+        self.tick += 1
+
+    def compute_checksum(self):
+        ents = self.entities
+        checksum = 0
+        for field in world.CHECKSUM_FIELDS:
+            array = np.fromiter(
+                (getattr(ent, field) for ent in ents), np.int64, len(ents))
+            checksum = zlib.crc32(array.tobytes(), checksum)
+        return checksum
+
+
+# peer, the tick the peer needs next, first tick and count of the inputs
+# that follow, the tick and value of the newest checksum of the peer
+PACKET_HEADER = struct.Struct('!HIIBII')
+PACKET_INPUT = struct.Struct('!HH')
+NO_HASH = 0xffffffff
+
+
+class LockstepPeer(object):
+
+    # runs a FixedSimulation a tick at a time once every peer's input for
+    # that tick is in. the own input is scheduled INPUT_DELAY ticks ahead,
+    # so it usually reached the others before they need it. packets repeat
+    # the inputs the slowest peer hasn't confirmed, their size depends on
+    # the latency but never on the number of entities
+
+    def __init__(self, peer_id, peers, sim,
+                 input_delay=LockstepConfig.INPUT_DELAY,
+                 hash_interval=LockstepConfig.HASH_INTERVAL):
+        self.peer_id = peer_id
+        self.peers = peers
+        self.sim = sim
+        self.input_delay = input_delay
+        self.hash_interval = hash_interval
+        # tick -> {peer: (action flags, angle)}, the first ticks run on no
+        # input
+        self.inputs = collections.defaultdict(dict)
+        for tick in range(input_delay):
+            for peer in range(peers):
+                self.inputs[tick][peer] = (0, 0)
+        self.next_input_tick = input_delay
+        self.input = (0, 0)
+        # tick -> own input, until every peer has it
+        self.sent = collections.OrderedDict()
+        # next tick every peer needs, as they last told
+        self.peer_ticks = [0] * peers
+        # tick -> {peer: checksum}
+        self.hashes = {}
+        self.last_hash = (NO_HASH, 0)
+        self.desync_tick = None
+        self.stalls = 0
+
+    def set_input(self, action_flags, angle):
+        # the input going into the next scheduled tick
+        self.input = (action_flags, angle & ANGLE_MASK)
+
+    def schedule_input(self):
+        while self.next_input_tick < self.sim.tick + self.input_delay + 1:
+            self.inputs[self.next_input_tick][self.peer_id] = self.input
+            self.sent[self.next_input_tick] = self.input
+            self.next_input_tick += 1
+
+    def get_packet(self):
+        others = [tick for peer, tick in enumerate(self.peer_ticks)
+                  if peer != self.peer_id]
+        sent = self.sent
+        if others:
+            # what every peer already simulated is never needed again
+            while sent and next(iter(sent)) < min(others):
+                sent.popitem(last=False)
+        first = max(next(iter(sent)) if sent else self.next_input_tick,
+                    self.next_input_tick - LockstepConfig.MAX_PACKET_INPUTS)
+        last = self.next_input_tick
+        hash_tick, checksum = self.last_hash
+        return PACKET_HEADER.pack(
+            self.peer_id, self.sim.tick, first, last - first, hash_tick,
+            checksum) + b''.join(
+                PACKET_INPUT.pack(*sent[tick]) for tick in range(first, last))
+
+    def on_packet(self, data):
+        peer, need_tick, first, count, hash_tick, checksum = (
+            PACKET_HEADER.unpack_from(data))
+        if peer >= self.peers or peer == self.peer_id:
+            LOG.warning('Lockstep packet from bad peer %d', peer)
+            return
+        self.peer_ticks[peer] = max(self.peer_ticks[peer], need_tick)
+        offset = PACKET_HEADER.size
+        inputs = self.inputs
+        for tick in range(first, first + count):
+            if tick >= self.sim.tick:
+                inputs[tick][peer] = PACKET_INPUT.unpack_from(data, offset)
+            offset += PACKET_INPUT.size
+        if hash_tick != NO_HASH:
+            self.on_hash(hash_tick, peer, checksum)
+
+    def on_hash(self, tick, peer, checksum):
+        hashes = self.hashes.get(tick)
+        if hashes is None:
+            if tick < self.sim.tick:
+                # too old to compare
+                return
+            hashes = self.hashes[tick] = {}
+        hashes[peer] = checksum
+        own = hashes.get(self.peer_id)
+        if own is None or self.desync_tick is not None:
+            return
+        for other, checksum in sorted(hashes.items()):
+            if checksum != own:
+                self.desync_tick = tick
+                LOG.error('Desync at tick %d: peer %d has %08x, we have '
+                          '%08x', tick, other, checksum, own)
+                return
+
+    def advance(self):
+        # simulates the next tick if all its input is in
+        tick = self.sim.tick
+        inputs = self.inputs.get(tick)
+        if inputs is None or len(inputs) < self.peers:
+            self.stalls += 1
+            return False
+        for peer, player in enumerate(self.sim.players):
+            player.set_input(*inputs[peer])
+        del self.inputs[tick]
+        self.sim.update()
+        if self.sim.tick % self.hash_interval == 0:
+            checksum = self.sim.compute_checksum()
+            self.last_hash = (self.sim.tick, checksum)
+            self.on_hash(self.sim.tick, self.peer_id, checksum)
+            while len(self.hashes) > LockstepConfig.HASH_HISTORY:
+                del self.hashes[min(self.hashes)]
+        return True
+
+
+def create_simulation(peers, entities, seed):
+    # the same start on every peer: a player per peer and drifting entities
+    rand = random.Random(seed)
+    sim = FixedSimulation()
+    for peer in range(peers):
+        ent = sim.spawn_entity(to_fixed(peer * 4.), 0, team=peer + 1)
+        sim.add_player(FixedPlayer(ent))
+    for i in range(entities):
+        ent = sim.spawn_entity(rand.randrange(256 * ONE),
+                               rand.randrange(256 * ONE))
+        ent.acc_x = rand.randrange(-4 * ONE, 4 * ONE)
+        ent.acc_y = rand.randrange(-4 * ONE, 4 * ONE)
+    return sim
+
+
+class LockstepMatch(object):
+
+    # peers in one process talking over a simulated network that delays
+    # every packet by latency ticks and drops some, each peer with a bot
+    # making its input
+
+    def __init__(self, peers, entities, seed, latency=2, loss=0.):
+        self.rand = random.Random(seed)
+        self.bot_rands = [random.Random(seed * 1000 + peer)
+                          for peer in range(peers)]
+        self.peers = [LockstepPeer(peer, peers,
+                                   create_simulation(peers, entities, seed))
+                      for peer in range(peers)]
+        self.latency = latency
+        self.loss = loss
+        self.frame = 0
+        # (arrival frame, peer, packet)
+        self.in_flight = collections.deque()
+        self.packets = 0
+        self.bytes = 0
+        self.lost = 0
+
+    def step(self, until=None):
+        # one frame of every peer, returns how many of them advanced. peers
+        # at tick until stop there
+        self.frame += 1
+        for peer in self.peers:
+            rand = self.bot_rands[peer.peer_id]
+            if rand.random() < .1:
+                peer.set_input(rand.getrandbits(10) & ~1,
+                               rand.randrange(ANGLE_STEPS))
+            peer.schedule_input()
+            packet = peer.get_packet()
+            for other in self.peers:
+                if other is peer:
+                    continue
+                self.packets += 1
+                self.bytes += len(packet)
+                if self.rand.random() < self.loss:
+                    self.lost += 1
+                    continue
+                self.in_flight.append(
+                    (self.frame + self.latency, other, packet))
+        while self.in_flight and self.in_flight[0][0] <= self.frame:
+            arrival, peer, packet = self.in_flight.popleft()
+            peer.on_packet(packet)
+        return sum(peer.advance() for peer in self.peers
+                   if until is None or peer.sim.tick < until)
+
+    def get_checksums(self):
+        return [peer.sim.compute_checksum() for peer in self.peers]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Scripted lockstep match')
+    parser.add_argument('--peers', type=int, default=4)
+    parser.add_argument('--entities', type=int, default=1000)
+    parser.add_argument('--ticks', type=int, default=300)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--latency', type=int, default=2,
+                        help='packet latency in ticks')
+    parser.add_argument('--loss', type=float, default=.05)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    match = LockstepMatch(args.peers, args.entities, args.seed,
+                          args.latency, args.loss)
+    while min(peer.sim.tick for peer in match.peers) < args.ticks:
+        match.step(args.ticks)
+    checksums = match.get_checksums()
+    desyncs = sum(peer.desync_tick is not None for peer in match.peers)
+    LOG.info('%d ticks in %d frames, %d desyncs, %.1f bytes per packet, '
+             '%d of %d packets lost', args.ticks, match.frame, desyncs,
+             match.bytes / float(max(match.packets, 1)), match.lost,
+             match.packets)
+    print('%08x' % checksums[0])
+    if desyncs or len(set(checksums)) > 1:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
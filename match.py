@@ -0,0 +1,300 @@
+# Copyright (c) 2014 Per Lindstrand
+
+import logging
+import math
+import random
+import time
+
+import networking
+import profiler
+import replay
+import replication
+import timers
+import world
+
+LOG = logging.getLogger(__name__)
+
+TICK_RATE = 30.
+
+
+class MatchConfig(object):
+
+    # side of the square bots are spawned in
+    BOT_AREA = 64.
+    # chance per tick that a bot player picks new input
+    BOT_INPUT_CHANCE = .05
+    # clients not heard from for this long are dropped
+    CLIENT_TIMEOUT = 10.
+    # clients nothing was sent to for this long get an empty packet, so
+    # they keep getting acks and know the server is alive
+    KEEPALIVE_INTERVAL = 1.
+    # seconds before a client whose unit died gets a new one
+    RESPAWN_DELAY = 3.
+
+
+class Match(object):
+
+    # one match: the simulation, its clients and the fixed rate tick. the
+    # owner feeds it datagrams and calls update(), clients are keyed by
+    # whatever the owner's socket sends to, an address or a session id
+
+    def __init__(self, sock, seed=None, tick_rate=TICK_RATE, recorder=None,
+                 prof=profiler.NULL_PROFILER):
+        if seed is None:
+            seed = random.randrange(1 << 32)
+        self.seed = seed
+        self.rand = random.Random(seed)
+        self.sock = sock
+        self.sim = world.Simulation()
+        self.sim.profiler = prof
+        self.prof = prof
+        self.recorder = recorder
+        self.clients = {}
+        self.players = {}
+        # client key -> {'timeout': Timer, 'keepalive': Timer, ...}
+        self.client_timers = {}
+        # client key -> replication.ClientReplication
+        self.replication = {}
+        self.bots = []
+        self.dt = 1. / TICK_RATE
+        # a tick rate of 0 ticks as often as update() is called
+        self.tick_time = 1. / tick_rate if tick_rate else 0.
+        self.next_tick = None
+        self.start_time = time.time()
+        self.timers = timers.TimerWheel(self.start_time)
+        self.ticks = 0
+        self.overruns = 0
+        self.simulate_time = 0.
+        # since the last get_load()
+        self.load_time = self.start_time
+        self.load_ticks = 0
+        self.load_simulate_time = 0.
+
+    def add_client(self, key, session=0):
+        chn = networking.Channel(self.sock, key, session)
+        self.clients[key] = chn
+        self.replication[key] = replication.ClientReplication(chn)
+        self.spawn_player(key)
+        self.client_timers[key] = {
+            'timeout': self.timers.schedule(
+                MatchConfig.CLIENT_TIMEOUT, self.on_client_timeout, key),
+            'keepalive': self.timers.schedule(
+                MatchConfig.KEEPALIVE_INTERVAL, self.on_keepalive, key),
+        }
+        return chn
+
+    def remove_client(self, key):
+        del self.clients[key]
+        del self.replication[key]
+        for timer in self.client_timers.pop(key).values():
+            self.timers.cancel(timer)
+        player = self.players.pop(key)
+        self.sim.despawn_entity(player.entity.id)
+        if self.recorder:
+            self.recorder.record_despawn(player.entity.id)
+
+    def spawn_player(self, key):
+        ent = self.sim.spawn_entity(0., 0.)
+        self.players[key] = world.Player(ent)
+        self.sim.add_player(self.players[key])
+        if self.recorder:
+            self.recorder.record_spawn(ent, replay.SpawnKind.PLAYER)
+
+    def on_client_timeout(self, key):
+        LOG.info('Client %r timed out', key)
+        self.remove_client(key)
+
+    def on_keepalive(self, key):
+        # rescheduled by send() whenever something goes out
+        self.clients[key].send_packet('', 'keepalive')
+
+    def on_respawn(self, key):
+        del self.client_timers[key]['respawn']
+        self.spawn_player(key)
+
+    def schedule_respawns(self):
+        dead = set()
+        for kind, ids in self.sim.events:
+            if kind == world.SimulationEvents.DEATH:
+                dead.update(ids)
+        for key, player in self.players.items():
+            if player.entity.id in dead:
+                self.client_timers[key]['respawn'] = self.timers.schedule(
+                    MatchConfig.RESPAWN_DELAY, self.on_respawn, key)
+
+    def add_bots(self, players, enemies):
+        # randomly driven players and the enemies hunting them
+        rand = self.rand
+        area = MatchConfig.BOT_AREA
+        for i in range(players):
+            ent = self.sim.spawn_entity(
+                rand.random() * area, rand.random() * area)
+            player = world.Player(ent)
+            self.sim.add_player(player)
+            self.bots.append(player)
+            if self.recorder:
+                self.recorder.record_spawn(ent, replay.SpawnKind.PLAYER)
+        for i in range(enemies):
+            enemy = self.sim.spawn_enemy(
+                rand.random() * area, rand.random() * area, team=1)
+            if self.recorder:
+                self.recorder.record_spawn(
+                    enemy.entity, replay.SpawnKind.ENEMY)
+
+    def drive_bots(self):
+        rand = self.rand
+        for player in self.bots:
+            if rand.random() < MatchConfig.BOT_INPUT_CHANCE:
+                player.action_flags = rand.getrandbits(10) & ~1
+            player.set_rotation(rand.uniform(-math.pi, math.pi))
+
+    def on_datagram(self, key, data, session=0):
+        prof = self.prof
+        prof.count('server.packets_in')
+        prof.count('server.bytes_in', len(data))
+        if not data:
+            # client disconnected
+            if key in self.clients:
+                self.remove_client(key)
+            return
+        chn = self.clients.get(key)
+        if not chn:
+            chn = self.add_client(key, session)
+        else:
+            self.timers.reschedule(self.client_timers[key]['timeout'],
+                                   MatchConfig.CLIENT_TIMEOUT)
+        chn.on_data_received(data)
+
+    def handle_packets(self):
+        start = self.prof.start()
+        for key, chn in self.clients.items():
+            packet = chn.recv_packet()
+            if packet:
+                LOG.debug('Client %r sent %r', key, packet)
+                chn.send_packet(packet)
+                # parse!
+        self.prof.stop('server.handle_ns', start)
+
+    def get_timeout(self, now):
+        # seconds until the next tick or timer is due
+        if self.next_tick is None:
+            return 0.
+        return self.timers.get_timeout(now, max(self.next_tick - now, 0.))
+
+    def tick(self, now):
+        # runs the ticks that are due at a fixed rate, returns how many
+        if self.next_tick is None:
+            self.next_tick = now
+        if not self.tick_time:
+            self.step()
+            return 1
+        if now - self.next_tick > self.tick_time:
+            self.prof.count('server.tick_overruns')
+            self.overruns += 1
+        ticks = 0
+        while now >= self.next_tick:
+            self.step()
+            self.next_tick += self.tick_time
+            ticks += 1
+        return ticks
+
+    def step(self):
+        prof = self.prof
+        recorder = self.recorder
+        start = time.perf_counter()
+        self.drive_bots()
+        if recorder:
+            recorder.record_tick(self.dt, self.sim.players)
+        self.sim.update(self.dt)
+        if recorder:
+            recorder.record_update(self.sim)
+        if self.sim.events:
+            self.schedule_respawns()
+        if self.clients:
+            self.replicate()
+        elapsed = time.perf_counter() - start
+        self.ticks += 1
+        self.simulate_time += elapsed
+        if prof.enabled:
+            prof.count('server.simulate_ns', int(elapsed * 1e9))
+            prof.gauge('server.clients', len(self.clients))
+            prof.gauge('server.outbox', sum(
+                len(chn.outbox) for chn in self.clients.values()))
+            prof.end_tick()
+
+    def replicate(self):
+        # queues the entity updates that fit the budget of every client,
+        # sent by the next send()
+        prof = self.prof
+        start = prof.start()
+        now = time.monotonic()
+        arrays = self.sim.get_entity_arrays(replication.REPLICATION_FIELDS)
+        sent = 0
+        for key, state in self.replication.items():
+            player = self.players.get(key)
+            ent = player.entity if player else None
+            state.update(now, self.dt, self.ticks, arrays, ent)
+            sent += state.sent
+        prof.count('server.replicated', sent)
+        prof.stop('server.replicate_ns', start)
+
+    def send(self):
+        # sends everything the channels queued, returns the keys of the
+        # clients dropped
+        prof = self.prof
+        start = prof.start()
+        removed = []
+        for key, chn in self.clients.items():
+            outbox = len(chn.outbox)
+            if not outbox:
+                continue
+            if not chn.flush():
+                removed.append(key)
+            self.timers.reschedule(self.client_timers[key]['keepalive'],
+                                   MatchConfig.KEEPALIVE_INTERVAL)
+            prof.count('server.packets_out', outbox - len(chn.outbox))
+        for key in removed:
+            LOG.info('Client %r disconnected', key)
+            self.remove_client(key)
+        prof.stop('server.send_ns', start)
+        return removed
+
+    def update(self, now):
+        self.handle_packets()
+        self.timers.advance(now)
+        self.tick(now)
+        return self.send()
+
+    def get_network_stats(self):
+        return {
+            'network': networking.aggregate_stats(self.clients.values()),
+            'clients': dict((str(key), dict(
+                chn.get_stats(),
+                replication_rate=self.replication[key].controller.rate))
+                for key, chn in self.clients.items()),
+        }
+
+    def get_load(self, now):
+        # tick rate and the share of wall time spent simulating since the
+        # last call
+        elapsed = max(now - self.load_time, 1e-9)
+        ticks = self.ticks - self.load_ticks
+        simulate_time = self.simulate_time - self.load_simulate_time
+        self.load_time = now
+        self.load_ticks = self.ticks
+        self.load_simulate_time = self.simulate_time
+        return {
+            'clients': len(self.clients),
+            'entities': len(self.sim.entities),
+            'ticks': self.ticks,
+            'tick_rate': ticks / elapsed,
+            'tick_ms': simulate_time * 1000. / ticks if ticks else 0.,
+            'busy': simulate_time / elapsed,
+            'overruns': self.overruns,
+            'timers': len(self.timers),
+            'uptime': now - self.start_time,
+        }
+
+    def close(self):
+        if self.recorder:
+            self.recorder.close()
@@ -0,0 +1,62 @@
+# Copyright (c) 2014 Per Lindstrand
+
+import array
+import ctypes
+import logging
+import os
+import struct
+import sys
+
+LOG = logging.getLogger(__name__)
+
+# a mesh file is a little endian header followed by the vertices, already
+# interleaved as xyz, uv, normal float32s in the layout InterleavedStaticVBO
+# binds, so loading is one read into the upload buffer
+MAGIC = b'BBMS'
+VERSION = 1
+HEADER = struct.Struct('<4sHHI')
+FLOATS_PER_VERTEX = 3 + 2 + 3
+VERTEX_SIZE = FLOATS_PER_VERTEX * 4
+
+
+class Mesh(object):
+
+    def __init__(self, vertex_count, data):
+        self.vertex_count = vertex_count
+        # ctypes float array, ready to hand to the vertex buffer
+        self.data = data
+
+    def get_size(self):
+        return ctypes.sizeof(self.data)
+
+
+def read_mesh(fname):
+    with open(fname, 'rb') as file:
+        magic, version, floats, vertex_count = HEADER.unpack(
+            file.read(HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise RuntimeError('%s: not a mesh file' % fname)
+        if floats != FLOATS_PER_VERTEX:
+            raise RuntimeError('%s: unsupported vertex layout' % fname)
+        data = (ctypes.c_float * (vertex_count * floats))()
+        size = file.readinto(data)
+        if size != ctypes.sizeof(data):
+            raise RuntimeError('%s: truncated mesh file' % fname)
+    if sys.byteorder != 'little':
+        swapped = array.array('f', bytes(data))
+        swapped.byteswap()
+        ctypes.memmove(data, swapped.tobytes(), ctypes.sizeof(data))
+    return Mesh(vertex_count, data)
+
+
+def write_mesh(fname, vertex_count, data):
+    # data is the interleaved vertices as little endian float32 bytes
+    if len(data) != vertex_count * VERTEX_SIZE:
+        raise ValueError('expected %d bytes of vertex data, got %d' % (
+            vertex_count * VERTEX_SIZE, len(data)))
+    tmp_fname = fname + '.tmp'
+    with open(tmp_fname, 'wb') as file:
+        file.write(HEADER.pack(
+            MAGIC, VERSION, FLOATS_PER_VERTEX, vertex_count))
+        file.write(data)
+    os.rename(tmp_fname, fname)
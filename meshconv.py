@@ -0,0 +1,289 @@
+# Copyright (c) 2014 Per Lindstrand
+
+# converts the built-in meshes to mesh files, run after changing them:
+# python meshconv.py
+
+import argparse
+import logging
+import logging.config
+import struct
+
+import mesh
+
+LOG = logging.getLogger(__name__)
+
+CUBE_VERT_XYZ = [
+    # front
+    -.5, -.5,  .5,
+     .5, -.5,  .5,
+     .5,  .5,  .5,
+     .5,  .5,  .5,
+    -.5,  .5,  .5,
+    -.5, -.5,  .5,
+
+    # back
+    -.5, -.5, -.5,
+    -.5,  .5, -.5,
+     .5,  .5, -.5,
+     .5,  .5, -.5,
+     .5, -.5, -.5,
+    -.5, -.5, -.5,
+
+    # right
+     .5, -.5, -.5,
+     .5,  .5, -.5,
+     .5,  .5,  .5,
+     .5,  .5,  .5,
+     .5, -.5,  .5,
+     .5, -.5, -.5,
+
+    # left
+    -.5, -.5, -.5,
+    -.5, -.5,  .5,
+    -.5,  .5,  .5,
+    -.5,  .5,  .5,
+    -.5,  .5, -.5,
+    -.5, -.5, -.5,
+
+    # top
+    -.5,  .5, -.5,
+    -.5,  .5,  .5,
+     .5,  .5,  .5,
+     .5,  .5,  .5,
+     .5,  .5, -.5,
+    -.5,  .5, -.5,
+
+    # bottom
+    # XXX probably no need to draw bottom
+    -.5, -.5, -.5,
+     .5, -.5, -.5,
+     .5, -.5,  .5,
+     .5, -.5,  .5,
+    -.5, -.5,  .5,
+    -.5, -.5, -.5,
+]
+
+CUBE_VERT_UV = [
+    # front
+    0., 0.,
+    1., 0.,
+    1., 1.,
+    1., 1.,
+    0., 1.,
+    0., 0.,
+
+    # back
+    1., 0.,
+    1., 1.,
+    0., 1.,
+    0., 1.,
+    0., 0.,
+    1., 0.,
+
+    # right
+    1., 0.,
+    1., 1.,
+    0., 1.,
+    0., 1.,
+    0., 0.,
+    1., 0.,
+
+    # left
+    0., 0.,
+    1., 0.,
+    1., 1.,
+    1., 1.,
+    0., 1.,
+    0., 0.,
+
+    # top
+    0., 1.,
+    0., 0.,
+    1., 0.,
+    1., 0.,
+    1., 1.,
+    0., 1.,
+
+    # bottom
+    1., 1.,
+    0., 1.,
+    0., 0.,
+    0., 0.,
+    1., 0.,
+    1., 1.,
+]
+
+CUBE_VERT_NORM = [
+    # front
+     0.,  0.,  .1,
+     0.,  0.,  .1,
+     0.,  0.,  .1,
+     0.,  0.,  .1,
+     0.,  0.,  .1,
+     0.,  0.,  .1,
+
+    # back
+     0.,  0., -.1,
+     0.,  0., -.1,
+     0.,  0., -.1,
+     0.,  0., -.1,
+     0.,  0., -.1,
+     0.,  0., -.1,
+
+    # right
+     1.,  0.,  0.,
+     1.,  0.,  0.,
+     1.,  0.,  0.,
+     1.,  0.,  0.,
+     1.,  0.,  0.,
+     1.,  0.,  0.,
+
+    # left
+    -1.,  0.,  0.,
+    -1.,  0.,  0.,
+    -1.,  0.,  0.,
+    -1.,  0.,  0.,
+    -1.,  0.,  0.,
+    -1.,  0.,  0.,
+
+    # top
+     0.,  1.,  0.,
+     0.,  1.,  0.,
+     0.,  1.,  0.,
+     0.,  1.,  0.,
+     0.,  1.,  0.,
+     0.,  1.,  0.,
+
+    # bottom
+     0., -1.,  0.,
+     0., -1.,  0.,
+     0., -1.,  0.,
+     0., -1.,  0.,
+     0., -1.,  0.,
+     0., -1.,  0.,
+]
+
+PYRAMID_VERT_XYZ = [
+    # front
+     0.,  .5,  0.,
+    -.5, -.5,  .5,
+     .5, -.5,  .5,
+
+    # back
+     0.,  .5,  0.,
+    -.5, -.5, -.5,
+     .5, -.5, -.5,
+
+    # right
+     0.,  .5,  0.,
+     .5, -.5,  .5,
+     .5, -.5, -.5,
+
+    # left
+     0.,  .5,  0.,
+    -.5, -.5,  .5,
+     .5, -.5,  .5,
+
+    # bottom (two tris)
+    -.5, -.5,  .5,
+     .5, -.5,  .5,
+    -.5, -.5, -.5,
+
+    -.5, -.5, -.5,
+     .5, -.5,  .5,
+     .5, -.5, -.5,
+]
+
+PYRAMID_VERT_UV = [
+     # front
+     .5, 1.,
+     0., 0.,
+     1., 0.,
+
+     # back
+     .5, 1.,
+     0., 0.,
+     1., 0.,
+
+     # right
+     .5, 1.,
+     0., 0.,
+     1., 0.,
+
+     # left
+     .5, 1.,
+     0., 0.,
+     1., 0.,
+
+     # bottom
+     0., 1.,
+     1., 1.,
+     0., 0.,
+
+     0., 0.,
+     1., 1.,
+     1., 0.,
+]
+
+
+def calc_pyramid_norms(xyz):
+    def vec_sub(u, v):
+        return (u[0] - v[0], u[1] - v[1], u[2] - v[2])
+
+    def vec_cross(u, v):
+        return (
+             u[1]*v[2] - v[1]*u[2],
+            -u[0]*v[2] + v[0]*u[2],
+             u[0]*v[1] - v[0]*u[1])
+
+    it = iter(xyz)
+    vecs = [(x, next(it), next(it)) for x in it]
+
+    norms = []
+    it = iter(vecs)
+    for u in it:
+        v = next(it)
+        w = next(it)
+        norms.extend(vec_cross(vec_sub(u, v), vec_sub(u, w)) * 3)
+    return norms
+
+
+def interleave(xyz, uvs, norms):
+    count = len(xyz) // 3
+    if len(uvs) != count * 2 or len(norms) != count * 3:
+        raise ValueError('attribute arrays of different lengths')
+    data = []
+    for i in range(count):
+        data.extend(xyz[i * 3:i * 3 + 3])
+        data.extend(uvs[i * 2:i * 2 + 2])
+        data.extend(norms[i * 3:i * 3 + 3])
+    return count, struct.pack('<%df' % len(data), *data)
+
+
+def get_builtin_meshes():
+    return {
+        'cube.mesh': (CUBE_VERT_XYZ, CUBE_VERT_UV, CUBE_VERT_NORM),
+        'pyramid.mesh': (
+            PYRAMID_VERT_XYZ, PYRAMID_VERT_UV,
+            calc_pyramid_norms(PYRAMID_VERT_XYZ)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Write the built-in meshes as mesh files')
+    parser.add_argument('names', nargs='*',
+                        help='meshes to write, all by default')
+    args = parser.parse_args()
+    logging.config.fileConfig('logging.conf', disable_existing_loggers=False)
+
+    meshes = get_builtin_meshes()
+    for fname in args.names or sorted(meshes):
+        if fname not in meshes:
+            parser.error('unknown mesh %r' % fname)
+        vertex_count, data = interleave(*meshes[fname])
+        mesh.write_mesh(fname, vertex_count, data)
+        LOG.info('Wrote %s, %d vertices', fname, vertex_count)
+
+if __name__ == '__main__':
+    main()
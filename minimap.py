@@ -0,0 +1,65 @@
+# Copyright (c) 2014 Per Lindstrand
+
+import logging
+
+import numpy as np
+
+LOG = logging.getLogger(__name__)
+
+
+class MinimapConfig(object):
+
+    # on screen size and distance to the window corner, in pixels
+    SIZE = 192
+    MARGIN = 10
+    # tiles per side of a heatmap cell
+    HEAT_CELL = 4
+    # seconds between heatmap uploads
+    HEAT_INTERVAL = .25
+    # units in a cell at which its color is fully opaque
+    HEAT_SATURATION = 8.
+    # rgb per team, team ids wrap around, team 0 is neutral
+    TEAM_COLORS = [
+        (160, 160, 160),
+        (220, 50, 40),
+        (40, 90, 220),
+        (230, 200, 40),
+        (60, 200, 80),
+        (180, 60, 200),
+    ]
+
+
+def get_heat_shape(width, height, cell=MinimapConfig.HEAT_CELL):
+    return (height + cell - 1) // cell, (width + cell - 1) // cell
+
+
+def bin_teams(xs, ys, teams, width, height, team_count,
+              cell=MinimapConfig.HEAT_CELL):
+    # unit count per team and heatmap cell as [team, cell_y, cell_x]
+    heat_height, heat_width = get_heat_shape(width, height, cell)
+    cxs = np.clip(np.floor(np.asarray(xs) + .5).astype(np.intp) // cell,
+                  0, heat_width - 1)
+    cys = np.clip(np.floor(np.asarray(ys) + .5).astype(np.intp) // cell,
+                  0, heat_height - 1)
+    slots = np.asarray(teams, dtype=np.intp) % team_count
+    cells = heat_width * heat_height
+    counts = np.bincount(slots * cells + cys * heat_width + cxs,
+                         minlength=team_count * cells)
+    return counts.reshape(team_count, heat_height, heat_width)
+
+
+def get_heatmap(xs, ys, teams, width, height,
+                cell=MinimapConfig.HEAT_CELL,
+                saturation=MinimapConfig.HEAT_SATURATION):
+    # rgba uint8 [cell_y, cell_x, 4], each cell colored by the mix of teams
+    # in it and as opaque as it is crowded
+    colors = np.array(MinimapConfig.TEAM_COLORS, dtype=np.float32)
+    counts = bin_teams(xs, ys, teams, width, height, len(colors), cell)
+    heat_height, heat_width = counts.shape[1:]
+    counts = counts.reshape(len(colors), -1).astype(np.float32)
+    totals = counts.sum(axis=0)
+    heatmap = np.zeros((heat_height * heat_width, 4), dtype=np.uint8)
+    rgb = counts.T.dot(colors) / np.maximum(totals, 1.)[:, None]
+    heatmap[:, :3] = rgb
+    heatmap[:, 3] = 255. * np.sqrt(np.minimum(totals / saturation, 1.))
+    return heatmap.reshape(heat_height, heat_width, 4)
@@ -0,0 +1,247 @@
+# Copyright (c) 2014 Per Lindstrand
+
+import collections
+import logging
+
+import numpy as np
+
+import world
+
+LOG = logging.getLogger(__name__)
+
+IMPASSABLE = 255
+UNREACHABLE = np.iinfo(np.int32).max
+
+NEIGHBORS_4 = ((1, 0), (-1, 0), (0, 1), (0, -1))
+NEIGHBORS_8 = (
+    (1, 0), (-1, 0), (0, 1), (0, -1),
+    (1, 1), (-1, 1), (1, -1), (-1, -1))
+
+
+class NavigationConfig(object):
+
+    FLOW_FIELD_CACHE_SIZE = 16
+    TILE_COSTS = {
+        world.TileType.SAND: 2,
+    }
+
+
+def grow_mask(mask):
+    # dilate a boolean grid by one cell in all eight directions
+    grown = mask.copy()
+    grown[1:, :] |= mask[:-1, :]
+    grown[:-1, :] |= mask[1:, :]
+    rows = grown.copy()
+    grown[:, 1:] |= rows[:, :-1]
+    grown[:, :-1] |= rows[:, 1:]
+    return grown
+
+
+def compute_cost_field(terrain, x0=0, y0=0, x1=None, y1=None):
+    if x1 is None:
+        x1 = terrain.width
+    if y1 is None:
+        y1 = terrain.height
+    types = terrain.types[y0:y1, x0:x1]
+    flags = terrain.flags[y0:y1, x0:x1]
+    cost = np.ones(types.shape, dtype=np.uint8)
+    for tile_type, tile_cost in NavigationConfig.TILE_COSTS.items():
+        cost[types == tile_type] = tile_cost
+    cost[types == world.TileType.WATER] = IMPASSABLE
+    cost[(flags & world.TileFlags.BLOCKING) != 0] = IMPASSABLE
+    return cost
+
+
+def compute_integration_field(cost, goal_x, goal_y):
+    # label correcting wavefront, every iteration relaxes the neighbours of
+    # all cells that improved in the previous one in a single batch
+    height, width = cost.shape
+    flat_cost = cost.ravel().astype(np.int32)
+    passable = flat_cost != IMPASSABLE
+    dist = np.full(width * height, UNREACHABLE, dtype=np.int32)
+    goal = goal_x + goal_y * width
+    if not passable[goal]:
+        return dist.reshape(height, width)
+    dist[goal] = 0
+    frontier = np.array([goal], dtype=np.intp)
+    while frontier.size:
+        fx = frontier % width
+        fy = frontier // width
+        fdist = dist[frontier]
+        cand_idx = []
+        cand_dist = []
+        for dx, dy in NEIGHBORS_4:
+            nx = fx + dx
+            ny = fy + dy
+            ok = (nx >= 0) & (nx < width) & (ny >= 0) & (ny < height)
+            nb = nx[ok] + ny[ok] * width
+            nd = fdist[ok] + flat_cost[nb]
+            better = passable[nb] & (nd < dist[nb])
+            cand_idx.append(nb[better])
+            cand_dist.append(nd[better])
+        cand_idx = np.concatenate(cand_idx)
+        if not cand_idx.size:
+            break
+        cand_dist = np.concatenate(cand_dist)
+        np.minimum.at(dist, cand_idx, cand_dist)
+        frontier = np.unique(cand_idx[dist[cand_idx] == cand_dist])
+    return dist.reshape(height, width)
+
+
+class FlowField(object):
+
+    def __init__(self, goal_x, goal_y, terrain):
+        self.goal_x = goal_x
+        self.goal_y = goal_y
+        self.chunk_size = terrain.chunk_size
+        self.width = terrain.width
+        self.height = terrain.height
+        self.integration = None
+        self.padded = None
+        self.dir_x = np.zeros((terrain.height, terrain.width), dtype=np.float32)
+        self.dir_y = np.zeros((terrain.height, terrain.width), dtype=np.float32)
+        self.chunk_ready = np.zeros(
+            (terrain.chunks_y, terrain.chunks_x), dtype=bool)
+        self.dirty_chunks = np.zeros(self.chunk_ready.shape, dtype=bool)
+        self.stale = True
+
+    def invalidate(self, dirty_chunks):
+        self.dirty_chunks |= dirty_chunks
+        self.stale = True
+
+    def integrate(self, cost):
+        old = self.integration
+        self.integration = compute_integration_field(
+            cost, self.goal_x, self.goal_y)
+        self.padded = np.pad(
+            self.integration, 1, mode='constant', constant_values=UNREACHABLE)
+        self.stale = False
+        if old is None:
+            self.chunk_ready[:, :] = False
+            self.dirty_chunks[:, :] = False
+            return
+        # a direction depends on the cell and its neighbours, so a change
+        # spills one tile into the surrounding chunks
+        dirty = self._chunk_any(grow_mask(old != self.integration))
+        self.chunk_ready &= ~(dirty | self.dirty_chunks)
+        self.dirty_chunks[:, :] = False
+
+    def _chunk_any(self, mask):
+        cs = self.chunk_size
+        chunks_y, chunks_x = self.chunk_ready.shape
+        padded = np.zeros((chunks_y * cs, chunks_x * cs), dtype=bool)
+        padded[:self.height, :self.width] = mask
+        return padded.reshape(chunks_y, cs, chunks_x, cs).any(axis=(1, 3))
+
+    def build_chunk(self, cx, cy):
+        cs = self.chunk_size
+        x0 = cx * cs
+        y0 = cy * cs
+        x1 = min(x0 + cs, self.width)
+        y1 = min(y0 + cs, self.height)
+        padded = self.padded
+        # view of the padded field shifted by one neighbour offset
+        def window(dx, dy):
+            return padded[y0 + 1 + dy:y1 + 1 + dy, x0 + 1 + dx:x1 + 1 + dx]
+        here = window(0, 0)
+        best = here.copy()
+        best_dx = np.zeros(here.shape, dtype=np.float32)
+        best_dy = np.zeros(here.shape, dtype=np.float32)
+        for dx, dy in NEIGHBORS_8:
+            value = window(dx, dy)
+            if dx and dy:
+                # no cutting corners past impassable tiles
+                blocked = ((window(dx, 0) == UNREACHABLE) |
+                           (window(0, dy) == UNREACHABLE))
+                value = np.where(blocked, UNREACHABLE, value)
+            better = value < best
+            best = np.where(better, value, best)
+            best_dx[better] = dx
+            best_dy[better] = dy
+        length = np.sqrt(best_dx * best_dx + best_dy * best_dy)
+        length[length == 0.] = 1.
+        self.dir_x[y0:y1, x0:x1] = best_dx / length
+        self.dir_y[y0:y1, x0:x1] = best_dy / length
+        self.chunk_ready[cy, cx] = True
+
+    def build_all(self):
+        for cy, cx in zip(*np.nonzero(~self.chunk_ready)):
+            self.build_chunk(cx, cy)
+
+    def sample(self, xs, ys):
+        tx = np.clip(np.floor(np.asarray(xs) + .5).astype(np.intp),
+                     0, self.width - 1)
+        ty = np.clip(np.floor(np.asarray(ys) + .5).astype(np.intp),
+                     0, self.height - 1)
+        chunk_ids = (ty // self.chunk_size) * self.chunk_ready.shape[1] + (
+            tx // self.chunk_size)
+        missing = ~self.chunk_ready.ravel()
+        if missing.any():
+            needed = np.unique(chunk_ids)
+            for chunk_id in needed[missing[needed]]:
+                cy, cx = divmod(int(chunk_id), self.chunk_ready.shape[1])
+                self.build_chunk(cx, cy)
+        return self.dir_x[ty, tx], self.dir_y[ty, tx]
+
+    def distance(self, x, y):
+        return int(self.integration[y, x])
+
+
+class Navigator(object):
+
+    def __init__(self, terrain,
+                 cache_size=NavigationConfig.FLOW_FIELD_CACHE_SIZE):
+        self.terrain = terrain
+        self.cache_size = cache_size
+        self.cost = compute_cost_field(terrain)
+        self.revision = terrain.revision
+        self.flow_fields = collections.OrderedDict()
+
+    def refresh(self):
+        if self.terrain.revision == self.revision:
+            return
+        cxs, cys = self.terrain.changed_chunks(self.revision)
+        for cx, cy in zip(cxs, cys):
+            x0, y0, x1, y1 = self.terrain.chunk_bounds(cx, cy)
+            self.cost[y0:y1, x0:x1] = compute_cost_field(
+                self.terrain, x0, y0, x1, y1)
+        self.revision = self.terrain.revision
+        # neighbouring chunks may cut corners past the changed tiles
+        changed = np.zeros(self.terrain.chunk_revisions.shape, dtype=bool)
+        changed[cys, cxs] = True
+        dirty = grow_mask(changed)
+        for field in self.flow_fields.values():
+            field.invalidate(dirty)
+        LOG.debug('Terrain changed in %d chunks, %d flow fields stale',
+                  len(cxs), len(self.flow_fields))
+
+    def get_flow_field(self, goal_x, goal_y):
+        self.refresh()
+        key = (goal_x, goal_y)
+        field = self.flow_fields.get(key)
+        if field is None:
+            field = FlowField(goal_x, goal_y, self.terrain)
+            self.flow_fields[key] = field
+            if len(self.flow_fields) > self.cache_size:
+                self.flow_fields.popitem(last=False)
+        else:
+            self.flow_fields.move_to_end(key)
+        if field.stale:
+            field.integrate(self.cost)
+        return field
+
+    def sample_directions(self, goal_x, goal_y, xs, ys):
+        return self.get_flow_field(goal_x, goal_y).sample(xs, ys)
+
+    def steer_entities(self, goal_x, goal_y, entities, speed):
+        if not entities:
+            return
+        count = len(entities)
+        xs = np.fromiter((ent.x for ent in entities), np.float64, count)
+        ys = np.fromiter((ent.y for ent in entities), np.float64, count)
+        dir_x, dir_y = self.sample_directions(goal_x, goal_y, xs, ys)
+        vel_x = (dir_x * speed).tolist()
+        vel_y = (dir_y * speed).tolist()
+        for ent, vx, vy in zip(entities, vel_x, vel_y):
+            ent.vel_x = vx
+            ent.vel_y = vy
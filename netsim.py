@@ -0,0 +1,168 @@
+# Copyright (c) 2014 Per Lindstrand
+
+import collections
+import logging
+
+import numpy as np
+
+import match
+import networking
+import replication
+import world
+
+LOG = logging.getLogger(__name__)
+
+TICK_TIME = 1. / match.TICK_RATE
+
+
+class NullSocket(object):
+
+    def sendto(self, data, addr):
+        return len(data)
+
+
+def create_match(seed):
+    # a match sending into a NullSocket that only ticks when stepped
+    game = match.Match(NullSocket(), seed)
+    game.next_tick = float('inf')
+    return game
+
+
+def get_connect_packet(payload='hello'):
+    # the first datagram of a new client
+    sender = networking.Channel(NullSocket(), None)
+    sender.send_packet(payload)
+    return sender.frame_packet(0, sender.outbox[0][1], 0.)
+
+
+class BottleneckLink(object):
+
+    # one direction of a link draining capacity bytes per second from a
+    # queue of at most queue_size bytes, datagrams that don't fit are
+    # dropped. the others arrive delay seconds after they drained
+
+    # ip and udp headers
+    OVERHEAD = 28
+
+    def __init__(self, capacity, queue_size, delay):
+        self.capacity = capacity
+        self.queue_size = queue_size
+        self.delay = delay
+        self.now = 0.
+        self.busy_until = 0.
+        # (arrival time, datagram)
+        self.arrivals = collections.deque()
+        self.dropped = 0
+
+    def get_backlog(self):
+        return max(self.busy_until - self.now, 0.) * self.capacity
+
+    def transmit(self, data):
+        size = len(data) + self.OVERHEAD
+        if self.get_backlog() + size > self.queue_size:
+            self.dropped += 1
+            return
+        self.busy_until = max(self.busy_until, self.now) + (
+            size / self.capacity)
+        self.arrivals.append((self.busy_until + self.delay, data))
+
+    def receive(self):
+        arrived = []
+        while self.arrivals and self.arrivals[0][0] <= self.now:
+            arrived.append(self.arrivals.popleft()[1])
+        return arrived
+
+
+class LinkSocket(object):
+
+    def __init__(self, link):
+        self.link = link
+
+    def sendto(self, data, addr):
+        self.link.transmit(data)
+        return len(data)
+
+
+class LinkedChannels(object):
+
+    # a server Channel replicating to a client Channel over a congested
+    # downlink and an uncongested uplink, on a simulated clock. the client
+    # acks once per tick
+
+    def __init__(self, capacity, queue_size, rtt, controller=None):
+        self.down = BottleneckLink(capacity, queue_size, rtt * .5)
+        self.up = BottleneckLink(1e9, 1e9, rtt * .5)
+        self.server = networking.Channel(LinkSocket(self.down), None)
+        self.client = networking.Channel(LinkSocket(self.up), None)
+        self.server.clock = self.client.clock = self.get_time
+        self.replication = replication.ClientReplication(self.server)
+        if controller is not None:
+            self.replication.controller = controller
+        # records that arrived, and the highest smoothed rtt and outbox
+        self.delivered = 0
+        self.max_rtt = 0.
+        self.max_outbox = 0
+
+    def get_time(self):
+        return self.down.now
+
+    def step(self, dt, tick, arrays, own):
+        self.down.now += dt
+        self.up.now += dt
+        for data in self.down.receive():
+            self.client.on_data_received(data)
+        packet = self.client.recv_packet()
+        while packet is not None:
+            snapshot = replication.read_snapshot(packet)
+            if snapshot is not None:
+                self.delivered += len(snapshot[1])
+            packet = self.client.recv_packet()
+        self.client.send_packet(b'', 'ack')
+        self.client.flush()
+        for data in self.up.receive():
+            self.server.on_data_received(data)
+        # the bare acks
+        del self.server.inbox[:]
+        self.replication.update(self.down.now, dt, tick, arrays, own)
+        self.max_outbox = max(self.max_outbox, len(self.server.outbox))
+        self.server.flush()
+        self.max_rtt = max(self.max_rtt, self.server.stats.srtt or 0.)
+
+    def get_loss_rate(self):
+        acked = self.server.packets_acked
+        lost = self.server.packets_lost
+        return lost / float(max(acked + lost, 1))
+
+
+class FixedRateController(replication.SendRateController):
+
+    def on_feedback(self, now, dt, acked, lost, rtt):
+        pass
+
+
+def create_congested_links(capacity):
+    # the adaptive rate against a fixed one at the starting capacity
+    return collections.OrderedDict([
+        ('adaptive', LinkedChannels(capacity, 16000., .05)),
+        ('fixed', LinkedChannels(capacity, 16000., .05,
+                                 FixedRateController(capacity))),
+    ])
+
+
+def run_congested_links(links, capacity, seconds, tick, arrays, own):
+    for link in links.values():
+        link.down.capacity = capacity
+    for i in range(int(round(seconds / TICK_TIME))):
+        tick += 1
+        for link in links.values():
+            link.step(TICK_TIME, tick, arrays, own)
+    return tick
+
+
+def get_replication_arrays(rand, count):
+    ids = np.arange(1, count + 1, dtype=np.uint32)
+    xs, ys = rand.uniform(0., 256., (2, count)).astype(np.float32)
+    rotations = np.zeros(count, dtype=np.float32)
+    own = world.Entity()
+    own.id, own.x, own.y = 1, float(xs[0]), float(ys[0])
+    return (ids, xs, ys, rotations), own
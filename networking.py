@@ -1,21 +1,46 @@
 # Copyright (c) 2014 Per Lindstrand
 
+import collections
 import logging
+import select
 import socket
 import struct
+import threading
+import time
 import zlib
 
 LOG = logging.getLogger(__name__)
 
 COMPRESSION_LEVEL = 1
 
+STATS_WINDOW = 5.
+STATS_BUCKETS = 10
+
+MAX_DATAGRAM_SIZE = 65536
+# received messages waiting for the render thread, the oldest are dropped
+# when it falls this far behind
+MAX_QUEUED_MESSAGES = 1024
+# received packets are acked on their own when nothing else went out for
+# this long, so the peer hears about its loss and round trip in time
+ACK_INTERVAL = .05
+
+
+def peek_session(data):
+    # the session id of a framed packet without decoding it, None if the
+    # datagram is too short to have one
+    if len(data) < 2 + 4:
+        return None
+    return struct.unpack_from('!I', data, 2)[0]
+
 
 def compress_data(data):
-    return zlib.compress(data.encode('ascii'), COMPRESSION_LEVEL)
+    if isinstance(data, str):
+        data = data.encode('ascii')
+    return zlib.compress(data, COMPRESSION_LEVEL)
 
 
 def decompress_data(data):
-    return str(zlib.decompress(data))
+    return zlib.decompress(data)
 
 
 class WriteBuffer(object):
@@ -164,38 +189,261 @@ class ReadBuffer(object):
         return data
 
 
+class SlidingWindow(object):
+
+    # sum, count and peak of the values added over the last `duration`
+    # seconds, kept in a ring of time buckets so old values fall out without
+    # storing every sample
+
+    def __init__(self, duration=STATS_WINDOW, buckets=STATS_BUCKETS):
+        self.bucket_time = duration / buckets
+        self.sums = [0] * buckets
+        self.counts = [0] * buckets
+        self.peaks = [0] * buckets
+        self.bucket = None
+
+    def advance(self, now):
+        bucket = int(now / self.bucket_time)
+        if self.bucket is None:
+            self.bucket = bucket
+        elif bucket > self.bucket:
+            size = len(self.sums)
+            for i in range(self.bucket + 1,
+                           min(bucket, self.bucket + size) + 1):
+                self.sums[i % size] = 0
+                self.counts[i % size] = 0
+                self.peaks[i % size] = 0
+            self.bucket = bucket
+
+    def add(self, now, value=1):
+        self.advance(now)
+        i = self.bucket % len(self.sums)
+        self.sums[i] += value
+        self.counts[i] += 1
+        if value > self.peaks[i]:
+            self.peaks[i] = value
+
+    def total(self, now):
+        self.advance(now)
+        return sum(self.sums)
+
+    def count(self, now):
+        self.advance(now)
+        return sum(self.counts)
+
+    def mean(self, now):
+        count = self.count(now)
+        return sum(self.sums) / float(count) if count else 0.
+
+    def peak(self, now):
+        self.advance(now)
+        return max(self.peaks)
+
+
+class ChannelStats(object):
+
+    # traffic, loss and latency of one channel over a sliding window
+
+    RTT_ALPHA = .125
+    RTT_BETA = .25
+
+    def __init__(self, window=STATS_WINDOW):
+        self.window = window
+        self.bytes_sent = SlidingWindow(window)
+        self.bytes_received = SlidingWindow(window)
+        self.raw_bytes_sent = SlidingWindow(window)
+        self.lost = SlidingWindow(window)
+        self.out_of_order = SlidingWindow(window)
+        self.duplicates = SlidingWindow(window)
+        # fate of the packets we sent, as told by the acks of the peer
+        self.acked = SlidingWindow(window)
+        self.send_lost = SlidingWindow(window)
+        self.rtt = SlidingWindow(window)
+        self.queue_delay = SlidingWindow(window)
+        self.bytes_by_kind = {}
+        self.srtt = None
+        self.rtt_var = 0.
+
+    def on_queued(self, now, kind, raw_size, size):
+        self.raw_bytes_sent.add(now, raw_size)
+        window = self.bytes_by_kind.get(kind)
+        if window is None:
+            window = self.bytes_by_kind[kind] = SlidingWindow(self.window)
+        window.add(now, size)
+
+    def on_sent(self, now, size, queue_delay):
+        self.bytes_sent.add(now, size)
+        self.queue_delay.add(now, queue_delay)
+
+    def on_rtt_sample(self, now, rtt):
+        self.rtt.add(now, rtt)
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rtt_var = rtt / 2.
+        else:
+            self.rtt_var += self.RTT_BETA * (
+                abs(self.srtt - rtt) - self.rtt_var)
+            self.srtt += self.RTT_ALPHA * (rtt - self.srtt)
+
+    def get_stats(self, now):
+        packets_received = self.bytes_received.count(now)
+        # late packets can cancel losses that already left the window
+        lost = max(self.lost.total(now), 0)
+        acked = self.acked.total(now)
+        send_lost = self.send_lost.total(now)
+        raw_bytes_sent = self.raw_bytes_sent.total(now)
+        stats = {
+            'bytes_sent': self.bytes_sent.total(now),
+            'bytes_received': self.bytes_received.total(now),
+            'packets_sent': self.bytes_sent.count(now),
+            'packets_received': packets_received,
+            'packets_lost': lost,
+            'send_rate': self.bytes_sent.total(now) / self.window,
+            'recv_rate': self.bytes_received.total(now) / self.window,
+            'compression_ratio': (
+                self.bytes_sent.total(now) / float(raw_bytes_sent)
+                if raw_bytes_sent else 0.),
+            'loss_rate': (
+                lost / float(lost + packets_received) if lost else 0.),
+            'send_loss_rate': (
+                send_lost / float(send_lost + acked) if send_lost else 0.),
+            'out_of_order_rate': (
+                self.out_of_order.total(now) / float(packets_received)
+                if packets_received else 0.),
+            'duplicate_rate': (
+                self.duplicates.total(now) / float(packets_received)
+                if packets_received else 0.),
+            'rtt': self.srtt or 0.,
+            'rtt_var': self.rtt_var,
+            'rtt_max': self.rtt.peak(now),
+            'queue_delay': self.queue_delay.mean(now),
+            'queue_delay_max': self.queue_delay.peak(now),
+            'bytes_by_kind': dict(
+                (kind, window.total(now))
+                for kind, window in self.bytes_by_kind.items()),
+        }
+        return stats
+
+
+def aggregate_stats(channels, now=None):
+    # totals over all channels, rates weighted by traffic and the worst
+    # latency of any client
+    if now is None:
+        now = time.monotonic()
+    per_channel = [chn.get_stats(now) for chn in channels]
+    total = {'channels': len(per_channel), 'bytes_by_kind': {}}
+    for name in ('bytes_sent', 'bytes_received', 'packets_sent',
+                 'packets_received', 'packets_lost', 'send_rate',
+                 'recv_rate', 'outbox'):
+        total[name] = sum(stats[name] for stats in per_channel)
+    for name in ('rtt_max', 'queue_delay_max', 'loss_rate'):
+        total[name + ('' if name.endswith('_max') else '_max')] = max(
+            [stats[name] for stats in per_channel] or [0.])
+    lost = total['packets_lost']
+    total['loss_rate'] = (
+        lost / float(lost + total['packets_received']) if lost else 0.)
+    rtts = [stats['rtt'] for stats in per_channel if stats['rtt']]
+    total['rtt_mean'] = sum(rtts) / len(rtts) if rtts else 0.
+    for stats in per_channel:
+        for kind, size in stats['bytes_by_kind'].items():
+            total['bytes_by_kind'][kind] = (
+                total['bytes_by_kind'].get(kind, 0) + size)
+    return total
+
+
 class Channel(object):
 
     #MAX_PACKET_ID = 512
     MAX_PACKET_SIZE = 512
-
-    def __init__(self, sock, addr):
+    NO_ACK = 0xffffffff
+    MAX_ACK_DELAY = 0xffff
+    # sent packets remembered for rtt samples
+    MAX_PENDING_ACKS = 256
+    # received packet ids remembered for duplicate detection, also sent
+    # along with every ack
+    RECV_HISTORY = 32
+    # a sent packet is lost once this many newer ones were acked
+    LOSS_REORDER_THRESHOLD = 3
+    # size, session, packet id, ack, ack bits, ack delay and the length of
+    # the payload
+    HEADER_SIZE = 2 + 4 + 4 + 4 + 4 + 2 + 2
+    # packets waiting to be sent, the oldest are dropped past this
+    MAX_OUTBOX = 256
+
+    def __init__(self, sock, addr, session=0):
         self.sock = sock
         self.addr = addr
+        # assigned by the server, a client starts at 0 and takes the one in
+        # the first packet it gets
+        self.session = session
         self.recv_buffer = ReadBuffer()
         self.send_packet_id = 0
         self.recv_packet_id = None
+        self.recv_history = 0
+        self.recv_time = None
         self.outbox = []
+        # framed size of what is in the outbox and the packets dropped from
+        # it for not fitting
+        self.outbox_bytes = 0
+        self.outbox_dropped = 0
         self.inbox = []
-
-    def send_packet(self, data):
+        # replaced by simulations that run faster than real time
+        self.clock = time.monotonic
+        self.sent_times = collections.OrderedDict()
+        # totals of the sent packets the peer acked or that were lost
+        self.packets_acked = 0
+        self.packets_lost = 0
+        self.stats = ChannelStats()
+
+    def send_packet(self, data, kind='default'):
+        now = self.clock()
         compressed_data = compress_data(data)
         #LOG.debug(
         #    'Compression %d -> %d bytes, compression factor %f',
         #    len(data), len(compressed_data),
         #    float(len(compressed_data)) / len(data))
+        self.stats.on_queued(now, kind, len(data), len(compressed_data))
+        self.outbox.append((self.send_packet_id, compressed_data, now))
+        self.outbox_bytes += self.HEADER_SIZE + len(compressed_data)
+        self.send_packet_id = (self.send_packet_id + 1)# % self.MAX_PACKET_ID
+        if len(self.outbox) > self.MAX_OUTBOX:
+            # stale by now, the peer sees it as lost
+            packet_id, dropped_data, queued = self.outbox.pop(0)
+            self.outbox_bytes -= self.HEADER_SIZE + len(dropped_data)
+            self.outbox_dropped += 1
+
+    def frame_packet(self, packet_id, compressed_data, now):
+        # the header piggybacks an ack of the newest packet we got, which of
+        # the ones before it we got too and how long we sat on it, so the
+        # peer can measure the round trip and its loss
+        ack = self.NO_ACK
+        ack_delay = 0
+        if self.recv_packet_id is not None:
+            ack = self.recv_packet_id
+            ack_delay = min(int((now - self.recv_time) * 1000.),
+                            self.MAX_ACK_DELAY)
         buf = WriteBuffer(self.MAX_PACKET_SIZE)
-        buf.write_uint16(2 + 4 + len(compressed_data))
-        buf.write_uint32(self.send_packet_id)
+        buf.write_uint16(self.HEADER_SIZE - 2 + len(compressed_data))
+        buf.write_uint32(self.session)
+        buf.write_uint32(packet_id)
+        buf.write_uint32(ack)
+        buf.write_uint32(self.recv_history)
+        buf.write_uint16(ack_delay)
         buf.write_string(compressed_data)
-        self.outbox.append(buf.get_data())
-        self.send_packet_id = (self.send_packet_id + 1)# % self.MAX_PACKET_ID
+        return buf.get_data()
 
     def send_data(self):
         try:
             # check if we have anything to send, and try to send it
             if self.outbox:
-                data = self.outbox.pop(0)
+                now = self.clock()
+                packet_id, compressed_data, queued = self.outbox.pop(0)
+                self.outbox_bytes -= self.HEADER_SIZE + len(compressed_data)
+                data = self.frame_packet(packet_id, compressed_data, now)
+                self.stats.on_sent(now, len(data), now - queued)
+                self.sent_times[packet_id] = now
+                if len(self.sent_times) > self.MAX_PENDING_ACKS:
+                    self.sent_times.popitem(last=False)
                 # try until all data is sent
                 while data:
                     bytes_sent = self.sock.sendto(data, self.addr)
@@ -208,24 +456,93 @@ class Channel(object):
             LOG.exception('Socket error')
             return False
 
+    def flush(self):
+        # sends everything queued, False when the socket failed
+        while self.outbox:
+            if not self.send_data():
+                return False
+        return True
+
+    def on_ack(self, now, ack, ack_bits, ack_delay):
+        sent_times = self.sent_times
+        sent = sent_times.get(ack)
+        if sent is not None:
+            self.stats.on_rtt_sample(
+                now, max(now - sent - ack_delay / 1000., 0.))
+        # bit n of ack_bits is packet ack - n, packets missing from it are
+        # given a little while to show up out of order
+        acked = 0
+        lost = 0
+        for packet_id in list(sent_times):
+            age = ack - packet_id
+            if age < 0:
+                break
+            if age < self.RECV_HISTORY and ack_bits & (1 << age):
+                acked += 1
+            elif age >= self.LOSS_REORDER_THRESHOLD:
+                lost += 1
+            else:
+                continue
+            del sent_times[packet_id]
+        if acked:
+            self.packets_acked += acked
+            self.stats.acked.add(now, acked)
+        if lost:
+            self.packets_lost += lost
+            self.stats.send_lost.add(now, lost)
+
+    def on_packet_id(self, now, packet_id):
+        # returns True if the packet is newer than anything seen so far
+        stats = self.stats
+        last_id = self.recv_packet_id
+        if last_id is None or packet_id > last_id:
+            if last_id is not None:
+                gap = packet_id - last_id - 1
+                if gap:
+                    LOG.debug(
+                        'Packet loss or out-of-order expect %d but got %d',
+                        last_id + 1, packet_id)
+                    # counted as lost until they show up late
+                    stats.lost.add(now, gap)
+                shift = packet_id - last_id
+                self.recv_history = ((self.recv_history << shift) | 1) & (
+                    (1 << self.RECV_HISTORY) - 1)
+            else:
+                self.recv_history = 1
+            self.recv_packet_id = packet_id
+            self.recv_time = now
+            return True
+        age = last_id - packet_id
+        if age < self.RECV_HISTORY and self.recv_history & (1 << age):
+            stats.duplicates.add(now)
+        else:
+            stats.out_of_order.add(now)
+            stats.lost.add(now, -1)
+            if age < self.RECV_HISTORY:
+                self.recv_history |= 1 << age
+        return False
+
     def on_data_received(self, data):
         self.recv_buffer.feed(data)
         if self.recv_buffer.can_read(2):
             buf = ReadBuffer(self.recv_buffer.get_data())
             packet_size = buf.read_uint16()
             if self.recv_buffer.get_size() >= packet_size:
+                now = self.clock()
                 packet_size = self.recv_buffer.read_uint16()
+                session = self.recv_buffer.read_uint32()
+                if not self.session:
+                    self.session = session
                 packet_id = self.recv_buffer.read_uint32()
+                ack = self.recv_buffer.read_uint32()
+                ack_bits = self.recv_buffer.read_uint32()
+                ack_delay = self.recv_buffer.read_uint16()
                 packet_data = decompress_data(
                     self.recv_buffer.read_string())
-                if (self.recv_packet_id is None or
-                    self.recv_packet_id < packet_id):
-                    if (self.recv_packet_id is not None and
-                        (self.recv_packet_id + 1) != packet_id):
-                        LOG.debug(
-                            'Packet loss or out-of-order expect %d but got %d',
-                            self.recv_packet_id + 1, packet_id)
-                    self.recv_packet_id = packet_id
+                self.stats.bytes_received.add(now, len(data))
+                if ack != self.NO_ACK:
+                    self.on_ack(now, ack, ack_bits, ack_delay)
+                if self.on_packet_id(now, packet_id):
                     self.inbox.append(packet_data)
 
     def recv_packet(self):
@@ -233,3 +550,154 @@ class Channel(object):
             return self.inbox.pop(0)
         else:
             return None
+
+    def get_stats(self, now=None):
+        if now is None:
+            now = self.clock()
+        stats = self.stats.get_stats(now)
+        stats['outbox'] = len(self.outbox)
+        return stats
+
+
+class MessageQueue(object):
+
+    # bounded queue shared between two threads, drops the oldest messages
+    # when full since stale state is worth less than fresh state
+
+    def __init__(self, max_size=MAX_QUEUED_MESSAGES):
+        self.lock = threading.Lock()
+        self.messages = collections.deque()
+        self.max_size = max_size
+        self.dropped = 0
+
+    def put_many(self, messages):
+        with self.lock:
+            self.messages.extend(messages)
+            overflow = len(self.messages) - self.max_size
+            for i in range(overflow):
+                self.messages.popleft()
+            if overflow > 0:
+                self.dropped += overflow
+
+    def take_all(self):
+        with self.lock:
+            messages = list(self.messages)
+            self.messages.clear()
+        return messages
+
+    def __len__(self):
+        return len(self.messages)
+
+
+class ChannelThread(threading.Thread):
+
+    # runs a Channel on its own thread: drains the socket completely every
+    # time it becomes readable and queues the decoded packets as
+    # (receive time, packet) for the owner to take once per frame.
+    # outgoing packets are queued by send() and wake the thread up
+
+    def __init__(self, addr):
+        super(ChannelThread, self).__init__(name='network')
+        self.daemon = True
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        self.channel = Channel(self.sock, addr)
+        # held by the thread while it uses the channel
+        self.channel_lock = threading.Lock()
+        self.inbox = MessageQueue()
+        self.outbox = MessageQueue()
+        self.wakeup_recv, self.wakeup_send = socket.socketpair()
+        self.wakeup_recv.setblocking(False)
+        self.running = True
+        self.connected = True
+        # when the oldest packet we haven't acked yet came in
+        self.unacked_since = None
+
+    def send(self, data, kind='default'):
+        self.outbox.put_many([(data, kind)])
+        self.wakeup_send.send(b'\0')
+
+    def receive(self):
+        return self.inbox.take_all()
+
+    def get_stats(self):
+        with self.channel_lock:
+            stats = self.channel.get_stats()
+        stats['inbox'] = len(self.inbox)
+        stats['inbox_dropped'] = self.inbox.dropped
+        return stats
+
+    def close(self):
+        self.running = False
+        self.wakeup_send.send(b'\0')
+        self.join()
+        self.sock.close()
+        self.wakeup_recv.close()
+        self.wakeup_send.close()
+
+    def run(self):
+        try:
+            while self.running and self.connected:
+                timeout = None
+                if self.unacked_since is not None:
+                    timeout = max(self.unacked_since + ACK_INTERVAL -
+                                  time.monotonic(), 0.)
+                readable, _, _ = select.select(
+                    [self.sock, self.wakeup_recv], [], [], timeout)
+                if self.wakeup_recv in readable:
+                    self.drain_wakeups()
+                with self.channel_lock:
+                    if self.sock in readable:
+                        self.drain_socket()
+                    self.flush_outbox()
+        except socket.error:
+            LOG.exception('Socket error')
+        self.connected = False
+
+    def drain_wakeups(self):
+        try:
+            while self.wakeup_recv.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def drain_socket(self):
+        chn = self.channel
+        packets = []
+        while True:
+            try:
+                data = self.sock.recv(MAX_DATAGRAM_SIZE)
+            except BlockingIOError:
+                break
+            except ConnectionRefusedError:
+                # nobody listening on the other end yet
+                break
+            if not data:
+                LOG.info('Server disconnected')
+                self.connected = False
+                break
+            chn.on_data_received(data)
+            now = time.perf_counter()
+            packet = chn.recv_packet()
+            while packet is not None:
+                packets.append((now, packet))
+                packet = chn.recv_packet()
+        if packets:
+            self.inbox.put_many(packets)
+            if self.unacked_since is None:
+                self.unacked_since = time.monotonic()
+
+    def flush_outbox(self):
+        chn = self.channel
+        for data, kind in self.outbox.take_all():
+            chn.send_packet(data, kind)
+        if chn.outbox:
+            # every packet carries an ack
+            self.unacked_since = None
+        elif (self.unacked_since is not None and
+              time.monotonic() - self.unacked_since >= ACK_INTERVAL):
+            chn.send_packet(b'', 'ack')
+            self.unacked_since = None
+        if not chn.flush():
+            LOG.info('Server disconnected')
+            self.connected = False
@@ -0,0 +1,174 @@
+# Copyright (c) 2014 Per Lindstrand
+
+import json
+import logging
+import socket
+import time
+
+LOG = logging.getLogger(__name__)
+
+HISTORY_SIZE = 256
+
+
+class Histogram(object):
+
+    # ring buffer with the values of the last HISTORY_SIZE ticks
+
+    def __init__(self, size=HISTORY_SIZE):
+        self.values = [0] * size
+        self.pos = 0
+        self.count = 0
+
+    def add(self, value):
+        self.values[self.pos] = value
+        self.pos = (self.pos + 1) % len(self.values)
+        self.count += 1
+
+    def summary(self):
+        values = sorted(self.values[:min(self.count, len(self.values))])
+        if not values:
+            return None
+        last = len(values) - 1
+        return {
+            'last': self.values[self.pos - 1],
+            'min': values[0],
+            'mean': sum(values) / float(len(values)),
+            'p50': values[last // 2],
+            'p99': values[int(last * .99)],
+            'max': values[last],
+        }
+
+
+class Profiler(object):
+
+    # phase times and counters accumulate over a tick, gauges keep their
+    # last value, end_tick pushes all of them into their histograms
+
+    enabled = True
+
+    def __init__(self):
+        self.current = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.ticks = 0
+
+    def start(self):
+        return time.perf_counter_ns()
+
+    def stop(self, name, start):
+        elapsed = time.perf_counter_ns() - start
+        self.current[name] = self.current.get(name, 0) + elapsed
+
+    def count(self, name, value=1):
+        self.current[name] = self.current.get(name, 0) + value
+
+    def gauge(self, name, value):
+        self.gauges[name] = value
+
+    def end_tick(self):
+        histograms = self.histograms
+        for values in (self.current, self.gauges):
+            for name, value in values.items():
+                hist = histograms.get(name)
+                if hist is None:
+                    hist = histograms[name] = Histogram()
+                hist.add(value)
+        for name in self.current:
+            self.current[name] = 0
+        self.ticks += 1
+
+    def get_stats(self):
+        stats = {'ticks': self.ticks}
+        for name, hist in sorted(self.histograms.items()):
+            stats[name] = hist.summary()
+        return stats
+
+    def log_summary(self):
+        for name, hist in sorted(self.histograms.items()):
+            summary = hist.summary()
+            if summary is None:
+                continue
+            if name.endswith('_ns'):
+                LOG.info('%-24s p50 %8.3f ms  p99 %8.3f ms  max %8.3f ms',
+                         name, summary['p50'] / 1e6, summary['p99'] / 1e6,
+                         summary['max'] / 1e6)
+            else:
+                LOG.info('%-24s p50 %8d  p99 %8d  max %8d',
+                         name, summary['p50'], summary['p99'],
+                         summary['max'])
+
+
+class NullProfiler(object):
+
+    # drop-in for Profiler when instrumentation is off, keep it trivial
+
+    enabled = False
+
+    def start(self):
+        return 0
+
+    def stop(self, name, start):
+        pass
+
+    def count(self, name, value=1):
+        pass
+
+    def gauge(self, name, value):
+        pass
+
+    def end_tick(self):
+        pass
+
+    def get_stats(self):
+        return {}
+
+    def log_summary(self):
+        pass
+
+
+NULL_PROFILER = NullProfiler()
+
+
+class StatsServer(object):
+
+    # answers any datagram on a local UDP port with the stats as JSON,
+    # e.g. echo | nc -u -w1 127.0.0.1 9010
+
+    MAX_REPLY_SIZE = 65000
+
+    def __init__(self, profiler, port, host='127.0.0.1', extra_stats=None):
+        self.profiler = profiler
+        self.extra_stats = extra_stats
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        self.sock.bind((host, port))
+
+    def get_stats(self):
+        stats = self.profiler.get_stats()
+        if self.extra_stats:
+            stats.update(self.extra_stats())
+        return stats
+
+    def get_reply(self):
+        # never a partial document, a reply that doesn't fit in a datagram
+        # is replaced by an error saying so
+        reply = json.dumps(self.get_stats(), sort_keys=True).encode('ascii')
+        if len(reply) <= self.MAX_REPLY_SIZE:
+            return reply
+        LOG.warning('Stats reply of %d bytes is over the %d byte limit',
+                    len(reply), self.MAX_REPLY_SIZE)
+        return json.dumps({'error': 'truncated',
+                           'size': len(reply)}).encode('ascii')
+
+    def poll(self):
+        try:
+            while True:
+                data, addr = self.sock.recvfrom(64)
+                self.sock.sendto(self.get_reply(), addr)
+        except (BlockingIOError, InterruptedError):
+            pass
+        except socket.error:
+            LOG.exception('Stats socket error')
+
+    def close(self):
+        self.sock.close()
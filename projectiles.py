@@ -0,0 +1,219 @@
+# Copyright (c) 2014 Per Lindstrand
+
+import logging
+
+import numpy as np
+
+import spatial
+
+LOG = logging.getLogger(__name__)
+
+
+class ProjectileConfig(object):
+
+    INITIAL_CAPACITY = 1024
+    RADIUS = .05
+    LIFETIME = 2.
+    DAMAGE = 10.
+    GRID_CELL_SIZE = 2.
+
+
+def march_tiles(blocking, ax, ay, bx, by):
+    # batched DDA over the tile grid for the segments a -> b, returns the
+    # segment parameter of the first blocking tile or inf if there is none;
+    # leaving the map counts as hitting a blocking tile
+    height, width = blocking.shape
+    count = ax.size
+    hit_t = np.full(count, np.inf)
+    if not count:
+        return hit_t
+    # tile i spans [i - .5, i + .5), shift so it spans [i, i + 1)
+    ax = ax + .5
+    ay = ay + .5
+    dx = bx + .5 - ax
+    dy = by + .5 - ay
+    tx = np.floor(ax).astype(np.intp)
+    ty = np.floor(ay).astype(np.intp)
+    step_x = np.where(dx > 0., 1, -1)
+    step_y = np.where(dy > 0., 1, -1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        delta_x = np.where(dx != 0., np.abs(1. / dx), np.inf)
+        delta_y = np.where(dy != 0., np.abs(1. / dy), np.inf)
+        next_x = np.where(
+            dx > 0., (tx + 1 - ax) * delta_x, (ax - tx) * delta_x)
+        next_y = np.where(
+            dy > 0., (ty + 1 - ay) * delta_y, (ay - ty) * delta_y)
+    next_x[dx == 0.] = np.inf
+    next_y[dy == 0.] = np.inf
+    active = np.arange(count)
+    t = np.zeros(count)
+    while active.size:
+        x = tx[active]
+        y = ty[active]
+        outside = (x < 0) | (x >= width) | (y < 0) | (y >= height)
+        blocked = outside.copy()
+        inside = ~outside
+        blocked[inside] = blocking[y[inside], x[inside]]
+        hit_t[active[blocked]] = t[active[blocked]]
+        active = active[~blocked]
+        # step into the next tile along whichever axis is crossed first
+        along_x = next_x[active] < next_y[active]
+        t_next = np.where(along_x, next_x[active], next_y[active])
+        keep = t_next <= 1.
+        active = active[keep]
+        along_x = along_x[keep]
+        t[active] = t_next[keep]
+        ix = active[along_x]
+        iy = active[~along_x]
+        tx[ix] += step_x[ix]
+        next_x[ix] += delta_x[ix]
+        ty[iy] += step_y[iy]
+        next_y[iy] += delta_y[iy]
+    return hit_t
+
+
+def sweep_circles(ax, ay, dx, dy, cx, cy, radius):
+    # first segment parameter in [0, 1] at which a + t * d touches the
+    # circle, inf if it never does
+    fx = ax - cx
+    fy = ay - cy
+    a = dx * dx + dy * dy
+    b = 2. * (fx * dx + fy * dy)
+    c = fx * fx + fy * fy - radius * radius
+    disc = b * b - 4. * a * c
+    t = np.full(ax.size, np.inf)
+    moving = (disc >= 0.) & (a > 0.)
+    root = (-b[moving] - np.sqrt(disc[moving])) / (2. * a[moving])
+    t[moving] = np.where((root >= 0.) & (root <= 1.), root, np.inf)
+    t[c <= 0.] = 0.
+    return t
+
+
+class ProjectileStore(object):
+
+    def __init__(self, capacity=ProjectileConfig.INITIAL_CAPACITY):
+        self.capacity = 0
+        self.count = 0
+        self.x = np.zeros(0)
+        self.y = np.zeros(0)
+        self.vel_x = np.zeros(0)
+        self.vel_y = np.zeros(0)
+        self.radius = np.zeros(0)
+        self.lifetime = np.zeros(0)
+        self.damage = np.zeros(0)
+        self.owner = np.zeros(0, dtype=np.int64)
+        self.alive = np.zeros(0, dtype=bool)
+        self.free = np.zeros(0, dtype=np.intp)
+        self.free_count = 0
+        self.grid = spatial.SpatialGrid(ProjectileConfig.GRID_CELL_SIZE)
+        self.grow(capacity)
+
+    def grow(self, capacity):
+        old = self.capacity
+        for name in ('x', 'y', 'vel_x', 'vel_y', 'radius', 'lifetime',
+                     'damage', 'owner', 'alive'):
+            array = getattr(self, name)
+            grown = np.zeros(capacity, dtype=array.dtype)
+            grown[:old] = array
+            setattr(self, name, grown)
+        # free slots are a stack, lowest slots on top so live projectiles
+        # stay packed at the start of the arrays
+        free = np.zeros(capacity, dtype=np.intp)
+        free[:capacity - old] = np.arange(capacity - 1, old - 1, -1)
+        free[capacity - old:capacity - old + self.free_count] = (
+            self.free[:self.free_count])
+        self.free = free
+        self.free_count += capacity - old
+        self.capacity = capacity
+
+    def spawn_many(self, xs, ys, vel_xs, vel_ys, owners,
+                   radius=ProjectileConfig.RADIUS,
+                   lifetime=ProjectileConfig.LIFETIME,
+                   damage=ProjectileConfig.DAMAGE):
+        xs = np.atleast_1d(np.asarray(xs, dtype=np.float64))
+        count = xs.size
+        if count > self.free_count:
+            capacity = self.capacity
+            while capacity - self.count < count:
+                capacity = max(1, capacity * 2)
+            self.grow(capacity)
+        self.free_count -= count
+        slots = self.free[self.free_count:self.free_count + count][::-1]
+        self.x[slots] = xs
+        self.y[slots] = ys
+        self.vel_x[slots] = vel_xs
+        self.vel_y[slots] = vel_ys
+        self.owner[slots] = owners
+        self.radius[slots] = radius
+        self.lifetime[slots] = lifetime
+        self.damage[slots] = damage
+        self.alive[slots] = True
+        self.count += count
+        return slots.copy()
+
+    def spawn(self, x, y, vel_x, vel_y, owner, **kwargs):
+        return int(self.spawn_many(x, y, vel_x, vel_y, owner, **kwargs)[0])
+
+    def kill(self, slots):
+        slots = np.asarray(slots, dtype=np.intp)
+        slots = slots[self.alive[slots]]
+        self.alive[slots] = False
+        self.free[self.free_count:self.free_count + slots.size] = slots
+        self.free_count += slots.size
+        self.count -= slots.size
+
+    def update(self, dt, ent_ids, ent_x, ent_y, ent_radius, blocking=None):
+        # moves every live projectile in one batch and returns the hits of
+        # this tick as (owner ids, target ids, damage)
+        ent_ids = np.asarray(ent_ids, dtype=np.int64)
+        slots = np.flatnonzero(self.alive)
+        ax = self.x[slots]
+        ay = self.y[slots]
+        dx = self.vel_x[slots] * dt
+        dy = self.vel_y[slots] * dt
+        self.lifetime[slots] -= dt
+
+        if blocking is not None:
+            wall_t = march_tiles(blocking, ax, ay, ax + dx, ay + dy)
+        else:
+            wall_t = np.full(slots.size, np.inf)
+
+        hit_target = np.full(slots.size, -1, dtype=np.intp)
+        if ent_ids.size and slots.size:
+            ent_x = np.asarray(ent_x, dtype=np.float64)
+            ent_y = np.asarray(ent_y, dtype=np.float64)
+            ent_radius = np.asarray(ent_radius, dtype=np.float64)
+            self.grid.build(ent_x, ent_y)
+            half_x = dx * .5
+            half_y = dy * .5
+            reach = (np.sqrt(half_x * half_x + half_y * half_y).max() +
+                     self.radius[slots].max() + ent_radius.max())
+            qi, ei = self.grid.query_pairs(ax + half_x, ay + half_y, reach)
+            not_owner = ent_ids[ei] != self.owner[slots[qi]]
+            qi = qi[not_owner]
+            ei = ei[not_owner]
+            t = sweep_circles(
+                ax[qi], ay[qi], dx[qi], dy[qi], ent_x[ei], ent_y[ei],
+                self.radius[slots[qi]] + ent_radius[ei])
+            hit = t < wall_t[qi]
+            qi = qi[hit]
+            ei = ei[hit]
+            t = t[hit]
+            # earliest target per projectile, ties go to the lowest id
+            order = np.lexsort((ent_ids[ei], t, qi))
+            qi = qi[order]
+            first = np.ones(qi.size, dtype=bool)
+            first[1:] = qi[1:] != qi[:-1]
+            hit_target[qi[first]] = ei[order][first]
+
+        self.x[slots] = ax + dx
+        self.y[slots] = ay + dy
+        hit_ent = hit_target >= 0
+        dead = (hit_ent | np.isfinite(wall_t) |
+                (self.lifetime[slots] <= 0.))
+        hit_slots = slots[hit_ent]
+        hits = (self.owner[hit_slots],
+                ent_ids[hit_target[hit_ent]],
+                self.damage[hit_slots])
+        self.kill(slots[dead])
+        return hits
@@ -1,256 +1,41 @@
 # Copyright (c) 2014 Per Lindstrand
 
+import collections
 import logging
 import math
 import json
 
+import numpy as np
 import pyglet
 from pyglet.gl import *
 
-import shader
+import assets
+import chunkbuild
+import mesh
+import minimap
+import world
 
 LOG = logging.getLogger(__name__)
 
 TILE_SIZE = 1.
 TILE_DIAG_SIZE = math.sqrt(2. * (TILE_SIZE * TILE_SIZE))
 
-CUBE_VERT_XYZ = [
-    # front
-    -.5, -.5,  .5,
-     .5, -.5,  .5,
-     .5,  .5,  .5,
-     .5,  .5,  .5,
-    -.5,  .5,  .5,
-    -.5, -.5,  .5,
-
-    # back
-    -.5, -.5, -.5,
-    -.5,  .5, -.5,
-     .5,  .5, -.5,
-     .5,  .5, -.5,
-     .5, -.5, -.5,
-    -.5, -.5, -.5,
-
-    # right
-     .5, -.5, -.5,
-     .5,  .5, -.5,
-     .5,  .5,  .5,
-     .5,  .5,  .5,
-     .5, -.5,  .5,
-     .5, -.5, -.5,
-
-    # left
-    -.5, -.5, -.5,
-    -.5, -.5,  .5,
-    -.5,  .5,  .5,
-    -.5,  .5,  .5,
-    -.5,  .5, -.5,
-    -.5, -.5, -.5,
-
-    # top
-    -.5,  .5, -.5,
-    -.5,  .5,  .5,
-     .5,  .5,  .5,
-     .5,  .5,  .5,
-     .5,  .5, -.5,
-    -.5,  .5, -.5,
-
-    # bottom
-    # XXX probably no need to draw bottom
-    -.5, -.5, -.5,
-     .5, -.5, -.5,
-     .5, -.5,  .5,
-     .5, -.5,  .5,
-    -.5, -.5,  .5,
-    -.5, -.5, -.5,
-]
-
-CUBE_VERT_UV = [
-    # front
-    0., 0.,
-    1., 0.,
-    1., 1.,
-    1., 1.,
-    0., 1.,
-    0., 0.,
-
-    # back
-    1., 0.,
-    1., 1.,
-    0., 1.,
-    0., 1.,
-    0., 0.,
-    1., 0.,
-
-    # right
-    1., 0.,
-    1., 1.,
-    0., 1.,
-    0., 1.,
-    0., 0.,
-    1., 0.,
-
-    # left
-    0., 0.,
-    1., 0.,
-    1., 1.,
-    1., 1.,
-    0., 1.,
-    0., 0.,
-
-    # top
-    0., 1.,
-    0., 0.,
-    1., 0.,
-    1., 0.,
-    1., 1.,
-    0., 1.,
-
-    # bottom
-    1., 1.,
-    0., 1.,
-    0., 0.,
-    0., 0.,
-    1., 0.,
-    1., 1.,
-]
-
-CUBE_VERT_NORM = [
-    # front
-     0.,  0.,  .1,
-     0.,  0.,  .1,
-     0.,  0.,  .1,
-     0.,  0.,  .1,
-     0.,  0.,  .1,
-     0.,  0.,  .1,
-
-    # back
-     0.,  0., -.1,
-     0.,  0., -.1,
-     0.,  0., -.1,
-     0.,  0., -.1,
-     0.,  0., -.1,
-     0.,  0., -.1,
-
-    # right
-     1.,  0.,  0.,
-     1.,  0.,  0.,
-     1.,  0.,  0.,
-     1.,  0.,  0.,
-     1.,  0.,  0.,
-     1.,  0.,  0.,
-
-    # left
-    -1.,  0.,  0.,
-    -1.,  0.,  0.,
-    -1.,  0.,  0.,
-    -1.,  0.,  0.,
-    -1.,  0.,  0.,
-    -1.,  0.,  0.,
-
-    # top
-     0.,  1.,  0.,
-     0.,  1.,  0.,
-     0.,  1.,  0.,
-     0.,  1.,  0.,
-     0.,  1.,  0.,
-     0.,  1.,  0.,
-
-    # bottom
-     0., -1.,  0.,
-     0., -1.,  0.,
-     0., -1.,  0.,
-     0., -1.,  0.,
-     0., -1.,  0.,
-     0., -1.,  0.,
-]
-
-PYRAMID_VERT_XYZ = [
-    # front
-     0.,  .5,  0.,
-    -.5, -.5,  .5,
-     .5, -.5,  .5,
-
-    # back
-     0.,  .5,  0.,
-    -.5, -.5, -.5,
-     .5, -.5, -.5,
-
-    # right
-     0.,  .5,  0.,
-     .5, -.5,  .5,
-     .5, -.5, -.5,
-
-    # left
-     0.,  .5,  0.,
-    -.5, -.5,  .5,
-     .5, -.5,  .5,
-
-    # bottom (two tris)
-    -.5, -.5,  .5,
-     .5, -.5,  .5,
-    -.5, -.5, -.5,
-
-    -.5, -.5, -.5,
-     .5, -.5,  .5,
-     .5, -.5, -.5,
-]
-
-PYRAMID_VERT_UV = [
-     # front
-     .5, 1.,
-     0., 0.,
-     1., 0.,
-
-     # back
-     .5, 1.,
-     0., 0.,
-     1., 0.,
-
-     # right
-     .5, 1.,
-     0., 0.,
-     1., 0.,
-
-     # left
-     .5, 1.,
-     0., 0.,
-     1., 0.,
-
-     # bottom
-     0., 1.,
-     1., 1.,
-     0., 0.,
-
-     0., 0.,
-     1., 1.,
-     1., 0.,
-]
-
-
-def calc_pyramid_norms(xyz):
-    def vec_sub(u, v):
-        return (u[0] - v[0], u[1] - v[1], u[2] - v[2])
-
-    def vec_cross(u, v):
-        return (
-             u[1]*v[2] - v[1]*u[2],
-            -u[0]*v[2] + v[0]*u[2],
-             u[0]*v[1] - v[0]*u[1])
-
-    it = iter(xyz)
-    vecs = [(x, next(it), next(it)) for x in it]
-
-    norms = []
-    it = iter(vecs)
-    for u in it:
-        v = next(it)
-        w = next(it)
-        norms.extend(vec_cross(vec_sub(u, v), vec_sub(u, w)) * 3)
-    return norms
-
-
-PYRAMID_VERT_NORM = calc_pyramid_norms(PYRAMID_VERT_XYZ)
+
+class TerrainLODConfig(object):
+
+    # camera scale beyond which every chunk is drawn as one baked quad
+    # instead of a cube per tile
+    ZOOM_THRESHOLD = 12.
+    # texture memory kept for baked chunks, least recently drawn go first
+    MEMORY_BUDGET = 8 * 1024 * 1024
+    # rgba of each tile type in the baked textures
+    TILE_COLORS = {
+        world.TileType.NONE: (0, 0, 0, 255),
+        world.TileType.WATER: (40, 80, 160, 255),
+        world.TileType.GRASS: (70, 130, 50, 255),
+        world.TileType.SAND: (200, 180, 120, 255),
+    }
+    BLOCKING_SHADE = .5
 
 
 class IsometricCamera(object):
@@ -275,100 +60,26 @@ class IsometricCamera(object):
             0., 1., 0.);
 
 
-def read_file(filename):
-    with open(filename, 'r') as file:
-        return file.read()
-
-
-class ShaderCache(object):
-
-    def __init__(self):
-        self.terrain_shaders = {}
-
-    def load_shader(self, vert_fname, frag_fname):
-        key = vert_fname + frag_fname
-        program = self.terrain_shaders.get(key)
-        if not program:
-            program = shader.Shader(
-                vertex_shader_source=read_file(vert_fname),
-                fragment_shader_source=read_file(frag_fname))
-        return program
-
-
-#def draw_cube(x, y, z, width, height, depth):
-#    glPushMatrix()
-#    glTranslatef(x, y, z)
-#    glScalef(width, height, depth)
-#    pyglet.graphics.draw(
-#        24, pyglet.gl.GL_QUADS,
-#        ('v3f', CUBE_VERT_XYZ),
-#        ('t2f', CUBE_VERT_UV),
-#        ('n3f', CUBE_VERT_NORM))
-#    glPopMatrix()
-
-
-def create_static_interleaved_vbo(verts, uvs, norms):
-    data = []
-    count = len(verts) / 3
-    vert_it = iter(verts)
-    uv_it = iter(uvs)
-    norm_it = iter(norms)
-    for i in range(count):
-        data.extend([
-            next(vert_it), next(vert_it), next(vert_it),
-            next(uv_it), next(uv_it),
-            next(norm_it), next(norm_it), next(norm_it)])
-    return create_static_vbo(data)
-
-
-def create_static_vbo(data):
-    #vbo_id = GLuint()
-    #glGenBuffers(1, vbo_id)
-    #glBindBuffer(GL_ARRAY_BUFFER, vbo_id)
-    #glBufferData(
-    #    GL_ARRAY_BUFFER,
-    #    len(data) * 4,
-    #    (GLfloat * len(data))(*data),
-    #    GL_STATIC_DRAW)
-    #return vbo_id
-    vbo = pyglet.graphics.vertexbuffer.create_buffer(
-        len(data) * 4,
-        target=GL_ARRAY_BUFFER,
-        usage=GL_STATIC_DRAW,
-        vbo=True)
-    vbo.set_data((GLfloat * len(data))(*data))
-    return vbo
-
-
 class InterleavedStaticVBO(object):
 
-    def __init__(self, xyz, uvs, norms):
-        data = []
-        count = len(xyz) // 3
-        xyz_it = iter(xyz)
-        uv_it = iter(uvs)
-        norm_it = iter(norms)
-        for i in range(count):
-            data.extend([
-                # xyz
-                next(xyz_it), next(xyz_it), next(xyz_it),
-                # uv
-                next(uv_it), next(uv_it),
-                # norm
-                next(norm_it), next(norm_it), next(norm_it)])
+    def __init__(self, source):
+        # mesh.Mesh, already interleaved xyz, uv, normal float32s
+        self.vertex_count = source.vertex_count
         self.vbo = pyglet.graphics.vertexbuffer.create_buffer(
-            len(data) * 4,
+            source.get_size(),
             target=GL_ARRAY_BUFFER,
             usage=GL_STATIC_DRAW,
             vbo=True)
-        self.vbo.set_data((GLfloat * len(data))(*data))
+        self.vbo.set_data(source.data)
 
-    def enable_state(self):
+    @staticmethod
+    def enable_state():
         glEnableClientState(GL_VERTEX_ARRAY)
         glEnableClientState(GL_NORMAL_ARRAY)
         glEnableClientState(GL_TEXTURE_COORD_ARRAY)
 
-    def disable_state(self):
+    @staticmethod
+    def disable_state():
         glDisableClientState(GL_VERTEX_ARRAY)
         glDisableClientState(GL_NORMAL_ARRAY)
         glDisableClientState(GL_TEXTURE_COORD_ARRAY)
@@ -383,99 +94,304 @@ class InterleavedStaticVBO(object):
     def unbind(self):
         self.vbo.unbind()
 
+    def draw(self):
+        glDrawArrays(GL_TRIANGLES, 0, self.vertex_count)
+
+    def delete(self):
+        self.vbo.delete()
+
 
-def load_texture_image(fname):
-    image = pyglet.image.load(fname)
-    tex = image.get_texture()
-    glBindTexture(tex.target, tex.id)
-    glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
-    glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
-    glBindTexture(tex.target, 0)
-    return image
+def upload_mesh(manager, asset):
+    asset.gpu_bytes = asset.data.get_size()
+    return InterleavedStaticVBO(asset.data)
+
+
+assets.LOADERS['mesh'] = (mesh.read_mesh, upload_mesh,
+                          InterleavedStaticVBO.delete)
+
+
+def acquire_terrain_textures(asset_manager):
+    # indexed by tile type, None for types without a texture
+    fnames = json.loads(assets.read_file('terrain_textures.json'))
+    textures = [None] * (max(value for name, value
+                             in vars(world.TileType).items()
+                             if name.isupper()) + 1)
+    for name, fname in fnames.items():
+        textures[getattr(world.TileType, name)] = (
+            asset_manager.acquire_texture(fname))
+    return textures
+
+
+def release_textures(asset_manager, textures):
+    for texture in textures:
+        if texture is not None:
+            asset_manager.release(texture)
+
+
+def get_texture_ids(textures):
+    # textures still loading draw untextured
+    return [texture.resource.id if texture and texture.resource else 0
+            for texture in textures]
+
+
+def get_tile_palette():
+    palette = np.zeros((256, 4), dtype=np.uint8)
+    palette[:, 3] = 255
+    for tile_type, color in TerrainLODConfig.TILE_COLORS.items():
+        palette[tile_type] = color
+    return palette
+
+
+def create_texture(texels, mag_filter=GL_NEAREST):
+    # rgba uint8 [height, width, 4] texels, returns the texture id
+    height, width = texels.shape[:2]
+    texture_id = GLuint()
+    glGenTextures(1, byref(texture_id))
+    glBindTexture(GL_TEXTURE_2D, texture_id)
+    glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
+    glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, mag_filter)
+    glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_EDGE)
+    glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP_TO_EDGE)
+    glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA, width, height, 0,
+                 GL_RGBA, GL_UNSIGNED_BYTE, texels.ctypes.data)
+    glBindTexture(GL_TEXTURE_2D, 0)
+    return texture_id.value
+
+
+def update_texture(texture_id, texels, x=0, y=0):
+    height, width = texels.shape[:2]
+    glBindTexture(GL_TEXTURE_2D, texture_id)
+    glTexSubImage2D(GL_TEXTURE_2D, 0, x, y, width, height,
+                    GL_RGBA, GL_UNSIGNED_BYTE, texels.ctypes.data)
+    glBindTexture(GL_TEXTURE_2D, 0)
+
+
+def delete_texture(texture_id):
+    glDeleteTextures(1, byref(GLuint(texture_id)))
+
+
+def draw_textured_quad(texture_id, x0, y0, x1, y1):
+    # screen space, texture row 0 at the top
+    glBindTexture(GL_TEXTURE_2D, texture_id)
+    glBegin(GL_QUADS)
+    glTexCoord2f(0., 1.)
+    glVertex2f(x0, y0)
+    glTexCoord2f(1., 1.)
+    glVertex2f(x1, y0)
+    glTexCoord2f(1., 0.)
+    glVertex2f(x1, y1)
+    glTexCoord2f(0., 0.)
+    glVertex2f(x0, y1)
+    glEnd()
+
+
+class ChunkTexture(object):
+
+    def __init__(self, texture_id, width, height, revision, vertices):
+        self.texture_id = texture_id
+        self.width = width
+        self.height = height
+        # terrain revision the texture was baked at
+        self.revision = revision
+        # the quad, interleaved for glInterleavedArrays(GL_T2F_V3F)
+        self.vertices = vertices
+
+    def get_size(self):
+        return self.width * self.height * 4
+
+
+class ChunkTextureCache(object):
+
+    # baked textures of terrain chunks, built by a chunkbuild.ChunkBuildPool
+    # off the main thread and uploaded within a budget per frame. chunks
+    # are rebuilt when their chunk revision moves past the one they were
+    # baked at and keep drawing the old texture until then, chunks not
+    # built yet aren't drawn. kept in least recently drawn order and
+    # trimmed down to the memory budget after each frame
+
+    def __init__(self, terrain, memory_budget=TerrainLODConfig.MEMORY_BUDGET,
+                 workers=chunkbuild.ChunkBuildConfig.WORKER_THREADS,
+                 upload_budget=chunkbuild.ChunkBuildConfig.UPLOAD_BUDGET):
+        self.terrain = terrain
+        self.memory_budget = memory_budget
+        self.upload_budget = upload_budget
+        self.palette = get_tile_palette()
+        self.pool = chunkbuild.ChunkBuildPool(self.build, workers)
+        self.chunks = collections.OrderedDict()
+        self.window = set()
+        self.texture_bytes = 0
+        self.bakes = 0
+        self.evictions = 0
+        # visible chunks that had nothing to draw in the last frame
+        self.missing = 0
+
+    def build(self, cx, cy):
+        return chunkbuild.build_chunk(self.terrain, cx, cy, self.palette,
+                                      TerrainLODConfig.BLOCKING_SHADE)
+
+    def update(self, cam_x, cam_y, tile_bounds):
+        # returns the visible chunks that can be drawn, in drawing order
+        visible, self.window, wanted = chunkbuild.get_chunk_window(
+            self.terrain, tile_bounds, cam_x, cam_y, self.chunks)
+        self.pool.request(wanted)
+        self.pool.upload(self.upload, self.window, self.upload_budget)
+        drawable = []
+        for key in visible:
+            chunk = self.chunks.get(key)
+            if chunk is not None:
+                self.chunks.move_to_end(key)
+                drawable.append(chunk)
+        self.missing = len(visible) - len(drawable)
+        return drawable
+
+    def upload(self, key, build):
+        chunk = self.chunks.get(key)
+        if chunk is not None and build.revision < chunk.revision:
+            return
+        texels = build.texels
+        height, width = texels.shape[:2]
+        if chunk is None:
+            chunk = ChunkTexture(create_texture(texels), width, height,
+                                 build.revision, build.vertices)
+            self.chunks[key] = chunk
+            self.texture_bytes += chunk.get_size()
+        else:
+            update_texture(chunk.texture_id, texels)
+            chunk.revision = build.revision
+            chunk.vertices = build.vertices
+        self.bakes += 1
+
+    def trim(self, in_use):
+        # the in_use most recently drawn chunks are kept regardless, and
+        # so is the prefetched window around them
+        for key in list(self.chunks):
+            if (self.texture_bytes <= self.memory_budget or
+                    len(self.chunks) <= in_use):
+                break
+            if key in self.window:
+                continue
+            self.delete(self.chunks.pop(key))
+            self.evictions += 1
+
+    def delete(self, chunk):
+        delete_texture(chunk.texture_id)
+        self.texture_bytes -= chunk.get_size()
+
+    def get_stats(self):
+        stats = self.pool.get_stats()
+        stats.update({
+            'chunks': len(self.chunks),
+            'texture_bytes': self.texture_bytes,
+            'bakes': self.bakes,
+            'evictions': self.evictions,
+            'missing': self.missing,
+        })
+        return stats
+
+    def close(self):
+        self.pool.close()
+        for chunk in self.chunks.values():
+            self.delete(chunk)
+        self.chunks.clear()
 
 
 class WorldRendering(object):
 
-    def __init__(self, shader_cache):
-        self.cube_vlist = vertex_list = pyglet.graphics.vertex_list(
-            36,
-            ('v3f', CUBE_VERT_XYZ),
-            ('t2f', CUBE_VERT_UV),
-            ('n3f', CUBE_VERT_NORM))
-        self.pyramid_vlist = vertex_list = pyglet.graphics.vertex_list(
-            18,
-            ('v3f', PYRAMID_VERT_XYZ),
-            ('t2f', PYRAMID_VERT_UV),
-            ('n3f', PYRAMID_VERT_NORM))
-        #self.cube_vbo = create_static_interleaved_vbo(
-        #    CUBE_VERT_XYZ, CUBE_VERT_UV, CUBE_VERT_NORM)
-        #self.pyramid_vbo = create_static_interleaved_vbo(
-        #    PYRAMID_VERT_XYZ, PYRAMID_VERT_UV, PYRAMID_VERT_NORM)
-        self.cube_vbo = InterleavedStaticVBO(
-            CUBE_VERT_XYZ, CUBE_VERT_UV, CUBE_VERT_NORM)
-        self.pyramid_vbo = InterleavedStaticVBO(
-            PYRAMID_VERT_XYZ, PYRAMID_VERT_UV, PYRAMID_VERT_NORM)
-
-        self.entity_shader = shader_cache.load_shader(
+    def __init__(self, asset_manager):
+        self.cube_mesh = asset_manager.acquire_mesh('cube.mesh')
+        self.pyramid_mesh = asset_manager.acquire_mesh('pyramid.mesh')
+        self.assets = asset_manager
+        self.entity_shader = asset_manager.acquire_shader(
             'entity.vp', 'entity.fp')
-        self.entity_models = json.loads(read_file('entity_models.json'))
-        for model in iter(self.entity_models.values()):
-            model['texture'] = load_texture_image(model['texture'])
-
-        self.terrain_shader = shader_cache.load_shader(
+        self.entity_models = asset_manager.acquire_models(
+            'entity_models.json')
+        self.terrain_shader = asset_manager.acquire_shader(
             'terrain.vp', 'terrain.fp')
-        self.terrain_textures = [
-            load_texture_image(fname)
-            for fname in json.loads(read_file('terrain_textures.json'))]
-
-    def draw_entities(self, ents):
+        self.terrain_textures = acquire_terrain_textures(asset_manager)
+
+    def close(self):
+        for asset in [self.cube_mesh, self.pyramid_mesh,
+                      self.entity_shader, self.entity_models,
+                      self.terrain_shader]:
+            self.assets.release(asset)
+        release_textures(self.assets, self.terrain_textures)
+
+    def draw_entities(self, ents, low_detail_ents=()):
+        # low detail entities are untextured cubes of the model size
+        if not (self.entity_models.is_ready() and
+                self.entity_shader.is_ready()):
+            return
+        models = self.entity_models.resource
         glEnable(GL_TEXTURE_2D)
-        self.cube_vbo.enable_state()
-        self.cube_vbo.bind()
-        self.entity_shader.bind()
+        InterleavedStaticVBO.enable_state()
+        self.entity_shader.resource.bind()
+        bound_vbo = None
         for ent in ents:
-            model = self.entity_models.get(ent.draw_model)
+            model = models.get(ent.draw_model)
             if model:
+                vbo = model['mesh'].resource
+                if vbo is None:
+                    continue
+                if vbo is not bound_vbo:
+                    vbo.bind()
+                    bound_vbo = vbo
                 size = model['size']
-                glBindTexture(
-                    GL_TEXTURE_2D, model['texture'].get_texture().id)
+                texture = model['texture'].resource
+                glBindTexture(GL_TEXTURE_2D, texture.id if texture else 0)
                 glPushMatrix()
                 glTranslatef(ent.x, .5 * size[1], ent.y)
                 glScalef(*size)
                 glRotatef(-ent.rotation * 180. / math.pi, 0., 1., 0.)
-                glDrawArrays(GL_TRIANGLES, 0, 36)
+                vbo.draw()
                 glPopMatrix()
-        self.entity_shader.unbind()
-        self.cube_vbo.unbind()
-        self.cube_vbo.disable_state()
+        if low_detail_ents and self.cube_mesh.is_ready():
+            vbo = self.cube_mesh.resource
+            vbo.bind()
+            bound_vbo = vbo
+            glBindTexture(GL_TEXTURE_2D, 0)
+            for ent in low_detail_ents:
+                model = models.get(ent.draw_model)
+                if model:
+                    size = model['size']
+                    glPushMatrix()
+                    glTranslatef(ent.x, .5 * size[1], ent.y)
+                    glScalef(*size)
+                    vbo.draw()
+                    glPopMatrix()
+        self.entity_shader.resource.unbind()
+        if bound_vbo:
+            bound_vbo.unbind()
+        InterleavedStaticVBO.disable_state()
         glDisable(GL_TEXTURE_2D)
 
     def draw_terrain_patch(self, wx, wy, tiles, width, height):
+        if not (self.terrain_shader.is_ready() and
+                self.cube_mesh.is_ready() and self.pyramid_mesh.is_ready()):
+            return
+        texture_ids = get_texture_ids(self.terrain_textures)
         x = 0
         y = 0
         glEnable(GL_TEXTURE_2D)
-        self.cube_vbo.enable_state()
-        self.cube_vbo.bind()
-        self.terrain_shader.bind()
+        InterleavedStaticVBO.enable_state()
+        self.cube_mesh.resource.bind()
+        self.terrain_shader.resource.bind()
         for tile in tiles:
-            glBindTexture(
-                GL_TEXTURE_2D, self.terrain_textures[tile].get_texture().id)
+            glBindTexture(GL_TEXTURE_2D, texture_ids[tile])
             self._draw_cube(wx + x, -.5, wy + y)
             x += 1
             if x >= width:
                 x = 0
                 y += 1
-        self.pyramid_vbo.bind()
-        glBindTexture(
-            GL_TEXTURE_2D, self.terrain_textures[0].get_texture().id)
+        self.pyramid_mesh.resource.bind()
+        glBindTexture(GL_TEXTURE_2D, texture_ids[world.TileType.GRASS])
         self._draw_pyramid(wx + width / 3., .5, wy + height / 3., .5, 1., .5)
         self._draw_pyramid(wx + width / 3., 1., wy + height / 3., .25, .5, .25)
         self._draw_pyramid(wx + width / 3., 1.25, wy + height / 3., .125, .25, .125)
         self._draw_pyramid(2 + wx + width / 3., .5, wy + height / 3., .5, 1., .5)
         self._draw_pyramid(2 + wx + width / 3., 1., wy + height / 3., .25, .5, .25)
         self._draw_pyramid(2 + wx + width / 3., 1.25, wy + height / 3., .125, .25, .125)
-        self.terrain_shader.unbind()
-        self.cube_vbo.disable_state()
+        self.terrain_shader.resource.unbind()
+        InterleavedStaticVBO.disable_state()
         glBindBuffer(GL_ARRAY_BUFFER, 0)
         glDisable(GL_TEXTURE_2D)
 
@@ -483,15 +399,13 @@ class WorldRendering(object):
         glPushMatrix()
         glTranslatef(x, y, z)
         glScalef(sx, sy, sz)
-        glDrawArrays(GL_TRIANGLES, 0, 18)
-        #self.pyramid_vlist.draw(GL_TRIANGLES)
+        self.pyramid_mesh.resource.draw()
         glPopMatrix()
 
     def _draw_cube(self, x, y, z):
         glPushMatrix()
         glTranslatef(x, y, z)
-        glDrawArrays(GL_TRIANGLES, 0, 36)
-        #self.cube_vlist.draw(GL_QUADS)
+        self.cube_mesh.resource.draw()
         glPopMatrix()
 
 
@@ -502,53 +416,198 @@ def rot_45(v):
     return ((x + y) / sqrt_2_over_two, (y - x) / sqrt_2_over_two)
 
 
+def get_tile_bounds(cam_x, cam_y, d, width, height):
+    # tiles around the camera that may be on screen, assumes the 45 degree
+    # isometric camera
+    tile_bl = rot_45((-d,  2. * math.sqrt(2.) * d))
+    tile_br = rot_45(( d,  2. * math.sqrt(2.) * d))
+    tile_tl = rot_45((-d, -2. * math.sqrt(2.) * d))
+    tile_tr = rot_45(( d, -2. * math.sqrt(2.) * d))
+
+    tile_min_x = max(0, int((cam_x + tile_tl[0] - .5) / TILE_SIZE))
+    tile_max_x = min(width, int((cam_x + tile_br[0] + .5) / TILE_SIZE))
+    tile_min_y = max(0, int((cam_y + tile_tr[1] - .5) / TILE_SIZE))
+    tile_max_y = min(height, int((cam_y + tile_bl[1] + .5) / TILE_SIZE))
+    return tile_min_x, tile_min_y, tile_max_x, tile_max_y
+
+
 class TerrainRendering(object):
 
-    def __init__(self, shader_cache):
-        self.shader = shader_cache.load_shader('terrain.vp', 'terrain.fp')
-        #self.atlas = load_texture_image('terrain_atlas.png')
-        #self.vbo = None
-        self.vbo = InterleavedStaticVBO(
-            CUBE_VERT_XYZ, CUBE_VERT_UV, CUBE_VERT_NORM)
-        self.textures = [
-            load_texture_image(fname)
-            for fname in json.loads(read_file('terrain_textures.json'))]
-
-    def draw_terrain(self, cam_x, cam_y, d, tiles, width, height):
-        # assumes 45 degree isometric camera
-        tile_bl = rot_45((-d,  2. * math.sqrt(2.) * d))
-        tile_br = rot_45(( d,  2. * math.sqrt(2.) * d))
-        tile_tl = rot_45((-d, -2. * math.sqrt(2.) * d))
-        tile_tr = rot_45(( d, -2. * math.sqrt(2.) * d))
-
-        tile_min_x = max(0, int((cam_x + tile_tl[0] - .5) / TILE_SIZE))
-        tile_max_x = min(width, int((cam_x + tile_br[0] + .5) / TILE_SIZE))
-        tile_min_y = max(0, int((cam_y + tile_tr[1] - .5) / TILE_SIZE))
-        tile_max_y = min(height, int((cam_y + tile_bl[1] + .5) / TILE_SIZE))
+    def __init__(self, asset_manager):
+        self.assets = asset_manager
+        self.shader = asset_manager.acquire_shader('terrain.vp', 'terrain.fp')
+        #self.atlas = asset_manager.acquire_texture('terrain_atlas.png')
+        self.mesh = asset_manager.acquire_mesh('cube.mesh')
+        self.textures = acquire_terrain_textures(asset_manager)
+        self.chunk_cache = None
+
+    def close(self):
+        for asset in [self.shader, self.mesh]:
+            self.assets.release(asset)
+        release_textures(self.assets, self.textures)
+        if self.chunk_cache:
+            self.chunk_cache.close()
+
+    def draw_terrain(self, cam_x, cam_y, d, terrain, view_extent=1.):
+        # only the share view_extent of the visible extent around the camera
+        # is drawn, the edges of the screen are left out
+        view_d = d * view_extent
+        if d > TerrainLODConfig.ZOOM_THRESHOLD:
+            self.draw_chunks(cam_x, cam_y, view_d, terrain)
+        else:
+            self.draw_tiles(cam_x, cam_y, view_d, terrain)
+
+    def draw_tiles(self, cam_x, cam_y, d, terrain):
+        tile_min_x, tile_min_y, tile_max_x, tile_max_y = get_tile_bounds(
+            cam_x, cam_y, d, terrain.width, terrain.height)
 
         min_x = -2. * d - 2. * TILE_SIZE
         max_x =  2. * d + 2. * TILE_SIZE
         min_y = -2. * math.sqrt(2.) * d - 2. * TILE_SIZE
         max_y =  2. * math.sqrt(2.) * d + 2. * TILE_SIZE
 
+        if not (self.shader.is_ready() and self.mesh.is_ready()):
+            return
+        vbo = self.mesh.resource
+        texture_ids = get_texture_ids(self.textures)
+        tiles = terrain.types[tile_min_y:tile_max_y,
+                              tile_min_x:tile_max_x].tolist()
         glEnable(GL_TEXTURE_2D)
-        self.vbo.enable_state()
-        self.vbo.bind()
-        self.shader.bind()
+        vbo.enable_state()
+        vbo.bind()
+        self.shader.resource.bind()
         for y in range(tile_min_y, tile_max_y):
             for x in range(tile_min_x, tile_max_x):
                 rot_tile = rot_45(((y - cam_y), -(x - cam_x)))
                 if (rot_tile[0] < min_x or rot_tile[0] > max_x or
                     rot_tile[1] < min_y or rot_tile[1] > max_y):
                     continue
-                glBindTexture(
-                    GL_TEXTURE_2D,
-                    self.textures[tiles[x + y * width]].get_texture().id)
+                glBindTexture(GL_TEXTURE_2D, texture_ids[
+                    tiles[y - tile_min_y][x - tile_min_x]])
                 glPushMatrix()
                 glTranslatef(x, -.5, y)
-                glDrawArrays(GL_TRIANGLES, 0, 36)
+                vbo.draw()
                 glPopMatrix()
-        self.shader.unbind()
-        self.vbo.disable_state()
+        self.shader.resource.unbind()
+        vbo.disable_state()
         glBindBuffer(GL_ARRAY_BUFFER, 0)
         glDisable(GL_TEXTURE_2D)
+
+    def draw_chunks(self, cam_x, cam_y, d, terrain):
+        # one quad per chunk at the height of the cube tops, the number of
+        # chunks on screen grows far slower than the number of tiles
+        if not self.shader.is_ready():
+            return
+        if self.chunk_cache is None or self.chunk_cache.terrain is not terrain:
+            if self.chunk_cache:
+                self.chunk_cache.close()
+            self.chunk_cache = ChunkTextureCache(terrain)
+        chunks = self.chunk_cache.update(cam_x, cam_y, get_tile_bounds(
+            cam_x, cam_y, d, terrain.width, terrain.height))
+        glEnable(GL_TEXTURE_2D)
+        self.shader.resource.bind()
+        glNormal3f(0., 1., 0.)
+        glPushClientAttrib(GL_CLIENT_VERTEX_ARRAY_BIT)
+        for chunk in chunks:
+            glBindTexture(GL_TEXTURE_2D, chunk.texture_id)
+            glInterleavedArrays(GL_T2F_V3F, 0, chunk.vertices.ctypes.data)
+            glDrawArrays(GL_QUADS, 0, 4)
+        glPopClientAttrib()
+        self.shader.resource.unbind()
+        glBindTexture(GL_TEXTURE_2D, 0)
+        glDisable(GL_TEXTURE_2D)
+        self.chunk_cache.trim(len(chunks))
+
+
+class MinimapRendering(object):
+
+    # the terrain image is only rebaked for chunks that changed, the unit
+    # heatmap is binned and uploaded a few times per second, so a frame
+    # costs two quads no matter how many units there are
+
+    def __init__(self, size=minimap.MinimapConfig.SIZE,
+                 margin=minimap.MinimapConfig.MARGIN,
+                 heat_interval=minimap.MinimapConfig.HEAT_INTERVAL):
+        self.size = size
+        self.margin = margin
+        self.heat_interval = heat_interval
+        self.palette = get_tile_palette()
+        self.terrain = None
+        self.terrain_texture = None
+        self.revision = -1
+        self.heat_texture = None
+        self.heat_time = None
+        self.chunk_updates = 0
+
+    def update_terrain(self, terrain):
+        if terrain is not self.terrain:
+            self.close()
+            self.terrain = terrain
+            texels = np.zeros((terrain.height, terrain.width, 4),
+                              dtype=np.uint8)
+            self.terrain_texture = create_texture(texels)
+            self.revision = -1
+        cxs, cys = terrain.changed_chunks(self.revision)
+        for cx, cy in zip(cxs.tolist(), cys.tolist()):
+            x0, y0, x1, y1 = terrain.chunk_bounds(cx, cy)
+            texels = chunkbuild.bake_chunk(
+                terrain, cx, cy, self.palette, TerrainLODConfig.BLOCKING_SHADE)
+            update_texture(self.terrain_texture, texels, x0, y0)
+        self.chunk_updates = len(cxs)
+        self.revision = terrain.revision
+
+    def update_heat(self, sim, now):
+        if self.heat_time is not None and (
+                now - self.heat_time < self.heat_interval):
+            return
+        self.heat_time = now
+        terrain = self.terrain
+        xs, ys, teams = sim.get_entity_arrays(('x', 'y', 'team'))
+        heatmap = minimap.get_heatmap(xs, ys, teams,
+                                      terrain.width, terrain.height)
+        if self.heat_texture is None:
+            self.heat_texture = create_texture(heatmap, GL_LINEAR)
+        else:
+            update_texture(self.heat_texture, heatmap)
+
+    def update(self, terrain, sim, now):
+        self.update_terrain(terrain)
+        self.update_heat(sim, now)
+
+    def draw(self, window_width, window_height, cam_x, cam_y, scale):
+        # in the top right corner of the hud projection, one pixel per unit
+        if self.terrain_texture is None:
+            return
+        terrain = self.terrain
+        x1 = window_width - self.margin
+        y1 = window_height - self.margin
+        x0 = x1 - self.size
+        y0 = y1 - self.size
+        glColor4f(1., 1., 1., 1.)
+        glEnable(GL_TEXTURE_2D)
+        draw_textured_quad(self.terrain_texture, x0, y0, x1, y1)
+        glEnable(GL_BLEND)
+        glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
+        if self.heat_texture is not None:
+            draw_textured_quad(self.heat_texture, x0, y0, x1, y1)
+        glBindTexture(GL_TEXTURE_2D, 0)
+        glDisable(GL_TEXTURE_2D)
+        # the part of the world around the camera
+        sx = self.size / float(terrain.width)
+        sy = self.size / float(terrain.height)
+        glBegin(GL_LINE_LOOP)
+        for dx, dy in ((-1., -1.), (1., -1.), (1., 1.), (-1., 1.)):
+            glVertex2f(x0 + (cam_x + dx * scale + .5) * sx,
+                       y1 - (cam_y + dy * scale + .5) * sy)
+        glEnd()
+        glDisable(GL_BLEND)
+
+    def close(self):
+        if self.terrain_texture is not None:
+            delete_texture(self.terrain_texture)
+        if self.heat_texture is not None:
+            delete_texture(self.heat_texture)
+        self.terrain = None
+        self.terrain_texture = None
+        self.heat_texture = None
+        self.heat_time = None
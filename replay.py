@@ -0,0 +1,229 @@
+# Copyright (c) 2014 Per Lindstrand
+
+import argparse
+import logging
+import logging.config
+import struct
+import sys
+import time
+import zlib
+
+import terrain
+import world
+
+LOG = logging.getLogger(__name__)
+
+MAGIC = b'BBRP'
+VERSION = 1
+CHECKSUM_INTERVAL = 30
+
+HEADER = struct.Struct('!4sHIHHH')
+RECORD_TYPE = struct.Struct('!B')
+SPAWN = struct.Struct('!BIddddIi')
+DESPAWN = struct.Struct('!I')
+TICK = struct.Struct('!dH')
+PLAYER_INPUT = struct.Struct('!IHd')
+CHECKSUM = struct.Struct('!II')
+AI_BUDGET = struct.Struct('!I')
+
+
+class RecordType(object):
+
+    SPAWN       = 1
+    DESPAWN     = 2
+    TICK        = 3
+    CHECKSUM    = 4
+    AI_BUDGET   = 5
+
+
+class SpawnKind(object):
+
+    ENTITY      = 0
+    PLAYER      = 1
+    ENEMY       = 2
+
+
+class MatchRecorder(object):
+
+    # the log is a zlib stream of records, each a type byte followed by a
+    # fixed struct, so it can be written incrementally while the match runs
+
+    def __init__(self, fileobj, seed, map_size=0,
+                 checksum_interval=CHECKSUM_INTERVAL):
+        self.fileobj = fileobj
+        self.compressor = zlib.compressobj()
+        self.checksum_interval = checksum_interval
+        self.tick = 0
+        self.write(HEADER.pack(
+            MAGIC, VERSION, seed, map_size, map_size, checksum_interval))
+
+    def write(self, data):
+        self.fileobj.write(self.compressor.compress(data))
+
+    def record_spawn(self, ent, kind=SpawnKind.ENTITY):
+        model = ent.draw_model.encode('ascii')
+        self.write(RECORD_TYPE.pack(RecordType.SPAWN))
+        self.write(SPAWN.pack(
+            kind, ent.id, ent.x, ent.y, ent.radius, ent.rotation,
+            ent.flags, ent.team))
+        self.write(struct.pack('!H', len(model)) + model)
+
+    def record_despawn(self, ent_id):
+        self.write(RECORD_TYPE.pack(RecordType.DESPAWN))
+        self.write(DESPAWN.pack(ent_id))
+
+    def record_tick(self, dt, players):
+        self.write(RECORD_TYPE.pack(RecordType.TICK))
+        self.write(TICK.pack(dt, len(players)))
+        self.write(b''.join(
+            PLAYER_INPUT.pack(
+                player.entity.id, player.action_flags,
+                player.entity.rotation)
+            for player in players))
+
+    def record_update(self, sim):
+        # call after every simulation update
+        self.tick += 1
+        if sim.ai.deferred:
+            # the AI ran out of time, the replay has to stop at the same
+            # decision no matter how fast it runs
+            self.write(RECORD_TYPE.pack(RecordType.AI_BUDGET))
+            self.write(AI_BUDGET.pack(sim.ai.decisions))
+        if self.tick % self.checksum_interval == 0:
+            self.write(RECORD_TYPE.pack(RecordType.CHECKSUM))
+            self.write(CHECKSUM.pack(self.tick, sim.compute_checksum()))
+            # keep the file replayable up to here if the server dies
+            self.fileobj.write(self.compressor.flush(zlib.Z_SYNC_FLUSH))
+            self.fileobj.flush()
+
+    def close(self):
+        self.fileobj.write(self.compressor.flush())
+        self.fileobj.close()
+
+
+class MatchReplay(object):
+
+    def __init__(self, fileobj):
+        # logs of crashed servers end in a truncated stream, replay as much
+        # of them as possible
+        self.data = zlib.decompressobj().decompress(fileobj.read())
+        self.offset = 0
+        (magic, version, self.seed, width, height,
+         self.checksum_interval) = self.read(HEADER)
+        if magic != MAGIC or version != VERSION:
+            raise RuntimeError('not a match log: %r %r' % (magic, version))
+        grid = None
+        if width and height:
+            grid = terrain.generate_random_grid(width, height, seed=self.seed)
+        self.sim = world.Simulation(grid)
+        self.sim.ai.tick_budget = None
+        self.players = {}
+        self.ticks = 0
+        self.sim_time = 0.
+        self.checksums = 0
+        self.mismatches = 0
+
+    def read(self, fmt):
+        values = fmt.unpack_from(self.data, self.offset)
+        self.offset += fmt.size
+        return values
+
+    def replay_spawn(self):
+        kind, ent_id, x, y, radius, rotation, flags, team = self.read(SPAWN)
+        length, = struct.unpack_from('!H', self.data, self.offset)
+        model = self.data[self.offset + 2:self.offset + 2 + length]
+        self.offset += 2 + length
+        kwargs = dict(radius=radius, rotation=rotation, flags=flags,
+                      draw_model=model.decode('ascii'), team=team)
+        if kind == SpawnKind.ENEMY:
+            ent = self.sim.spawn_enemy(x, y, **kwargs).entity
+        else:
+            ent = self.sim.spawn_entity(x, y, **kwargs)
+        if kind == SpawnKind.PLAYER:
+            player = world.Player(ent)
+            self.sim.add_player(player)
+            self.players[ent.id] = player
+        if ent.id != ent_id:
+            raise RuntimeError(
+                'replay diverged, spawned %d instead of %d' % (ent.id, ent_id))
+
+    def replay_tick(self):
+        dt, count = self.read(TICK)
+        for i in range(count):
+            ent_id, action_flags, rotation = self.read(PLAYER_INPUT)
+            player = self.players[ent_id]
+            player.action_flags = action_flags
+            player.set_rotation(rotation)
+        if (self.offset < len(self.data) and
+            ord(self.data[self.offset:self.offset + 1]) ==
+                RecordType.AI_BUDGET):
+            self.offset += RECORD_TYPE.size
+            self.sim.ai.decision_limit, = self.read(AI_BUDGET)
+        self.sim.update(dt)
+        self.ticks += 1
+        self.sim_time += dt
+
+    def replay_checksum(self, verify):
+        tick, checksum = self.read(CHECKSUM)
+        if not verify:
+            return
+        self.checksums += 1
+        actual = self.sim.compute_checksum()
+        if actual != checksum:
+            self.mismatches += 1
+            LOG.error('Checksum mismatch at tick %d: %08x != %08x',
+                      tick, actual, checksum)
+
+    def replay_record(self, verify):
+        record_type, = self.read(RECORD_TYPE)
+        if record_type == RecordType.TICK:
+            self.replay_tick()
+        elif record_type == RecordType.SPAWN:
+            self.replay_spawn()
+        elif record_type == RecordType.DESPAWN:
+            ent_id, = self.read(DESPAWN)
+            self.players.pop(ent_id, None)
+            self.sim.despawn_entity(ent_id)
+        elif record_type == RecordType.CHECKSUM:
+            self.replay_checksum(verify)
+        else:
+            raise RuntimeError('bad record type %d' % record_type)
+
+    def run(self, verify=True):
+        start = time.perf_counter()
+        size = len(self.data)
+        try:
+            while self.offset < size:
+                self.replay_record(verify)
+        except struct.error:
+            LOG.warning('Match log truncated after %d ticks', self.ticks)
+        wall_time = time.perf_counter() - start
+        return {
+            'ticks': self.ticks,
+            'sim_time': self.sim_time,
+            'wall_time': wall_time,
+            'speed': self.sim_time / wall_time if wall_time else 0.,
+            'checksums': self.checksums,
+            'mismatches': self.mismatches,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a recorded match')
+    parser.add_argument('log')
+    parser.add_argument('--no-verify', action='store_true')
+    args = parser.parse_args()
+    logging.config.fileConfig('logging.conf', disable_existing_loggers=False)
+
+    with open(args.log, 'rb') as fileobj:
+        match = MatchReplay(fileobj)
+    result = match.run(verify=not args.no_verify)
+    LOG.info('Replayed %d ticks (%.1f s) in %.2f s, %.1fx real time, '
+             '%d/%d checksums failed',
+             result['ticks'], result['sim_time'], result['wall_time'],
+             result['speed'], result['mismatches'], result['checksums'])
+    if result['mismatches']:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
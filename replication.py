@@ -0,0 +1,235 @@
+# Copyright (c) 2014 Per Lindstrand
+
+import logging
+import struct
+
+import numpy as np
+
+import world
+
+LOG = logging.getLogger(__name__)
+
+# a snapshot packet is the marker, the tick and then the entity records
+SNAPSHOT_MARKER = b'S'
+SNAPSHOT_HEADER = struct.Struct('!cI')
+ENTITY_RECORD = np.dtype([('id', '>u4'), ('x', '>f4'), ('y', '>f4'),
+                          ('rotation', '>f4')])
+REPLICATION_FIELDS = ('id', 'x', 'y', 'rotation')
+
+
+class ReplicationConfig(object):
+
+    # bytes per second a client starts at and the bounds of its rate
+    START_RATE = 16000.
+    MIN_RATE = 2000.
+    MAX_RATE = 128000.
+    # rate added per second while the link keeps up, and the factor it is
+    # cut by, at most once per round trip, when it doesn't
+    RATE_INCREASE = 8000.
+    RATE_DECREASE = .7
+    # loss above this, or an rtt this much over the lowest one seen, means
+    # the link is congested
+    LOSS_THRESHOLD = .02
+    RTT_INFLATION = 2.
+    RTT_SLACK = .02
+    # budget that can build up while nothing is sent, in seconds of rate
+    BURST = .1
+    # headers of ip, udp and the channel, on top of the payload
+    PACKET_OVERHEAD = 28 + 20
+    # priority per second of entities far away, growing towards
+    # NEAR_PRIORITY close to the player, and of the player's own unit
+    FAR_PRIORITY = 1.
+    NEAR_PRIORITY = 20.
+    DISTANCE_FALLOFF = 16.
+    OWN_PRIORITY = 1000.
+
+
+def get_records_per_packet(max_packet_size):
+    # what fits a channel packet after its header and the worst case
+    # growth of the compression
+    space = max_packet_size - 20 - 16 - SNAPSHOT_HEADER.size
+    return max(space // ENTITY_RECORD.itemsize, 1)
+
+
+def write_snapshot(tick, ids, xs, ys, rotations):
+    records = np.empty(len(ids), dtype=ENTITY_RECORD)
+    records['id'] = ids
+    records['x'] = xs
+    records['y'] = ys
+    records['rotation'] = rotations
+    return SNAPSHOT_HEADER.pack(SNAPSHOT_MARKER, tick) + records.tobytes()
+
+
+def read_snapshot(data):
+    # (tick, records) or None when the packet isn't a snapshot
+    if data[:1] != SNAPSHOT_MARKER or len(data) < SNAPSHOT_HEADER.size:
+        return None
+    marker, tick = SNAPSHOT_HEADER.unpack_from(data)
+    records = np.frombuffer(data, dtype=ENTITY_RECORD,
+                            offset=SNAPSHOT_HEADER.size)
+    return tick, records
+
+
+class SendRateController(object):
+
+    # additive increase, multiplicative decrease of a client's send rate
+    # driven by the loss and round trip of what it acked, and a token
+    # bucket turning the rate into a byte budget per tick
+
+    def __init__(self, rate=ReplicationConfig.START_RATE):
+        self.rate = rate
+        self.budget = 0.
+        self.min_rtt = None
+        self.last_decrease = None
+        self.decreases = 0
+
+    def on_feedback(self, now, dt, acked, lost, rtt):
+        # acked and lost are the packets the peer told about since the
+        # last call, rtt the smoothed round trip or 0 if unknown
+        config = ReplicationConfig
+        if rtt:
+            if self.min_rtt is None or rtt < self.min_rtt:
+                self.min_rtt = rtt
+        congested = False
+        if acked + lost and lost > config.LOSS_THRESHOLD * (acked + lost):
+            congested = True
+        elif rtt and rtt > (self.min_rtt * config.RTT_INFLATION +
+                            config.RTT_SLACK):
+            congested = True
+        if congested:
+            # the loss of one round trip is one congestion event
+            if (self.last_decrease is None or
+                    now - self.last_decrease >= max(rtt, dt)):
+                self.rate *= config.RATE_DECREASE
+                self.last_decrease = now
+                self.decreases += 1
+        elif acked:
+            self.rate += config.RATE_INCREASE * dt
+        self.rate = min(max(self.rate, config.MIN_RATE), config.MAX_RATE)
+
+    def refill(self, dt):
+        self.budget = min(self.budget + self.rate * dt,
+                          self.rate * ReplicationConfig.BURST)
+
+    def spend(self, size):
+        self.budget -= size
+
+
+class PriorityAccumulator(object):
+
+    # priority per entity index that grows every tick the entity isn't
+    # sent, faster the closer it is to the player, and drops to 0 when it
+    # is sent. entities the budget doesn't cover get their turn later
+    # instead of never
+
+    def __init__(self):
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.priority = np.zeros(0)
+
+    def ensure_capacity(self, count):
+        capacity = self.ids.size
+        if count <= capacity:
+            return
+        while capacity < count:
+            capacity = max(1024, capacity * 2)
+        ids = np.zeros(capacity, dtype=np.int64)
+        ids[:self.ids.size] = self.ids
+        priority = np.zeros(capacity)
+        priority[:self.priority.size] = self.priority
+        self.ids = ids
+        self.priority = priority
+
+    def accumulate(self, ids, xs, ys, own_id, own_x, own_y, dt):
+        # returns the entity indices, for select() and mark_sent()
+        config = ReplicationConfig
+        indices = (ids & world.EntityAllocator.INDEX_MASK).astype(np.intp)
+        if indices.size:
+            self.ensure_capacity(int(indices.max()) + 1)
+        fresh = self.ids[indices] != ids
+        self.ids[indices] = ids
+        self.priority[indices[fresh]] = 0.
+        dxs = xs - own_x
+        dys = ys - own_y
+        near = (dxs * dxs + dys * dys) / (
+            config.DISTANCE_FALLOFF * config.DISTANCE_FALLOFF)
+        weights = config.FAR_PRIORITY + (
+            config.NEAR_PRIORITY - config.FAR_PRIORITY) / (1. + near)
+        weights[ids == own_id] = config.OWN_PRIORITY
+        self.priority[indices] += weights * dt
+        return indices
+
+    def select(self, indices, count):
+        # positions in indices of the count highest priorities, highest
+        # first
+        priority = self.priority[indices]
+        if count <= 0:
+            return np.zeros(0, dtype=np.intp)
+        if count < priority.size:
+            top = np.argpartition(-priority, count - 1)[:count]
+            return top[np.argsort(-priority[top], kind='stable')]
+        return np.argsort(-priority, kind='stable')
+
+    def mark_sent(self, indices):
+        self.priority[indices] = 0.
+
+
+class ClientReplication(object):
+
+    # what one client gets sent: its rate controller, its priorities and
+    # the channel counters the last feedback was taken at
+
+    def __init__(self, chn):
+        self.chn = chn
+        self.controller = SendRateController()
+        self.priorities = PriorityAccumulator()
+        self.acked = chn.packets_acked
+        self.lost = chn.packets_lost
+        self.records_per_packet = get_records_per_packet(chn.MAX_PACKET_SIZE)
+        # counters of the last update
+        self.sent = 0
+        self.packets = 0
+
+    def update(self, now, dt, tick, arrays, own_ent):
+        chn = self.chn
+        controller = self.controller
+        acked = chn.packets_acked - self.acked
+        lost = chn.packets_lost - self.lost
+        self.acked = chn.packets_acked
+        self.lost = chn.packets_lost
+        controller.on_feedback(now, dt, acked, lost, chn.stats.srtt or 0.)
+        controller.refill(dt)
+
+        ids, xs, ys, rotations = arrays
+        if own_ent is not None:
+            own_id, own_x, own_y = own_ent.id, own_ent.x, own_ent.y
+        else:
+            own_id, own_x, own_y = -1, 0., 0.
+        priorities = self.priorities
+        indices = priorities.accumulate(
+            ids, xs, ys, own_id, own_x, own_y, dt)
+
+        # greedy, whole packets of the highest priorities while the budget
+        # lasts, the last one only as full as the budget allows. what still
+        # waits in the outbox is held against the budget, so a socket that
+        # doesn't keep up slows the sending down like a full link would
+        budget = controller.budget - chn.outbox_bytes
+        per_packet = self.records_per_packet
+        record_size = ENTITY_RECORD.itemsize
+        overhead = ReplicationConfig.PACKET_OVERHEAD + SNAPSHOT_HEADER.size
+        full_packets = max(int(budget //
+                               (overhead + per_packet * record_size)), 0)
+        rest = budget - full_packets * (
+            overhead + per_packet * record_size)
+        count = full_packets * per_packet + max(
+            int((rest - overhead) // record_size), 0)
+        order = priorities.select(indices, min(count, len(ids)))
+        self.sent = len(order)
+        self.packets = 0
+        for start in range(0, len(order), per_packet):
+            chunk = order[start:start + per_packet]
+            payload = write_snapshot(tick, ids[chunk], xs[chunk], ys[chunk],
+                                     rotations[chunk])
+            chn.send_packet(payload, 'snapshot')
+            controller.spend(len(payload) + ReplicationConfig.PACKET_OVERHEAD)
+            self.packets += 1
+        priorities.mark_sent(indices[order])
@@ -1,58 +1,119 @@
 # Copyright (c) 2014 Per Lindstrand
 
+import argparse
 import logging
 import logging.config
+import random
 import socket
 import select
+import time
+
+import asynclog
+import match
 import networking
+import profiler
+import replay
 
 LOG = logging.getLogger(__name__)
 
+STATS_PORT = 9010
+STATS_LOG_INTERVAL = 60.
+TOP_CLIENTS = 5
+
+
+def log_network_stats(clients):
+    if not clients:
+        return
+    total = networking.aggregate_stats(clients.values())
+    LOG.info('%d clients, out %.1f kB/s, in %.1f kB/s, loss %.1f%%, '
+             'rtt mean %.1f ms max %.1f ms', total['channels'],
+             total['send_rate'] / 1000., total['recv_rate'] / 1000.,
+             total['loss_rate'] * 100., total['rtt_mean'] * 1000.,
+             total['rtt_max'] * 1000.)
+    top = sorted(clients.items(), key=lambda item: -item[1].get_stats()[
+        'send_rate'])[:TOP_CLIENTS]
+    for addr, chn in top:
+        stats = chn.get_stats()
+        LOG.info('  %s:%d out %.1f kB/s, loss %.1f%%, rtt %.1f ms, %r',
+                 addr[0], addr[1], stats['send_rate'] / 1000.,
+                 stats['loss_rate'] * 100., stats['rtt'] * 1000.,
+                 stats['bytes_by_kind'])
+
+
 def main():
+    parser = argparse.ArgumentParser(description='Big Battle server')
+    parser.add_argument('--record', metavar='FILE',
+                        help='record the match for replay.py')
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--no-profile', dest='profile', action='store_false',
+                        help='disable the tick phase profiler')
+    parser.add_argument('--stats-port', type=int, default=STATS_PORT,
+                        help='local UDP port answering with profiler stats')
+    args = parser.parse_args()
+
     logging.config.fileConfig('logging.conf', disable_existing_loggers=False)
+    log_writer = asynclog.AsyncLogging()
+    log_writer.start()
 
-    clients = {}
+    seed = args.seed
+    if seed is None:
+        seed = random.randrange(1 << 32)
+    random.seed(seed)
+    LOG.info('Match seed %d', seed)
+
+    recorder = None
+    if args.record:
+        recorder = replay.MatchRecorder(open(args.record, 'wb'), seed)
 
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     sock.bind(('0.0.0.0', 9009))
 
-    while True:
-        try:
-            # check if there's anything on the socket
-            readable, _, _ = select.select([sock], [], [], 0)
-            if readable:
-                data, addr = sock.recvfrom(1024)
-                if data:
-                    chn = clients.get(addr)
-                    if not chn:
-                        chn = networking.Channel(sock, addr)
-                        clients[addr] = chn
-                    chn.on_data_received(data)
-                else:
-                    # client disconnected
-                    if addr in clients:
-                        del clients[addr]
-
-            # handle packets
-            for addr, chn in clients.items():
-                packet = chn.recv_packet()
-                if packet:
-                    print(addr, 'sent', packet)
-                    chn.send_packet(packet)
-                    # parse!
-
-            # check if the socket is writable
-            _, writable, _ = select.select([], [sock], [], 0)
-            if writable:
-                removed_clients = []
-                for addr, chn in clients.items():
-                    if not chn.send_data():
-                        removed_clients.append(addr)
-                for addr in removed_clients:
-                    LOG.info('Client %r disconnected', addr)
-                    del clients[addr]
-        except socket.error:
-            LOG.exception('Socket error')
+    prof = profiler.Profiler() if args.profile else profiler.NULL_PROFILER
+    game = match.Match(sock, seed, recorder=recorder, prof=prof)
+    stats_server = None
+    if args.profile and args.stats_port:
+        stats_server = profiler.StatsServer(
+            prof, args.stats_port, extra_stats=game.get_network_stats)
+
+    next_summary = time.time() + STATS_LOG_INTERVAL
+    try:
+        while True:
+            try:
+                # wait for the socket until the next tick or timer is due
+                readable, _, _ = select.select(
+                    [sock], [], [], game.get_timeout(time.time()))
+                start = prof.start()
+                if readable:
+                    data, addr = sock.recvfrom(1024)
+                    game.on_datagram(addr, data)
+                prof.stop('server.input_ns', start)
+
+                # handle packets, fire timers and run the simulation at a
+                # fixed rate
+                game.handle_packets()
+                now = time.time()
+                game.timers.advance(now)
+                game.tick(now)
+
+                # check if the socket is writable
+                _, writable, _ = select.select([], [sock], [], 0)
+                if writable:
+                    game.send()
+
+                if stats_server:
+                    stats_server.poll()
+                log_writer.flush(now)
+                if now >= next_summary:
+                    prof.log_summary()
+                    log_network_stats(game.clients)
+                    next_summary = now + STATS_LOG_INTERVAL
+            except socket.error:
+                LOG.exception('Socket error')
+    finally:
+        game.close()
+        if stats_server:
+            stats_server.close()
+        log_writer.stop()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,83 @@
+# Copyright (c) 2014 Per Lindstrand
+
+import logging
+import math
+
+import numpy as np
+
+LOG = logging.getLogger(__name__)
+
+
+class SpatialGrid(object):
+
+    # uniform grid rebuilt from scratch every tick, items are sorted by
+    # cell so every cell is a contiguous run of the order array
+
+    def __init__(self, cell_size):
+        self.cell_size = float(cell_size)
+        self.origin_x = 0.
+        self.origin_y = 0.
+        self.cells_x = 0
+        self.cells_y = 0
+        self.order = np.zeros(0, dtype=np.intp)
+        self.starts = np.zeros(0, dtype=np.intp)
+        self.counts = np.zeros(0, dtype=np.intp)
+
+    def build(self, xs, ys):
+        xs = np.asarray(xs, dtype=np.float64)
+        ys = np.asarray(ys, dtype=np.float64)
+        if not xs.size:
+            self.cells_x = self.cells_y = 0
+            self.order = np.zeros(0, dtype=np.intp)
+            self.starts = self.counts = np.zeros(0, dtype=np.intp)
+            return
+        self.origin_x = float(xs.min())
+        self.origin_y = float(ys.min())
+        cxs = ((xs - self.origin_x) / self.cell_size).astype(np.intp)
+        cys = ((ys - self.origin_y) / self.cell_size).astype(np.intp)
+        self.cells_x = int(cxs.max()) + 1
+        self.cells_y = int(cys.max()) + 1
+        cell_ids = cxs + cys * self.cells_x
+        self.order = np.argsort(cell_ids, kind='stable')
+        self.counts = np.bincount(
+            cell_ids, minlength=self.cells_x * self.cells_y)
+        self.starts = np.cumsum(self.counts) - self.counts
+
+    def query_pairs(self, qxs, qys, radius):
+        # candidate (query index, item index) pairs for all items in the
+        # cells overlapping each query circle, callers do the exact test
+        qxs = np.asarray(qxs, dtype=np.float64)
+        qys = np.asarray(qys, dtype=np.float64)
+        empty = np.zeros(0, dtype=np.intp)
+        if not qxs.size or not self.cells_x:
+            return empty, empty
+        reach = int(math.ceil(radius / self.cell_size))
+        qcx = np.floor((qxs - self.origin_x) / self.cell_size).astype(np.intp)
+        qcy = np.floor((qys - self.origin_y) / self.cell_size).astype(np.intp)
+        queries = np.arange(qxs.size)
+        pair_queries = []
+        pair_starts = []
+        pair_counts = []
+        for oy in range(-reach, reach + 1):
+            cy = qcy + oy
+            valid_y = (cy >= 0) & (cy < self.cells_y)
+            for ox in range(-reach, reach + 1):
+                cx = qcx + ox
+                valid = valid_y & (cx >= 0) & (cx < self.cells_x)
+                cell_ids = cx[valid] + cy[valid] * self.cells_x
+                counts = self.counts[cell_ids]
+                hit = counts > 0
+                pair_queries.append(queries[valid][hit])
+                pair_starts.append(self.starts[cell_ids[hit]])
+                pair_counts.append(counts[hit])
+        pair_queries = np.concatenate(pair_queries)
+        pair_starts = np.concatenate(pair_starts)
+        pair_counts = np.concatenate(pair_counts)
+        total = int(pair_counts.sum())
+        if not total:
+            return empty, empty
+        # expand every (query, cell) run into one pair per item
+        run_offsets = np.cumsum(pair_counts) - pair_counts
+        within = np.arange(total) - np.repeat(run_offsets, pair_counts)
+        items = self.order[np.repeat(pair_starts, pair_counts) + within]
+        return np.repeat(pair_queries, pair_counts), items
@@ -0,0 +1,211 @@
+# Copyright (c) 2014 Per Lindstrand
+
+import logging
+
+import numpy as np
+
+import spatial
+import world
+
+LOG = logging.getLogger(__name__)
+
+
+class SteeringConfig(object):
+
+    # as big as the neighbour radius, so a query looks at 3x3 cells
+    GRID_CELL_SIZE = 1.5
+    NEIGHBOR_RADIUS = 1.5
+    # closest neighbours looked at per unit, bounds the work in a crowd
+    MAX_NEIGHBORS = 8
+    # speed a unit is pushed away from a neighbour it overlaps completely,
+    # falling off to 0 at the neighbour radius
+    SEPARATION_SPEED = 6.
+    # share of the difference to the neighbours' mean velocity taken on
+    ALIGNMENT_WEIGHT = .3
+    # units with a goal head for it at full speed and slow down inside
+    # the arrival radius
+    ARRIVAL_SPEED = 3.
+    ARRIVAL_RADIUS = 2.
+    MAX_SPEED = 4.
+
+
+def get_nearest_pairs(qi, dist_sq, radius, cap):
+    # positions of the pairs of the cap closest neighbours of every query,
+    # sorted by query and then distance in one go: the distance is below
+    # the radius, so scaled down it fits between two query numbers
+    order = np.argsort(qi + dist_sq * (.5 / (radius * radius)))
+    qi = qi[order]
+    first = np.ones(qi.size, dtype=bool)
+    first[1:] = qi[1:] != qi[:-1]
+    starts = np.flatnonzero(first)
+    counts = np.diff(np.append(starts, qi.size))
+    rank = np.arange(qi.size) - np.repeat(starts, counts)
+    return order[rank < cap]
+
+
+class SteeringSystem(object):
+
+    # separation, alignment and arrival for crowds, added to the
+    # acceleration of the units before Entity.update integrates it. the
+    # friction of Entity.update wipes the velocity every tick, so an
+    # acceleration acts as a velocity of acc * dt and the forces are
+    # worked out as velocities. per entity state lives in arrays indexed
+    # by the index part of the entity id, like CombatSystem
+
+    def __init__(self, cell_size=SteeringConfig.GRID_CELL_SIZE,
+                 max_neighbors=SteeringConfig.MAX_NEIGHBORS):
+        self.grid = spatial.SpatialGrid(cell_size)
+        self.max_neighbors = max_neighbors
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.last_x = np.zeros(0)
+        self.last_y = np.zeros(0)
+        # what the last update added and the acceleration it left behind,
+        # to take it out again unless the ai has set a new one since
+        self.added_x = np.zeros(0)
+        self.added_y = np.zeros(0)
+        self.written_x = np.zeros(0)
+        self.written_y = np.zeros(0)
+        self.goal_x = np.zeros(0)
+        self.goal_y = np.zeros(0)
+        self.goal_ids = np.zeros(0, dtype=np.int64)
+        # counters of the last update
+        self.steered = 0
+        self.pairs = 0
+
+    def ensure_capacity(self, count):
+        capacity = self.ids.size
+        if count <= capacity:
+            return
+        while capacity < count:
+            capacity = max(1024, capacity * 2)
+        for name in ('ids', 'last_x', 'last_y', 'added_x', 'added_y',
+                     'written_x', 'written_y', 'goal_x', 'goal_y',
+                     'goal_ids'):
+            array = getattr(self, name)
+            grown = np.zeros(capacity, dtype=array.dtype)
+            grown[:array.size] = array
+            setattr(self, name, grown)
+
+    def set_goals(self, ids, goal_xs, goal_ys):
+        ids = np.asarray(ids, dtype=np.int64)
+        indices = (ids & world.EntityAllocator.INDEX_MASK).astype(np.intp)
+        if indices.size:
+            self.ensure_capacity(int(indices.max()) + 1)
+        self.goal_x[indices] = goal_xs
+        self.goal_y[indices] = goal_ys
+        self.goal_ids[indices] = ids
+
+    def clear_goals(self, ids):
+        ids = np.asarray(ids, dtype=np.int64)
+        indices = (ids & world.EntityAllocator.INDEX_MASK).astype(np.intp)
+        indices = indices[indices < self.goal_ids.size]
+        self.goal_ids[indices] = 0
+
+    def update(self, dt, ids, xs, ys, acc_xs, acc_ys, steerable):
+        # returns the new acceleration of every entity
+        ids = np.asarray(ids, dtype=np.int64)
+        indices = (ids & world.EntityAllocator.INDEX_MASK).astype(np.intp)
+        if indices.size:
+            self.ensure_capacity(int(indices.max()) + 1)
+        known = self.ids[indices] == ids
+        vel_xs = np.where(known, (xs - self.last_x[indices]) / dt, 0.)
+        vel_ys = np.where(known, (ys - self.last_y[indices]) / dt, 0.)
+        ours = (known & (acc_xs == self.written_x[indices]) &
+                (acc_ys == self.written_y[indices]))
+        base_xs = np.where(ours, acc_xs - self.added_x[indices], acc_xs)
+        base_ys = np.where(ours, acc_ys - self.added_y[indices], acc_ys)
+
+        steer_xs = np.zeros(ids.size)
+        steer_ys = np.zeros(ids.size)
+        units = np.flatnonzero(steerable)
+        self.steered = units.size
+        self.pairs = 0
+        if units.size:
+            self.steer(units, xs[units], ys[units], vel_xs[units],
+                       vel_ys[units], indices[units], ids[units],
+                       steer_xs, steer_ys)
+
+        # the friction makes acc * dt the velocity
+        add_xs = steer_xs / dt
+        add_ys = steer_ys / dt
+        new_xs = base_xs + add_xs
+        new_ys = base_ys + add_ys
+        self.ids[indices] = ids
+        self.last_x[indices] = xs
+        self.last_y[indices] = ys
+        self.added_x[indices] = add_xs
+        self.added_y[indices] = add_ys
+        self.written_x[indices] = new_xs
+        self.written_y[indices] = new_ys
+        return new_xs, new_ys
+
+    def steer(self, units, xs, ys, vel_xs, vel_ys, indices, ids, steer_xs,
+              steer_ys):
+        config = SteeringConfig
+        count = units.size
+        radius = config.NEIGHBOR_RADIUS
+        self.grid.build(xs, ys)
+        qi, ni = self.grid.query_pairs(xs, ys, radius)
+        dx = xs[qi] - xs[ni]
+        dy = ys[qi] - ys[ni]
+        dist_sq = dx * dx + dy * dy
+        near = np.flatnonzero((dist_sq < radius * radius) & (qi != ni))
+        qi = qi[near]
+        ni = ni[near]
+        dist_sq = dist_sq[near]
+        if qi.size and np.bincount(qi).max() > self.max_neighbors:
+            keep = get_nearest_pairs(qi, dist_sq, radius, self.max_neighbors)
+            qi = qi[keep]
+            ni = ni[keep]
+            dist_sq = dist_sq[keep]
+        # fewer pairs left, cheaper to look the offsets up again than to
+        # carry them through the filtering
+        dx = xs[qi] - xs[ni]
+        dy = ys[qi] - ys[ni]
+        self.pairs = qi.size
+
+        # separation, away from every neighbour and harder the closer it
+        # is. units on the same spot part in a direction picked by the
+        # lower of their positions, opposite for the two of them
+        dist = np.sqrt(dist_sq)
+        same = np.flatnonzero(dist < 1e-9)
+        if same.size:
+            angle = np.minimum(qi[same], ni[same]) * 2.399963
+            side = np.where(qi[same] < ni[same], 1., -1.)
+            dx[same] = np.cos(angle) * side
+            dy[same] = np.sin(angle) * side
+            dist[same] = 1.
+        push = config.SEPARATION_SPEED * (1. - dist / radius) / dist
+        sep_xs = np.bincount(qi, dx * push, count)
+        sep_ys = np.bincount(qi, dy * push, count)
+
+        # alignment, towards the mean velocity of the neighbours
+        neighbors = np.bincount(qi, minlength=count)
+        has_neighbors = neighbors > 0
+        mean_xs = np.bincount(qi, vel_xs[ni], count)
+        mean_ys = np.bincount(qi, vel_ys[ni], count)
+        mean_xs[has_neighbors] /= neighbors[has_neighbors]
+        mean_ys[has_neighbors] /= neighbors[has_neighbors]
+        weight = config.ALIGNMENT_WEIGHT * has_neighbors
+        align_xs = (mean_xs - vel_xs) * weight
+        align_ys = (mean_ys - vel_ys) * weight
+
+        # arrival, full speed towards the goal until close to it
+        has_goal = self.goal_ids[indices] == ids
+        goal_dx = np.where(has_goal, self.goal_x[indices] - xs, 0.)
+        goal_dy = np.where(has_goal, self.goal_y[indices] - ys, 0.)
+        goal_dist = np.sqrt(goal_dx * goal_dx + goal_dy * goal_dy)
+        speed = config.ARRIVAL_SPEED * np.minimum(
+            goal_dist / config.ARRIVAL_RADIUS, 1.)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scale = np.where(goal_dist > 0., speed / goal_dist, 0.)
+
+        total_xs = sep_xs + align_xs + goal_dx * scale
+        total_ys = sep_ys + align_ys + goal_dy * scale
+        total = np.sqrt(total_xs * total_xs + total_ys * total_ys)
+        too_fast = total > config.MAX_SPEED
+        clamp = config.MAX_SPEED / total[too_fast]
+        total_xs[too_fast] *= clamp
+        total_ys[too_fast] *= clamp
+        steer_xs[units] = total_xs
+        steer_ys[units] = total_ys
@@ -0,0 +1,559 @@
+# Copyright (c) 2014 Per Lindstrand
+
+import argparse
+import logging
+import logging.config
+import multiprocessing
+import multiprocessing.connection
+import os
+import random
+import socket
+import time
+
+import asynclog
+import match
+import networking
+import profiler
+
+LOG = logging.getLogger(__name__)
+
+PORT = 9009
+STATS_PORT = 9010
+STATS_LOG_INTERVAL = 60.
+
+
+class SupervisorConfig(object):
+
+    # matches a worker hosts at once, new matches go to the least busy
+    # worker that has room
+    MATCHES_PER_WORKER = 8
+    # clients joining are put in the newest match that has room
+    CLIENTS_PER_MATCH = 16
+    # a worker is replaced once it has hosted this many matches and runs
+    # none, so long running processes don't hold on to fragmented memory
+    RECYCLE_AFTER = 64
+    # sessions not heard from for this long are dropped
+    SESSION_TIMEOUT = 30.
+    # matches that had no clients for this long are stopped
+    MATCH_IDLE_TIMEOUT = 60.
+    # seconds between the load reports of the workers
+    LOAD_INTERVAL = 1.
+
+
+class MessageType(object):
+
+    # supervisor -> worker
+    START       = 0
+    STOP        = 1
+    DATAGRAMS   = 2
+    LEAVE       = 3
+    QUIT        = 4
+    # worker -> supervisor
+    LOAD        = 5
+    ENDED       = 6
+
+
+class DatagramSink(object):
+
+    # stands in for the socket of the channels in a worker, the datagrams
+    # go back to the supervisor which owns the real socket
+
+    def __init__(self):
+        self.datagrams = []
+
+    def sendto(self, data, session):
+        self.datagrams.append((session, data))
+        return len(data)
+
+    def take_all(self):
+        datagrams = self.datagrams
+        self.datagrams = []
+        return datagrams
+
+
+class Worker(object):
+
+    # runs in its own process and hosts a few matches, everything it gets
+    # and sends goes through the pipe to the supervisor
+
+    def __init__(self, worker_id, conn, log_writer):
+        self.worker_id = worker_id
+        self.conn = conn
+        # asynclog.AsyncLogging of the process, its summaries are flushed
+        # from the loop
+        self.log_writer = log_writer
+        self.sink = DatagramSink()
+        self.matches = {}
+        # match id -> time the match ends, for bot matches with a duration
+        self.end_times = {}
+        self.next_report = time.time() + SupervisorConfig.LOAD_INTERVAL
+        self.running = True
+
+    def start_match(self, match_id, options):
+        game = match.Match(self.sink, options.get('seed'),
+                           options.get('tick_rate', match.TICK_RATE))
+        game.add_bots(options.get('bots', 0), options.get('enemies', 0))
+        self.matches[match_id] = game
+        if options.get('duration'):
+            self.end_times[match_id] = time.time() + options['duration']
+
+    def stop_match(self, match_id, now):
+        game = self.matches.pop(match_id, None)
+        self.end_times.pop(match_id, None)
+        if game is None:
+            return
+        load = game.get_load(now)
+        load['simulate_time'] = game.simulate_time
+        game.close()
+        self.conn.send((MessageType.ENDED, match_id, load))
+
+    def handle_message(self, message):
+        kind = message[0]
+        if kind == MessageType.DATAGRAMS:
+            for match_id, session, data in message[1]:
+                game = self.matches.get(match_id)
+                if game:
+                    game.on_datagram(session, data, session)
+        elif kind == MessageType.START:
+            self.start_match(message[1], message[2])
+        elif kind == MessageType.LEAVE:
+            game = self.matches.get(message[1])
+            if game and message[2] in game.clients:
+                game.remove_client(message[2])
+        elif kind == MessageType.STOP:
+            self.stop_match(message[1], time.time())
+        elif kind == MessageType.QUIT:
+            self.running = False
+
+    def get_timeout(self, now):
+        timeouts = [game.get_timeout(now) for game in self.matches.values()]
+        return min(timeouts + [max(self.next_report - now, 0.)])
+
+    def run(self):
+        conn = self.conn
+        while self.running:
+            if conn.poll(self.get_timeout(time.time())):
+                while self.running and conn.poll():
+                    self.handle_message(conn.recv())
+            now = time.time()
+            for match_id, game in self.matches.items():
+                game.update(now)
+            datagrams = self.sink.take_all()
+            if datagrams:
+                conn.send((MessageType.DATAGRAMS, datagrams))
+            for match_id, end_time in list(self.end_times.items()):
+                if now >= end_time:
+                    self.stop_match(match_id, now)
+            self.log_writer.flush(now)
+            if now >= self.next_report:
+                conn.send((MessageType.LOAD, dict(
+                    (match_id, game.get_load(now))
+                    for match_id, game in self.matches.items())))
+                self.next_report = now + SupervisorConfig.LOAD_INTERVAL
+        for match_id in list(self.matches):
+            self.stop_match(match_id, time.time())
+
+
+def run_worker(worker_id, conn, cpu=None):
+    # process entry point, pinned to one core so the matches of different
+    # workers don't fight over the same one
+    if cpu is not None and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, [cpu])
+    # the logging thread is started after the fork, threads don't survive
+    # it
+    log_writer = asynclog.AsyncLogging()
+    log_writer.start()
+    try:
+        Worker(worker_id, conn, log_writer).run()
+    except (EOFError, KeyboardInterrupt):
+        pass
+    finally:
+        log_writer.stop()
+
+
+class WorkerHandle(object):
+
+    def __init__(self, worker_id, cpu):
+        self.worker_id = worker_id
+        self.cpu = cpu
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=run_worker, args=(worker_id, child_conn, cpu),
+            name='match-worker-%d' % worker_id)
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+        self.matches = set()
+        self.hosted = 0
+        # datagrams waiting to be sent down the pipe as one message
+        self.outbox = []
+        self.alive = True
+
+    def get_busy(self, matches):
+        return sum(matches[match_id].load.get('busy', 0.)
+                   for match_id in self.matches)
+
+    def send(self, message):
+        try:
+            self.conn.send(message)
+        except (BrokenPipeError, EOFError, OSError):
+            self.alive = False
+
+
+class MatchInfo(object):
+
+    def __init__(self, match_id, worker, options, now):
+        self.match_id = match_id
+        self.worker = worker
+        self.options = options
+        self.sessions = set()
+        self.joinable = not options.get('bots') and not options.get('enemies')
+        self.idle_since = now
+        self.load = {}
+
+
+class Session(object):
+
+    def __init__(self, session_id, addr, match_id, now):
+        self.session_id = session_id
+        self.addr = addr
+        self.match_id = match_id
+        self.last_seen = now
+
+
+class Supervisor(object):
+
+    # owns the one public socket and routes datagrams to the match workers
+    # by the session id in the packet header. a client's first datagram
+    # has session 0, it gets a session in a match with room and learns its
+    # id from the replies
+
+    def __init__(self, sock, workers=None,
+                 matches_per_worker=SupervisorConfig.MATCHES_PER_WORKER,
+                 prof=profiler.NULL_PROFILER, on_match_ended=None):
+        self.sock = sock
+        self.sock.setblocking(False)
+        self.prof = prof
+        self.matches_per_worker = matches_per_worker
+        # called with the match id and its final load
+        self.on_match_ended = on_match_ended
+        if hasattr(os, 'sched_getaffinity'):
+            self.cpus = sorted(os.sched_getaffinity(0))
+        else:
+            self.cpus = list(range(multiprocessing.cpu_count()))
+        if not workers:
+            workers = len(self.cpus)
+        self.rand = random.SystemRandom()
+        self.workers = []
+        self.matches = {}
+        self.sessions = {}
+        self.addr_sessions = {}
+        self.next_worker_id = 0
+        self.next_match_id = 1
+        self.spawned = 0
+        self.recycled = 0
+        for i in range(workers):
+            self.spawn_worker(self.cpus[i % len(self.cpus)])
+
+    def spawn_worker(self, cpu):
+        worker = WorkerHandle(self.next_worker_id, cpu)
+        self.next_worker_id += 1
+        self.workers.append(worker)
+        self.spawned += 1
+        LOG.info('Started worker %d on cpu %d', worker.worker_id, cpu)
+        return worker
+
+    def start_match(self, **options):
+        # on the least busy worker with room, None when all are full
+        now = time.time()
+        workers = [worker for worker in self.workers
+                   if worker.alive and
+                   len(worker.matches) < self.matches_per_worker]
+        if not workers:
+            LOG.warning('No room for another match')
+            return None
+        worker = min(workers, key=lambda worker: (
+            worker.get_busy(self.matches), len(worker.matches)))
+        match_id = self.next_match_id
+        self.next_match_id += 1
+        self.matches[match_id] = MatchInfo(match_id, worker, options, now)
+        worker.matches.add(match_id)
+        worker.hosted += 1
+        worker.send((MessageType.START, match_id, options))
+        LOG.info('Started match %d on worker %d', match_id, worker.worker_id)
+        return match_id
+
+    def stop_match(self, match_id):
+        info = self.matches.get(match_id)
+        if info:
+            info.worker.send((MessageType.STOP, match_id))
+
+    def end_match(self, match_id, load):
+        info = self.matches.pop(match_id, None)
+        if info is None:
+            return
+        info.worker.matches.discard(match_id)
+        for session_id in list(info.sessions):
+            self.remove_session(session_id)
+        LOG.info('Match %d ended after %d ticks', match_id,
+                 load.get('ticks', 0) if load else 0)
+        if self.on_match_ended:
+            self.on_match_ended(match_id, load)
+
+    def find_match(self):
+        joinable = [info for info in self.matches.values()
+                    if info.joinable and
+                    len(info.sessions) < SupervisorConfig.CLIENTS_PER_MATCH]
+        if joinable:
+            return max(joinable, key=lambda info: info.match_id).match_id
+        return self.start_match()
+
+    def create_session(self, addr, now):
+        match_id = self.find_match()
+        if match_id is None:
+            return None
+        session_id = 0
+        while not session_id or session_id in self.sessions:
+            session_id = self.rand.getrandbits(32)
+        session = Session(session_id, addr, match_id, now)
+        self.sessions[session_id] = session
+        self.addr_sessions[addr] = session
+        self.matches[match_id].sessions.add(session_id)
+        LOG.info('Session %08x from %s:%d joined match %d', session_id,
+                 addr[0], addr[1], match_id)
+        return session
+
+    def remove_session(self, session_id):
+        session = self.sessions.pop(session_id)
+        if self.addr_sessions.get(session.addr) is session:
+            del self.addr_sessions[session.addr]
+        info = self.matches.get(session.match_id)
+        if info:
+            info.sessions.discard(session_id)
+            if not info.sessions:
+                info.idle_since = time.time()
+            info.worker.send(
+                (MessageType.LEAVE, session.match_id, session_id))
+
+    def on_datagram(self, data, addr, now):
+        prof = self.prof
+        prof.count('supervisor.datagrams_in')
+        session_id = networking.peek_session(data)
+        if not session_id:
+            # new clients and disconnects don't know their session yet
+            session = self.addr_sessions.get(addr)
+            if session is None:
+                if not data:
+                    return
+                session = self.create_session(addr, now)
+                if session is None:
+                    prof.count('supervisor.rejected')
+                    return
+        else:
+            session = self.sessions.get(session_id)
+            if session is None:
+                prof.count('supervisor.unknown_session')
+                return
+            if session.addr != addr:
+                # the client's address changed, the session follows it
+                if self.addr_sessions.get(session.addr) is session:
+                    del self.addr_sessions[session.addr]
+                session.addr = addr
+                self.addr_sessions[addr] = session
+        if not data:
+            self.remove_session(session.session_id)
+            return
+        session.last_seen = now
+        info = self.matches[session.match_id]
+        info.worker.outbox.append(
+            (session.match_id, session.session_id, data))
+
+    def read_socket(self, now):
+        while True:
+            try:
+                data, addr = self.sock.recvfrom(networking.MAX_DATAGRAM_SIZE)
+            except (BlockingIOError, InterruptedError):
+                break
+            except ConnectionError:
+                continue
+            self.on_datagram(data, addr, now)
+
+    def flush_workers(self):
+        for worker in self.workers:
+            if worker.outbox:
+                worker.send((MessageType.DATAGRAMS, worker.outbox))
+                worker.outbox = []
+
+    def on_worker_message(self, worker, message):
+        kind = message[0]
+        if kind == MessageType.DATAGRAMS:
+            prof = self.prof
+            for session_id, data in message[1]:
+                session = self.sessions.get(session_id)
+                if session is None:
+                    continue
+                try:
+                    self.sock.sendto(data, session.addr)
+                    prof.count('supervisor.datagrams_out')
+                except (BlockingIOError, InterruptedError):
+                    prof.count('supervisor.send_dropped')
+                except socket.error:
+                    LOG.exception('Socket error')
+        elif kind == MessageType.LOAD:
+            for match_id, load in message[1].items():
+                info = self.matches.get(match_id)
+                if info:
+                    info.load = load
+        elif kind == MessageType.ENDED:
+            self.end_match(message[1], message[2])
+
+    def read_workers(self, conns):
+        for worker in list(self.workers):
+            if worker.conn not in conns:
+                continue
+            try:
+                while worker.conn.poll():
+                    self.on_worker_message(worker, worker.conn.recv())
+            except (EOFError, OSError):
+                worker.alive = False
+
+    def check_workers(self):
+        # replaces dead workers, and idle ones that hosted enough matches
+        for worker in list(self.workers):
+            if worker.alive and worker.process.is_alive():
+                if (worker.hosted < SupervisorConfig.RECYCLE_AFTER or
+                        worker.matches):
+                    continue
+                LOG.info('Recycling worker %d after %d matches',
+                         worker.worker_id, worker.hosted)
+                worker.send((MessageType.QUIT,))
+                self.recycled += 1
+            else:
+                LOG.error('Worker %d died, dropping its %d matches',
+                          worker.worker_id, len(worker.matches))
+                for match_id in list(worker.matches):
+                    self.end_match(match_id, None)
+            self.workers.remove(worker)
+            worker.conn.close()
+            self.spawn_worker(worker.cpu)
+
+    def expire(self, now):
+        for session in list(self.sessions.values()):
+            if now - session.last_seen > SupervisorConfig.SESSION_TIMEOUT:
+                LOG.info('Session %08x timed out', session.session_id)
+                self.remove_session(session.session_id)
+        for info in list(self.matches.values()):
+            if (info.joinable and not info.sessions and
+                    now - info.idle_since > SupervisorConfig.MATCH_IDLE_TIMEOUT):
+                self.stop_match(info.match_id)
+                info.idle_since = now
+
+    def poll(self, timeout):
+        conns = [worker.conn for worker in self.workers]
+        readable = multiprocessing.connection.wait(
+            conns + [self.sock], timeout)
+        now = time.time()
+        if self.sock in readable:
+            self.read_socket(now)
+        self.read_workers(readable)
+        self.flush_workers()
+        return now
+
+    def run(self, stats_server=None):
+        prof = self.prof
+        next_check = time.time() + SupervisorConfig.LOAD_INTERVAL
+        next_summary = time.time() + STATS_LOG_INTERVAL
+        while True:
+            now = self.poll(SupervisorConfig.LOAD_INTERVAL)
+            if stats_server:
+                stats_server.poll()
+            if now >= next_check:
+                self.check_workers()
+                self.expire(now)
+                if prof.enabled:
+                    prof.gauge('supervisor.workers', len(self.workers))
+                    prof.gauge('supervisor.matches', len(self.matches))
+                    prof.gauge('supervisor.sessions', len(self.sessions))
+                    prof.end_tick()
+                next_check = now + SupervisorConfig.LOAD_INTERVAL
+            if now >= next_summary:
+                self.log_load()
+                next_summary = now + STATS_LOG_INTERVAL
+
+    def get_load(self):
+        workers = {}
+        for worker in self.workers:
+            workers[str(worker.worker_id)] = {
+                'cpu': worker.cpu,
+                'hosted': worker.hosted,
+                'busy': worker.get_busy(self.matches),
+                'matches': dict((str(match_id), self.matches[match_id].load)
+                                for match_id in worker.matches),
+            }
+        return {
+            'workers': workers,
+            'sessions': len(self.sessions),
+            'spawned': self.spawned,
+            'recycled': self.recycled,
+        }
+
+    def log_load(self):
+        for worker in self.workers:
+            LOG.info('Worker %d on cpu %d: %d matches, %.0f%% busy',
+                     worker.worker_id, worker.cpu, len(worker.matches),
+                     worker.get_busy(self.matches) * 100.)
+            for match_id in sorted(worker.matches):
+                load = self.matches[match_id].load
+                if load:
+                    LOG.info('  match %d: %d clients, %d entities, '
+                             '%.1f ticks/s, %.2f ms/tick', match_id,
+                             load['clients'], load['entities'],
+                             load['tick_rate'], load['tick_ms'])
+
+    def close(self):
+        for worker in self.workers:
+            worker.send((MessageType.QUIT,))
+        for worker in self.workers:
+            worker.process.join(1.)
+            if worker.process.is_alive():
+                worker.process.terminate()
+            worker.conn.close()
+        self.workers = []
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Big Battle server hosting many matches')
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--workers', type=int,
+                        help='worker processes, one per core by default')
+    parser.add_argument('--matches-per-worker', type=int,
+                        default=SupervisorConfig.MATCHES_PER_WORKER)
+    parser.add_argument('--no-profile', dest='profile', action='store_false')
+    parser.add_argument('--stats-port', type=int, default=STATS_PORT,
+                        help='local UDP port answering with the load')
+    args = parser.parse_args()
+
+    logging.config.fileConfig('logging.conf', disable_existing_loggers=False)
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('0.0.0.0', args.port))
+    prof = profiler.Profiler() if args.profile else profiler.NULL_PROFILER
+    supervisor = Supervisor(sock, args.workers, args.matches_per_worker,
+                            prof)
+    stats_server = None
+    if args.profile and args.stats_port:
+        stats_server = profiler.StatsServer(
+            prof, args.stats_port, extra_stats=supervisor.get_load)
+    try:
+        supervisor.run(stats_server)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        supervisor.close()
+        if stats_server:
+            stats_server.close()
+        sock.close()
+
+if __name__ == '__main__':
+    main()
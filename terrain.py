@@ -1,9 +1,134 @@
 # Copyright (c) 2014 Per Lindstrand
 
 import logging
+import math
 import random
 
+import numpy as np
+
+import world
+
 LOG = logging.getLogger(__name__)
 
+CHUNK_SIZE = 32
+
+
 def generate_random_square_patch(size, tile_types=[0]):
     return [random.choice(tile_types) for i in range(size * size)]
+
+
+def generate_random_grid(width, height, tile_types=[world.TileType.GRASS],
+                         blocking_ratio=0., seed=None):
+    rand = np.random.RandomState(seed)
+    grid = TerrainGrid(width, height)
+    grid.types[:, :] = rand.choice(tile_types, size=(height, width))
+    if blocking_ratio > 0.:
+        blocking = rand.random_sample((height, width)) < blocking_ratio
+        grid.flags[blocking] |= world.TileFlags.BLOCKING
+    return grid
+
+
+def generate_maze(width, height, room_size=4, door_ratio=.5, seed=None):
+    # rooms of room_size - 1 tiles between one tile thick walls, each wall
+    # segment between two corners has a door with the given chance
+    rand = np.random.RandomState(seed)
+    grid = TerrainGrid(width, height)
+    ys, xs = np.mgrid[0:height, 0:width]
+    rooms_y = ys // room_size
+    rooms_x = xs // room_size
+    on_row = (ys % room_size) == 0
+    on_column = (xs % room_size) == 0
+    shape = (height // room_size + 1, width // room_size + 1)
+    row_doors = rand.random_sample(shape) < door_ratio
+    column_doors = rand.random_sample(shape) < door_ratio
+    walls = on_row | on_column
+    walls &= ~(on_row & ~on_column & row_doors[rooms_y, rooms_x])
+    walls &= ~(on_column & ~on_row & column_doors[rooms_y, rooms_x])
+    grid.flags[walls] |= world.TileFlags.BLOCKING
+    return grid
+
+
+def world_to_tile(x):
+    # tiles are centered on integer world coordinates
+    return int(math.floor(x + .5))
+
+
+class TerrainGrid(object):
+
+    # tile (x, y) is stored at [y, x], the same layout as the flat tile
+    # lists where it is found at index x + y * width
+
+    def __init__(self, width, height, chunk_size=CHUNK_SIZE):
+        self.width = width
+        self.height = height
+        self.chunk_size = chunk_size
+        self.chunks_x = (width + chunk_size - 1) // chunk_size
+        self.chunks_y = (height + chunk_size - 1) // chunk_size
+        self.types = np.zeros((height, width), dtype=np.uint8)
+        self.flags = np.zeros((height, width), dtype=np.uint8)
+        # bumped on every change, the chunk revisions remember when each
+        # chunk was last touched so caches can invalidate incrementally
+        self.revision = 0
+        self.chunk_revisions = np.zeros(
+            (self.chunks_y, self.chunks_x), dtype=np.int64)
+        self.blocking = None
+        self.blocking_revision = -1
+
+    @classmethod
+    def from_tiles(cls, tiles, width, height, chunk_size=CHUNK_SIZE):
+        grid = cls(width, height, chunk_size)
+        grid.types[:, :] = np.asarray(
+            tiles, dtype=np.uint8).reshape(height, width)
+        return grid
+
+    def in_bounds(self, x, y):
+        return 0 <= x < self.width and 0 <= y < self.height
+
+    def get_type(self, x, y):
+        return int(self.types[y, x])
+
+    def get_flags(self, x, y):
+        return int(self.flags[y, x])
+
+    def is_blocking(self, x, y):
+        return (self.types[y, x] == world.TileType.WATER or
+                (self.flags[y, x] & world.TileFlags.BLOCKING) != 0)
+
+    def set_tile(self, x, y, tile_type, flags=world.TileFlags.NONE):
+        self.types[y, x] = tile_type
+        self.flags[y, x] = flags
+        self.revision += 1
+        self.chunk_revisions[
+            y // self.chunk_size, x // self.chunk_size] = self.revision
+
+    def set_tiles(self, xs, ys, tile_type, flags=world.TileFlags.NONE):
+        xs = np.asarray(xs, dtype=np.intp)
+        ys = np.asarray(ys, dtype=np.intp)
+        self.types[ys, xs] = tile_type
+        self.flags[ys, xs] = flags
+        self.revision += 1
+        self.chunk_revisions[
+            ys // self.chunk_size, xs // self.chunk_size] = self.revision
+
+    def blocking_mask(self):
+        return ((self.types == world.TileType.WATER) |
+                ((self.flags & world.TileFlags.BLOCKING) != 0))
+
+    def get_blocking(self):
+        # cached blocking_mask, rebuilt after the terrain changes
+        if self.blocking_revision != self.revision:
+            self.blocking = self.blocking_mask()
+            self.blocking_revision = self.revision
+        return self.blocking
+
+    def changed_chunks(self, revision):
+        # chunks touched after the given revision as (cxs, cys)
+        cys, cxs = np.nonzero(self.chunk_revisions > revision)
+        return cxs, cys
+
+    def chunk_bounds(self, cx, cy):
+        x0 = cx * self.chunk_size
+        y0 = cy * self.chunk_size
+        return (x0, y0,
+                min(x0 + self.chunk_size, self.width),
+                min(y0 + self.chunk_size, self.height))
@@ -0,0 +1,59 @@
+# Copyright (c) 2014 Per Lindstrand
+
+import gc
+import tracemalloc
+
+import match
+import netsim
+
+# new clients per simulated second, each sends one packet and vanishes
+CLIENTS_PER_SECOND = 20
+PERIODS = 6
+
+
+def get_sizes(game):
+    return {
+        'clients': len(game.clients),
+        'client_timers': len(game.client_timers),
+        'replication': len(game.replication),
+        'timers': len(game.timers),
+        'entities': len(game.sim.entities),
+    }
+
+
+def test_churning_clients_level_off():
+    game = netsim.create_match(1)
+    packet = netsim.get_connect_packet()
+    now = game.start_time
+    seconds = int(match.MatchConfig.CLIENT_TIMEOUT)
+    port = 0
+    # (sizes, traced memory) at the end of every timeout period
+    periods = []
+    tracemalloc.start()
+    try:
+        for period in range(PERIODS):
+            for second in range(seconds):
+                for i in range(CLIENTS_PER_SECOND):
+                    game.on_datagram(('10.0.0.1', port), packet)
+                    port += 1
+                now += 1.
+                game.timers.advance(now)
+                # a tick now and then, it clears the simulation's events
+                game.step()
+                game.send()
+            gc.collect()
+            periods.append((get_sizes(game),
+                            tracemalloc.get_traced_memory()[0]))
+    finally:
+        tracemalloc.stop()
+    # the first period fills up to a timeout's worth of clients, from the
+    # second on as many time out as connect
+    steady = periods[1][0]
+    assert steady['clients'] <= CLIENTS_PER_SECOND * (seconds + 1)
+    for sizes, memory in periods[2:]:
+        assert sizes == steady
+    assert steady['client_timers'] == steady['clients']
+    assert steady['replication'] == steady['clients']
+    memory = [memory for sizes, memory in periods]
+    assert max(memory[2:]) < memory[1] * 1.02
+    assert port == CLIENTS_PER_SECOND * seconds * PERIODS
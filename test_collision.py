@@ -0,0 +1,117 @@
+# Copyright (c) 2014 Per Lindstrand
+
+import numpy as np
+
+import collision
+import terrain
+
+RADIUS = .25
+EPSILON = 1e-9
+
+
+def resolve(blocking, old, new, radius=RADIUS):
+    old = np.atleast_2d(np.asarray(old, dtype=np.float64))
+    new = np.atleast_2d(np.asarray(new, dtype=np.float64))
+    return collision.resolve_movement(
+        blocking, old[:, 0], old[:, 1], new[:, 0], new[:, 1],
+        np.full(len(old), radius))
+
+
+def overlaps_blocking(blocking, x, y, radius=RADIUS):
+    # brute force, every tile around the circle and the outside of the map
+    height, width = blocking.shape
+    tx = int(np.floor(x + .5))
+    ty = int(np.floor(y + .5))
+    for by in range(ty - 2, ty + 3):
+        for bx in range(tx - 2, tx + 3):
+            inside = 0 <= bx < width and 0 <= by < height
+            if inside and not blocking[by, bx]:
+                continue
+            dx = x - min(max(x, bx - .5), bx + .5)
+            dy = y - min(max(y, by - .5), by + .5)
+            if dx * dx + dy * dy < (radius - EPSILON) ** 2:
+                return True
+    return False
+
+
+def test_no_tunnelling_at_high_speed():
+    blocking = np.zeros((10, 20), dtype=bool)
+    blocking[:, 10] = True
+    # 15 tiles in one move, far more than a wall's thickness
+    xs, ys, hit, push_xs, push_ys = resolve(blocking, (2., 5.), (17., 5.))
+    assert hit[0]
+    assert xs[0] <= 9.5 - RADIUS + EPSILON
+    assert xs[0] > 9.
+    assert ys[0] == 5.
+    assert push_xs[0] < 0.
+
+
+def test_no_tunnelling_through_a_maze():
+    grid = terrain.generate_maze(64, 64, seed=3)
+    blocking = grid.get_blocking()
+    rand = np.random.RandomState(3)
+    # start in the middle of the rooms, move up to 20 tiles at once
+    rooms = rand.randint(0, 16, (500, 2)) * 4 + 2.
+    moves = rand.uniform(-20., 20., (500, 2))
+    xs, ys, hit, push_xs, push_ys = resolve(blocking, rooms, rooms + moves)
+    for x, y in zip(xs, ys):
+        assert not overlaps_blocking(blocking, x, y)
+    assert hit.any()
+
+
+def test_slides_along_a_wall():
+    blocking = np.zeros((10, 10), dtype=bool)
+    blocking[5, :] = True
+    xs, ys, hit, push_xs, push_ys = resolve(blocking, (1., 4.), (4., 5.))
+    assert hit[0]
+    assert abs(ys[0] - (4.5 - RADIUS)) < 1e-5
+    # keeps the motion along the wall
+    assert abs(xs[0] - 4.) < 1e-9
+    assert push_xs[0] == 0.
+
+
+def test_rounds_a_corner():
+    blocking = np.zeros((10, 10), dtype=bool)
+    blocking[5, 5] = True
+    # straight at the corner of the tile, ends up touching it. the axes are
+    # resolved one after the other so it may slide off to one side
+    xs, ys, hit, push_xs, push_ys = resolve(blocking, (3., 3.), (4.6, 4.6))
+    assert hit[0]
+    dx = xs[0] - min(max(xs[0], 4.5), 5.5)
+    dy = ys[0] - min(max(ys[0], 4.5), 5.5)
+    assert RADIUS - EPSILON <= np.hypot(dx, dy) < RADIUS + .01
+    assert not overlaps_blocking(blocking, xs[0], ys[0])
+    # passing next to the corner is pushed around it without stopping
+    xs, ys, hit, push_xs, push_ys = resolve(blocking, (3., 4.4), (7., 4.4))
+    assert hit[0]
+    assert xs[0] > 6.
+    assert not overlaps_blocking(blocking, xs[0], ys[0])
+
+
+def test_diagonal_gap_is_closed():
+    # two tiles touching at a corner leave no gap to squeeze through
+    blocking = np.zeros((10, 10), dtype=bool)
+    blocking[6, 5] = True
+    blocking[5, 6] = True
+    xs, ys, hit, push_xs, push_ys = resolve(blocking, (5., 5.), (7., 7.))
+    assert hit[0]
+    assert xs[0] + ys[0] < 11.
+    assert not overlaps_blocking(blocking, xs[0], ys[0])
+
+
+def test_clamped_to_the_map_edges():
+    blocking = np.zeros((10, 10), dtype=bool)
+    xs, ys, hit, push_xs, push_ys = resolve(
+        blocking, [(1., 1.), (8., 8.)], [(-5., 20.), (30., -30.)])
+    assert hit.all()
+    assert abs(xs[0] - (-.5 + RADIUS)) < 1e-5
+    assert abs(ys[0] - (9.5 - RADIUS)) < 1e-5
+    assert abs(xs[1] - (9.5 - RADIUS)) < 1e-5
+    assert abs(ys[1] - (-.5 + RADIUS)) < 1e-5
+
+
+def test_free_movement_is_untouched():
+    blocking = np.zeros((10, 10), dtype=bool)
+    xs, ys, hit, push_xs, push_ys = resolve(blocking, (2., 2.), (7., 3.))
+    assert not hit[0]
+    assert xs[0] == 7. and abs(ys[0] - 3.) < 1e-12
@@ -0,0 +1,74 @@
+# Copyright (c) 2014 Per Lindstrand
+
+import numpy as np
+
+import governor
+
+FRAMES = 10000
+# share of the best quality's frame time left at each level
+LEVEL_COSTS = (1., .8, .6, .45, .35)
+
+
+def run_trace(loads, seed=2):
+    # a frame costs the load times the cost of the level it is drawn at
+    gov = governor.FrameGovernor()
+    noise = np.random.RandomState(seed).normal(1., .03, len(loads))
+    levels = []
+    for load, jitter in zip(loads.tolist(), noise.tolist()):
+        gov.add_frame(gov.target * load * LEVEL_COSTS[gov.level] * jitter)
+        levels.append(gov.level)
+    return gov, levels
+
+
+def get_changes(levels):
+    return [(frame, levels[frame - 1], levels[frame])
+            for frame in range(1, len(levels))
+            if levels[frame] != levels[frame - 1]]
+
+
+def test_follows_a_battle_down_and_back_up():
+    gov, levels = run_trace(governor.get_frame_traces(1, FRAMES)['battle'])
+    changes = get_changes(levels)
+    # a level at a time, all the way down while it builds up and all the
+    # way back once it is over, no changing of minds on the way
+    assert [(old, new) for frame, old, new in changes] == [
+        (0, 1), (1, 2), (2, 3), (3, 4), (4, 3), (3, 2), (2, 1), (1, 0)]
+    assert all(frame < FRAMES // 2 for frame, old, new in changes[:4])
+    assert all(frame > FRAMES // 2 for frame, old, new in changes[4:])
+    assert gov.raise_delay == governor.GovernorConfig.RAISE_DELAY
+
+
+def test_steady_load_near_the_limit_doesnt_flap():
+    # one level down is enough, the hysteresis keeps it from rising again
+    gov, levels = run_trace(governor.get_frame_traces(1, FRAMES)['edge'])
+    assert gov.drops == 1
+    assert gov.raises == 0
+    assert levels[-1] == 1
+
+
+def test_single_frame_spikes_are_ignored():
+    gov, levels = run_trace(governor.get_frame_traces(1, FRAMES)['spikes'])
+    assert gov.drops == 0
+    assert gov.raises == 0
+    assert set(levels) == {0}
+
+
+def test_raise_delay_doubles_when_a_rise_doesnt_hold():
+    # too slow at the best quality, comfortable one level down. every rise
+    # is taken back, so each one waits twice as long as the last
+    gov = governor.FrameGovernor()
+    delays = []
+    raises = []
+    for frame in range(20000):
+        load = 1.3 if gov.level == 0 else .6
+        gov.add_frame(gov.target * load)
+        if gov.raise_delay not in delays:
+            delays.append(gov.raise_delay)
+        if gov.raises > len(raises):
+            raises.append(frame)
+    assert delays == [120, 240, 480, 960, 1920, 3840]
+    gaps = np.diff(raises)
+    assert (np.diff(gaps[:5]) > 0).all()
+    # the cap keeps it trying now and then, never more often
+    assert (gaps[5:] > governor.GovernorConfig.MAX_RAISE_DELAY).all()
+    assert gov.drops - gov.raises in (0, 1)
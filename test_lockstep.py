@@ -0,0 +1,59 @@
+# Copyright (c) 2014 Per Lindstrand
+
+import json
+import os
+import subprocess
+import sys
+
+import lockstep
+
+PEERS = 3
+ENTITIES = 200
+SEED = 7
+TICKS = 300
+INTERVAL = 30
+
+
+def run_match(seed=SEED, ticks=TICKS, interval=INTERVAL, loss=.2):
+    # the checksums every interval ticks, all peers stepped up to the tick
+    # before any of them goes on
+    game = lockstep.LockstepMatch(PEERS, ENTITIES, seed, 3, loss)
+    checksums = []
+    for tick in range(interval, ticks + 1, interval):
+        while min(peer.sim.tick for peer in game.peers) < tick:
+            game.step(tick)
+        peer_checksums = game.get_checksums()
+        assert len(set(peer_checksums)) == 1, (tick, peer_checksums)
+        checksums.append(peer_checksums[0])
+    for peer in game.peers:
+        assert peer.desync_tick is None
+    assert game.lost > 0
+    return checksums
+
+
+def test_peers_agree_over_a_lossy_link():
+    checksums = run_match()
+    assert len(checksums) == TICKS // INTERVAL
+    # the bots move, the state doesn't stand still
+    assert len(set(checksums)) == len(checksums)
+
+
+def test_separate_matches_agree():
+    assert run_match() == run_match()
+    assert run_match() != run_match(seed=SEED + 1)
+
+
+def test_matches_agree_across_processes():
+    # another interpreter with other hash seeds, nothing may depend on the
+    # iteration order of sets or dicts of strings
+    here = os.path.dirname(os.path.abspath(__file__))
+    checksums = []
+    for hash_seed in ('1', '2'):
+        env = dict(os.environ, PYTHONHASHSEED=hash_seed)
+        output = subprocess.check_output(
+            [sys.executable, '-c',
+             'import json, test_lockstep; '
+             'print(json.dumps(test_lockstep.run_match()))'],
+            cwd=here, env=env)
+        checksums.append(json.loads(output))
+    assert checksums[0] == checksums[1] == run_match()
@@ -0,0 +1,51 @@
+# Copyright (c) 2014 Per Lindstrand
+
+import json
+import socket
+
+import profiler
+
+
+def request_stats(server):
+    client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    client.settimeout(.01)
+    try:
+        client.sendto(b'\n', server.sock.getsockname())
+        for i in range(500):
+            server.poll()
+            try:
+                return json.loads(client.recv(65536).decode('ascii'))
+            except socket.timeout:
+                pass
+        raise AssertionError('no stats reply')
+    finally:
+        client.close()
+
+
+def test_stats_reply():
+    prof = profiler.Profiler()
+    prof.count('server.datagrams_in', 3)
+    prof.end_tick()
+    server = profiler.StatsServer(prof, 0, extra_stats=lambda: {'clients': 2})
+    try:
+        stats = request_stats(server)
+    finally:
+        server.close()
+    assert stats['ticks'] == 1
+    assert stats['clients'] == 2
+    assert stats['server.datagrams_in']['max'] == 3
+
+
+def test_oversized_stats_reply_is_an_error():
+    prof = profiler.Profiler()
+    for i in range(2000):
+        prof.gauge('client.%04d.rtt_ms' % i, i)
+    prof.end_tick()
+    server = profiler.StatsServer(prof, 0)
+    try:
+        assert len(json.dumps(server.get_stats())) > server.MAX_REPLY_SIZE
+        stats = request_stats(server)
+    finally:
+        server.close()
+    assert stats['error'] == 'truncated'
+    assert stats['size'] > server.MAX_REPLY_SIZE
@@ -0,0 +1,67 @@
+# Copyright (c) 2014 Per Lindstrand
+
+import numpy as np
+
+import netsim
+import networking
+
+
+def run_phases(capacities, seconds=5., count=1000):
+    arrays, own = netsim.get_replication_arrays(
+        np.random.RandomState(1), count)
+    links = netsim.create_congested_links(capacities[0])
+    tick = 0
+    phases = []
+    for capacity in capacities:
+        tick = netsim.run_congested_links(
+            links, capacity, seconds, tick, arrays, own)
+        phases.append(dict(
+            (name, (link.server.stats.srtt, link.get_loss_rate()))
+            for name, link in links.items()))
+    return links, phases
+
+
+def test_adaptive_rate_backs_off_on_a_congested_link():
+    links, phases = run_phases((48000., 24000., 48000., 24000.))
+    adaptive = links['adaptive']
+    fixed = links['fixed']
+    assert adaptive.get_loss_rate() < .02
+    assert adaptive.get_loss_rate() < fixed.get_loss_rate() / 4.
+    # the queue doesn't stand, the rtt is back near the base one by the
+    # end of every phase while the fixed rate keeps the queue full
+    for phase in phases:
+        assert phase['adaptive'][0] < .2
+    for phase in phases[1::2]:
+        assert phase['fixed'][0] > .5
+    assert adaptive.max_rtt < .8
+    assert adaptive.replication.controller.decreases > 0
+
+
+def test_channels_send_everything_queued():
+    links, phases = run_phases((24000.,), seconds=2.)
+    for link in links.values():
+        assert link.max_outbox > 0
+        assert not link.server.outbox
+        assert link.server.outbox_bytes == 0
+
+
+def test_outbox_is_capped():
+    chn = networking.Channel(netsim.NullSocket(), None)
+    for i in range(chn.MAX_OUTBOX + 10):
+        chn.send_packet(b'x' * 100)
+    assert len(chn.outbox) == chn.MAX_OUTBOX
+    assert chn.outbox_dropped == 10
+    assert chn.flush()
+    assert not chn.outbox and chn.outbox_bytes == 0
+
+
+def test_match_send_drains_the_replication_packets():
+    game = netsim.create_match(1)
+    packet = netsim.get_connect_packet()
+    game.on_datagram(('10.0.0.1', 1), packet)
+    chn = game.clients[('10.0.0.1', 1)]
+    for i in range(100):
+        game.step()
+        game.send()
+        assert not chn.outbox
+    assert game.replication[('10.0.0.1', 1)].packets
@@ -0,0 +1,27 @@
+# Copyright (c) 2014 Per Lindstrand
+
+import numpy as np
+
+import terrain
+import visibility
+
+
+def test_zero_sight_radius_sees_only_its_own_tile():
+    grid = terrain.generate_maze(32, 32, seed=1)
+    vis = visibility.VisibilityGrid(grid, sight_radius=0)
+    vis.update([1], [2.], [2.], [1])
+    visible = vis.get_visible_tiles(1)
+    assert visible.shape == (32, 32)
+    assert np.flatnonzero(visible).tolist() == [2 + 2 * 32]
+    assert vis.is_tile_visible(1, 2, 2)
+    assert vis.is_visible(1, 1)
+
+
+def test_visible_tiles_match_the_map():
+    grid = terrain.generate_maze(32, 24, seed=1)
+    vis = visibility.VisibilityGrid(grid, sight_radius=4)
+    vis.update([1], [30.], [22.], [1])
+    visible = vis.get_visible_tiles(1)
+    assert visible.shape == (24, 32)
+    assert visible[22, 30]
+    assert not visible[:10, :10].any()
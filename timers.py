@@ -0,0 +1,186 @@
+# Copyright (c) 2014 Per Lindstrand
+
+import logging
+import math
+
+LOG = logging.getLogger(__name__)
+
+
+class TimerConfig(object):
+
+    # seconds per slot of the finest wheel
+    RESOLUTION = .01
+    # slots of each wheel as a power of two, the first covers 2.56 s and
+    # every further one 64 times the one before, about 7.7 days in total.
+    # timers further out wait in the last wheel and get placed again
+    WHEEL_BITS = (8, 6, 6, 6)
+
+
+class Timer(object):
+
+    __slots__ = ('tick', 'callback', 'args', 'interval', 'slot')
+
+    def __init__(self, tick, callback, args, interval=None):
+        self.tick = tick
+        self.callback = callback
+        self.args = args
+        # seconds between firings of a repeating timer
+        self.interval = interval
+        # the wheel slot holding the timer, None once fired or cancelled
+        self.slot = None
+
+    def is_active(self):
+        return self.slot is not None
+
+
+class TimerWheel(object):
+
+    # hierarchical timing wheel: timers due within 256 ticks sit in the slot
+    # of their tick in the first wheel, later ones in the slot of their
+    # block of ticks in a coarser wheel and are moved down a wheel when the
+    # finer one wraps around. schedule and cancel are O(1), advancing is
+    # O(1) per tick plus the timers that fire. slots are dicts so timers
+    # sharing a tick fire in the order they were scheduled
+
+    def __init__(self, now=0., resolution=TimerConfig.RESOLUTION,
+                 wheel_bits=TimerConfig.WHEEL_BITS):
+        self.resolution = resolution
+        self.wheels = [[{} for i in range(1 << bits)] for bits in wheel_bits]
+        self.masks = [(1 << bits) - 1 for bits in wheel_bits]
+        self.shifts = []
+        self.limits = []
+        shift = 0
+        for bits in wheel_bits:
+            self.shifts.append(shift)
+            shift += bits
+            self.limits.append(1 << shift)
+        # the last tick that was processed
+        self.tick = self.get_tick(now)
+        self.count = 0
+        self.fired = 0
+
+    def __len__(self):
+        return self.count
+
+    def get_tick(self, now):
+        return int(math.floor(now / self.resolution))
+
+    def get_time(self):
+        return self.tick * self.resolution
+
+    def schedule(self, delay, callback, *args):
+        # calls callback(*args) delay seconds after the current time
+        timer = Timer(self.get_due_tick(delay), callback, args)
+        self.insert(timer)
+        self.count += 1
+        return timer
+
+    def schedule_repeating(self, interval, callback, *args):
+        timer = Timer(self.get_due_tick(interval), callback, args, interval)
+        self.insert(timer)
+        self.count += 1
+        return timer
+
+    def cancel(self, timer):
+        if timer.slot is None:
+            return False
+        del timer.slot[timer]
+        timer.slot = None
+        self.count -= 1
+        return True
+
+    def reschedule(self, timer, delay):
+        # pushes a timer back, e.g. an idle timeout on activity
+        self.cancel(timer)
+        timer.tick = self.get_due_tick(delay)
+        self.insert(timer)
+        self.count += 1
+
+    def get_due_tick(self, delay):
+        return self.tick + max(
+            int(math.ceil(delay / self.resolution)), 1)
+
+    def insert(self, timer):
+        delta = timer.tick - self.tick
+        for level, limit in enumerate(self.limits):
+            if delta < limit:
+                tick = timer.tick
+                break
+        else:
+            # beyond the last wheel, parked in its furthest slot
+            tick = self.tick + self.limits[-1] - 1
+        slot = self.wheels[level][
+            (tick >> self.shifts[level]) & self.masks[level]]
+        slot[timer] = None
+        timer.slot = slot
+
+    def cascade(self):
+        # the first wheel wrapped, the current slot of every coarser wheel
+        # up to the first one that didn't wrap moves a wheel down
+        for level in range(1, len(self.wheels)):
+            index = (self.tick >> self.shifts[level]) & self.masks[level]
+            slot = self.wheels[level][index]
+            if slot:
+                timers = list(slot)
+                slot.clear()
+                for timer in timers:
+                    self.insert(timer)
+            if index:
+                break
+
+    def advance(self, now):
+        # fires every timer due up to now, returns how many fired
+        target = self.get_tick(now)
+        if not self.count:
+            if target > self.tick:
+                self.tick = target
+            return 0
+        fired = 0
+        wheel = self.wheels[0]
+        mask = self.masks[0]
+        while self.tick < target:
+            self.tick += 1
+            index = self.tick & mask
+            if not index:
+                self.cascade()
+            slot = wheel[index]
+            if not slot:
+                continue
+            # callbacks may cancel timers of the same slot, those are
+            # taken out of it and skipped
+            wheel[index] = {}
+            for timer in list(slot):
+                if timer.slot is not slot:
+                    continue
+                timer.slot = None
+                self.count -= 1
+                fired += 1
+                if timer.interval is not None:
+                    timer.tick += max(int(math.ceil(
+                        timer.interval / self.resolution)), 1)
+                    self.insert(timer)
+                    self.count += 1
+                try:
+                    timer.callback(*timer.args)
+                except Exception:
+                    LOG.exception('Timer callback failed')
+            if not self.count:
+                self.tick = target
+        self.fired += fired
+        return fired
+
+    def get_timeout(self, now, limit):
+        # seconds until the next timer may be due, at most limit. timers in
+        # the coarser wheels are only looked at when the first one wraps
+        if not self.count:
+            return limit
+        wheel = self.wheels[0]
+        mask = self.masks[0]
+        steps = mask + 1 - (self.tick & mask)
+        for step in range(1, steps):
+            if wheel[(self.tick + step) & mask]:
+                break
+        else:
+            step = steps
+        timeout = (self.tick + step) * self.resolution - now
+        return min(max(timeout, 0.), limit)
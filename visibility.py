@@ -0,0 +1,246 @@
+# Copyright (c) 2014 Per Lindstrand
+
+import logging
+
+import numpy as np
+
+import world
+
+LOG = logging.getLogger(__name__)
+
+
+class VisibilityConfig(object):
+
+    # in tiles
+    SIGHT_RADIUS = 8
+    LINE_OF_SIGHT = True
+    # units whose line of sight is traced at once, bounds the temporaries
+    RAY_BATCH = 4096
+
+
+def get_stamp_offsets(radius):
+    # tile offsets of the sight disk as (dxs, dys), sorted by ring so every
+    # tile comes after the tiles between it and the center
+    dys, dxs = np.mgrid[-radius:radius + 1, -radius:radius + 1]
+    inside = dxs * dxs + dys * dys <= radius * radius + radius
+    dxs = dxs[inside]
+    dys = dys[inside]
+    order = np.argsort(np.maximum(np.abs(dxs), np.abs(dys)), kind='stable')
+    return dxs[order], dys[order]
+
+
+def get_ray_parents(dxs, dys):
+    # the stamp is a tree of rays from the center: each tile is in sight when
+    # the tile before it on the line to the center is in sight and doesn't
+    # block. returns the parent of each stamp tile and the ring they are in
+    lookup = dict(((dx, dy), i)
+                  for i, (dx, dy) in enumerate(zip(dxs.tolist(),
+                                                   dys.tolist())))
+    parents = np.zeros(len(lookup), dtype=np.intp)
+    for (dx, dy), i in lookup.items():
+        ring = max(abs(dx), abs(dy))
+        if ring <= 1:
+            parents[i] = lookup[(0, 0)]
+            continue
+        # one step back from the end of the line along its major axis
+        t = (ring - 1) / float(ring)
+        parent = (int(np.floor(dx * t + .5)), int(np.floor(dy * t + .5)))
+        parents[i] = lookup[parent]
+    rings = np.maximum(np.abs(dxs), np.abs(dys))
+    return parents, rings
+
+
+class VisibilityGrid(object):
+
+    # every team has a grid counting how many of its units see each tile,
+    # a unit adds its sight stamp when it enters a tile and takes the same
+    # stamp away when it leaves, so only units crossing tile boundaries cost
+    # anything. the grids are padded by the sight radius so stamps never
+    # need clipping
+
+    def __init__(self, terrain, sight_radius=VisibilityConfig.SIGHT_RADIUS,
+                 line_of_sight=VisibilityConfig.LINE_OF_SIGHT):
+        self.terrain = terrain
+        self.radius = sight_radius
+        self.line_of_sight = line_of_sight
+        self.pad = sight_radius
+        self.padded_width = terrain.width + 2 * self.pad
+        self.padded_height = terrain.height + 2 * self.pad
+        # the stamp shape is the same for every unit, only which of its
+        # tiles are in sight depends on the terrain
+        dxs, dys = get_stamp_offsets(sight_radius)
+        self.stamp = dxs + dys * self.padded_width
+        parents, rings = get_ray_parents(dxs, dys)
+        self.rings = [(np.flatnonzero(rings == ring),
+                       parents[rings == ring])
+                      for ring in range(2, sight_radius + 1)]
+        self.counts = {}
+        # per entity index: id, tile, team and which stamp tiles it sees
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.tile_x = np.zeros(0, dtype=np.intp)
+        self.tile_y = np.zeros(0, dtype=np.intp)
+        self.teams = np.zeros(0, dtype=np.int64)
+        self.masks = np.zeros((0, self.stamp.size), dtype=bool)
+        self.blocking = None
+        self.revision = None
+        # counters of the last update
+        self.moved = 0
+        self.removed = 0
+
+    def ensure_capacity(self, count):
+        capacity = self.ids.size
+        if count <= capacity:
+            return
+        while capacity < count:
+            capacity = max(1024, capacity * 2)
+        for name in ('ids', 'tile_x', 'tile_y', 'teams', 'masks'):
+            array = getattr(self, name)
+            grown = np.zeros((capacity,) + array.shape[1:], dtype=array.dtype)
+            grown[:array.shape[0]] = array
+            setattr(self, name, grown)
+
+    def get_counts(self, team):
+        counts = self.counts.get(team)
+        if counts is None:
+            counts = np.zeros(self.padded_width * self.padded_height,
+                              dtype=np.int32)
+            self.counts[team] = counts
+        return counts
+
+    def get_padded_blocking(self):
+        # outside the map blocks the sight
+        pad = self.pad
+        blocking = np.ones((self.padded_height, self.padded_width),
+                           dtype=bool)
+        blocking[pad:pad + self.terrain.height,
+                 pad:pad + self.terrain.width] = self.terrain.get_blocking()
+        return blocking.ravel()
+
+    def refresh(self):
+        # when the terrain changed every stamp may have changed, start over
+        revision = self.terrain.revision
+        if revision == self.revision:
+            return
+        self.revision = revision
+        if self.line_of_sight:
+            self.blocking = self.get_padded_blocking()
+        if self.ids.any():
+            LOG.debug('Terrain changed, rebuilding visibility')
+        for counts in self.counts.values():
+            counts[:] = 0
+        self.ids[:] = 0
+
+    def get_centers(self, indices):
+        return ((self.tile_x[indices] + self.pad) +
+                (self.tile_y[indices] + self.pad) * self.padded_width)
+
+    def compute_masks(self, centers):
+        count = len(centers)
+        masks = np.ones((count, self.stamp.size), dtype=bool)
+        if not self.line_of_sight:
+            return masks
+        # the center and the first ring are always in sight, every further
+        # ring is seen through its parents
+        batch = VisibilityConfig.RAY_BATCH
+        for start in range(0, count, batch):
+            clear = ~self.blocking[
+                centers[start:start + batch, None] + self.stamp[None]]
+            mask = masks[start:start + batch]
+            for tiles, parents in self.rings:
+                mask[:, tiles] = mask[:, parents] & clear[:, parents]
+        return masks
+
+    def apply_stamps(self, indices, sign):
+        teams = self.teams[indices]
+        for team in np.unique(teams).tolist():
+            if team == 0:
+                # neutral units have no vision
+                continue
+            team_indices = indices[teams == team]
+            cells = self.get_centers(team_indices)[:, None] + self.stamp[None]
+            cells = cells[self.masks[team_indices]]
+            counts = self.get_counts(team)
+            if cells.size > counts.size // 64:
+                np.add(counts, sign * np.bincount(cells, minlength=counts.size),
+                       out=counts, casting='unsafe')
+            elif sign > 0:
+                np.add.at(counts, cells, 1)
+            else:
+                np.subtract.at(counts, cells, 1)
+
+    def update(self, ids, xs, ys, teams):
+        # ids, positions and teams of all entities, entities missing since
+        # the last update have despawned
+        self.refresh()
+        ids = np.asarray(ids, dtype=np.int64)
+        indices = (ids & world.EntityAllocator.INDEX_MASK).astype(np.intp)
+        if indices.size:
+            self.ensure_capacity(int(indices.max()) + 1)
+        width = self.terrain.width
+        height = self.terrain.height
+        txs = np.clip(np.floor(np.asarray(xs) + .5).astype(np.intp),
+                      0, width - 1)
+        tys = np.clip(np.floor(np.asarray(ys) + .5).astype(np.intp),
+                      0, height - 1)
+        teams = np.asarray(teams, dtype=np.int64)
+
+        present = np.zeros(self.ids.size, dtype=bool)
+        present[indices] = True
+        gone = np.flatnonzero((self.ids != 0) & ~present)
+        known = self.ids[indices] == ids
+        changed = np.flatnonzero(
+            ~known | (self.tile_x[indices] != txs) |
+            (self.tile_y[indices] != tys) | (self.teams[indices] != teams))
+        stale = indices[changed]
+        stale = np.concatenate((gone, stale[self.ids[stale] != 0]))
+        if stale.size:
+            self.apply_stamps(stale, -1)
+        self.ids[gone] = 0
+
+        moved = indices[changed]
+        self.ids[moved] = ids[changed]
+        self.tile_x[moved] = txs[changed]
+        self.tile_y[moved] = tys[changed]
+        self.teams[moved] = teams[changed]
+        if moved.size:
+            self.masks[moved] = self.compute_masks(self.get_centers(moved))
+            self.apply_stamps(moved, 1)
+        self.moved = moved.size
+        self.removed = gone.size
+
+    def is_visible(self, team, ent_id):
+        # O(1), whether the entity stands on a tile the team sees
+        index = ent_id & world.EntityAllocator.INDEX_MASK
+        if index >= self.ids.size or self.ids[index] != ent_id:
+            return False
+        counts = self.counts.get(team)
+        if counts is None:
+            return False
+        return bool(counts[self.get_centers(index)] > 0)
+
+    def get_visible_mask(self, team, ids):
+        ids = np.asarray(ids, dtype=np.int64)
+        indices = (ids & world.EntityAllocator.INDEX_MASK).astype(np.intp)
+        counts = self.counts.get(team)
+        if counts is None or not ids.size:
+            return np.zeros(ids.size, dtype=bool)
+        known = indices < self.ids.size
+        visible = np.zeros(ids.size, dtype=bool)
+        known[known] = self.ids[indices[known]] == ids[known]
+        visible[known] = counts[self.get_centers(indices[known])] > 0
+        return visible
+
+    def is_tile_visible(self, team, x, y):
+        counts = self.counts.get(team)
+        if counts is None or not self.terrain.in_bounds(x, y):
+            return False
+        return bool(counts[x + self.pad +
+                           (y + self.pad) * self.padded_width] > 0)
+
+    def get_visible_tiles(self, team):
+        # bool [y, x] grid of the tiles the team sees
+        pad = self.pad
+        counts = self.get_counts(team).reshape(
+            self.padded_height, self.padded_width)
+        return counts[pad:pad + self.terrain.height,
+                      pad:pad + self.terrain.width] > 0
@@ -2,6 +2,16 @@
 
 import logging
 import math
+import operator
+import zlib
+
+import numpy as np
+
+import ai
+import collision
+import combat
+import profiler
+import projectiles
 
 LOG = logging.getLogger(__name__)
 
@@ -9,6 +19,7 @@ LOG = logging.getLogger(__name__)
 class SimulationConfig(object):
 
     PLAYER_MOVE_SPEED = 3.
+    ENEMY_ACCELERATION = 60.
     ENTITY_FRICTION = .9
     VERY_SLOW_SPEED = .001
     VERY_FAST_SPEED = 10.
@@ -24,6 +35,10 @@ class EntityFlags(object):
 
 class Entity(object):
 
+    __slots__ = (
+        'id', 'x', 'y', 'acc_x', 'acc_y', 'vel_x', 'vel_y', 'radius',
+        'rotation', 'flags', 'team', 'draw_model')
+
     def __init__(self):
         self.id = 0
         self.x = 0.
@@ -35,6 +50,7 @@ class Entity(object):
         self.radius = .5
         self.rotation = 0.
         self.flags = 0
+        self.team = 0
         self.draw_model = 'default'
 
     def update(self, dt):
@@ -73,6 +89,29 @@ class Enemy(object):
 
     def __init__(self, entity):
         self.entity = entity
+        self.target = None
+        # maintained by ai.AIScheduler
+        self.ai_period = 1
+        self.ai_due = None
+
+    def think(self, dt):
+        ent = self.entity
+        target = self.target
+        ent.acc_x = 0.
+        ent.acc_y = 0.
+        if target is None:
+            return
+        dx = target.x - ent.x
+        dy = target.y - ent.y
+        ent.rotation = math.atan2(dy, dx)
+        dist = math.sqrt(dx * dx + dy * dy)
+        if dist > combat.CombatConfig.ATTACK_RANGE + target.radius:
+            acc = SimulationConfig.ENEMY_ACCELERATION / dist
+            ent.acc_x = dx * acc
+            ent.acc_y = dy * acc
+            ent.flags &= ~EntityFlags.ATTACKING
+        else:
+            ent.flags |= EntityFlags.ATTACKING
 
 
 class PlayerActionFlags(object):
@@ -165,37 +204,383 @@ class Player(object):
             speed_fac = 0.
         self.entity.vel_x = vel_x * speed_fac
         self.entity.vel_y = vel_y * speed_fac
-        #if (self.action_flags & PlayerActionFlags.ATTACK) != 0:
-        #    self.entity.flags |= EntityFlags.ATTACKING
-        #else:
-        #    self.entity.flags &= ~EntityFlags.ATTACKING
+        if (self.action_flags & PlayerActionFlags.ATTACK) != 0:
+            self.entity.flags |= EntityFlags.ATTACKING
+        else:
+            self.entity.flags &= ~EntityFlags.ATTACKING
         #self.action_flags = 0
 
 
-class Simulation(object):
+class SimulationEvents(object):
+
+    # events are (type, ids) tuples collected in Simulation.events
+    DEATH       = 1
+    DESPAWN     = 2
+
+
+class EntityAllocator(object):
+
+    # entity ids are generational indices: the low bits pick a slot in the
+    # index tables and the high bits count how often that index has been
+    # reused, so ids of despawned entities never match a live entity
+
+    INDEX_BITS = 20
+    INDEX_MASK = (1 << INDEX_BITS) - 1
+    MAX_GENERATION = (1 << (32 - INDEX_BITS)) - 1
 
     def __init__(self):
-        self.id_gen = 100
+        self.generations = []
+        # index -> position in Simulation.entities, -1 when free
+        self.slots = []
+        self.free = []
+
+    def allocate(self):
+        if self.free:
+            index = self.free.pop()
+        else:
+            index = len(self.generations)
+            if index > self.INDEX_MASK:
+                raise RuntimeError('out of entity indices')
+            self.generations.append(1)
+            self.slots.append(-1)
+        return (self.generations[index] << self.INDEX_BITS) | index
+
+    def allocate_many(self, count):
+        reused = self.free[-count:] if count else []
+        del self.free[len(self.free) - len(reused):]
+        first = len(self.generations)
+        fresh = count - len(reused)
+        if first + fresh - 1 > self.INDEX_MASK:
+            raise RuntimeError('out of entity indices')
+        self.generations.extend([1] * fresh)
+        self.slots.extend([-1] * fresh)
+        bits = self.INDEX_BITS
+        gens = self.generations
+        ids = [(gens[index] << bits) | index for index in reversed(reused)]
+        ids.extend(
+            (1 << bits) | index for index in range(first, first + fresh))
+        return ids
+
+    def release(self, ent_id):
+        index = ent_id & self.INDEX_MASK
+        generation = self.generations[index] + 1
+        if generation > self.MAX_GENERATION:
+            generation = 1
+        self.generations[index] = generation
+        self.slots[index] = -1
+        self.free.append(index)
+
+    def get_slot(self, ent_id):
+        index = ent_id & self.INDEX_MASK
+        if (index < len(self.generations) and
+            self.generations[index] == ent_id >> self.INDEX_BITS):
+            return self.slots[index]
+        return -1
+
+    def is_alive(self, ent_id):
+        return self.get_slot(ent_id) >= 0
+
+
+ENTITY_FIELD_TYPES = {
+    'id': np.int64,
+    'x': np.float64,
+    'y': np.float64,
+    'acc_x': np.float64,
+    'acc_y': np.float64,
+    'vel_x': np.float64,
+    'vel_y': np.float64,
+    'radius': np.float64,
+    'rotation': np.float64,
+    'flags': np.int64,
+    'team': np.int64,
+}
+
+COMBAT_FIELDS = ('id', 'x', 'y', 'radius', 'rotation', 'team', 'flags')
+VISIBILITY_FIELDS = ('id', 'x', 'y', 'team')
+STEERING_FIELDS = ('id', 'x', 'y', 'acc_x', 'acc_y', 'flags')
+CHECKSUM_FIELDS = ('id', 'x', 'y', 'vel_x', 'vel_y', 'rotation', 'flags')
+
+
+class Simulation(object):
+
+    def __init__(self, terrain=None):
+        self.allocator = EntityAllocator()
         self.entities = []
+        self.players = []
+        self.terrain = terrain
+        self.ai = ai.AIScheduler()
+        self.projectiles = projectiles.ProjectileStore()
+        self.projectile_hits = None
+        self.combat = combat.CombatSystem()
+        self.time = 0.
+        self.events = []
+        self.profiler = profiler.NULL_PROFILER
+        # optional visibility.VisibilityGrid, updated at the end of a tick
+        self.visibility = None
+        # optional history.PositionHistory, recorded at the end of a tick
+        self.history = None
+        # optional steering.SteeringSystem, run before the entities move
+        self.steering = None
 
     def update(self, dt):
+        prof = self.profiler
+        self.events = []
+        self.time += dt
+        start = prof.start()
+        for player in self.players:
+            player.update(dt)
+        prof.stop('sim.players_ns', start)
+        start = prof.start()
+        self.ai.update([player.entity for player in self.players], dt)
+        prof.stop('sim.ai_ns', start)
+        if self.steering is not None:
+            start = prof.start()
+            self.update_steering(dt)
+            prof.stop('sim.steering_ns', start)
+            prof.count('sim.steering_pairs', self.steering.pairs)
+        start = prof.start()
+        if self.terrain is not None:
+            old_xs, old_ys = self.get_entity_arrays(('x', 'y'))
         for entity in self.entities:
             entity.update(dt)
+        prof.stop('sim.entities_ns', start)
+        if self.terrain is not None:
+            start = prof.start()
+            self.resolve_terrain_collisions(old_xs, old_ys)
+            prof.stop('sim.collision_ns', start)
+        start = prof.start()
+        if self.projectiles.count:
+            self.update_projectiles(dt)
+        else:
+            self.projectile_hits = None
+        prof.stop('sim.projectiles_ns', start)
+        start = prof.start()
+        self.update_combat()
+        prof.stop('sim.combat_ns', start)
+        if self.visibility is not None:
+            start = prof.start()
+            self.visibility.update(*self.get_entity_arrays(VISIBILITY_FIELDS))
+            prof.stop('sim.visibility_ns', start)
+            prof.count('sim.visibility_moved', self.visibility.moved)
+        if self.history is not None:
+            start = prof.start()
+            self.history.record(self.time, *self.get_collidable_arrays())
+            prof.stop('sim.history_ns', start)
+        prof.gauge('sim.entities', len(self.entities))
+        prof.gauge('sim.projectiles', self.projectiles.count)
+        prof.count('sim.ai_decisions', self.ai.decisions)
+
+    def resolve_terrain_collisions(self, old_xs, old_ys):
+        xs, ys = self.get_entity_arrays(('x', 'y'))
+        moved = np.flatnonzero((xs != old_xs) | (ys != old_ys))
+        if not moved.size:
+            return
+        moved_ents = self.entities
+        if moved.size != len(moved_ents):
+            moved_ents = [moved_ents[i] for i in moved.tolist()]
+            old_xs = old_xs[moved]
+            old_ys = old_ys[moved]
+            xs = xs[moved]
+            ys = ys[moved]
+        radii = np.fromiter(map(operator.attrgetter('radius'), moved_ents),
+                            np.float64, len(moved_ents))
+        xs, ys, hit, push_xs, push_ys = collision.resolve_movement(
+            self.terrain.get_blocking(), old_xs, old_ys, xs, ys, radii)
+        hits = np.flatnonzero(hit)
+        self.profiler.count('sim.terrain_collisions', len(hits))
+        if not hits.size:
+            return
+        push_len = np.hypot(push_xs[hits], push_ys[hits])
+        for i, x, y, nx, ny in zip(hits.tolist(), xs[hits].tolist(),
+                                   ys[hits].tolist(),
+                                   (push_xs[hits] / push_len).tolist(),
+                                   (push_ys[hits] / push_len).tolist()):
+            ent = moved_ents[i]
+            ent.x = x
+            ent.y = y
+            # slide, drop the part of the velocity going into the wall
+            vel_n = ent.vel_x * nx + ent.vel_y * ny
+            if vel_n < 0.:
+                ent.vel_x -= vel_n * nx
+                ent.vel_y -= vel_n * ny
+
+    def update_steering(self, dt):
+        ids, xs, ys, acc_xs, acc_ys, flags = self.get_entity_arrays(
+            STEERING_FIELDS)
+        steerable = (flags & (EntityFlags.NO_MOVE | EntityFlags.NO_COLLIDE |
+                              EntityFlags.PROJECTILE)) == 0
+        new_xs, new_ys = self.steering.update(
+            dt, ids, xs, ys, acc_xs, acc_ys, steerable)
+        changed = np.flatnonzero((new_xs != acc_xs) | (new_ys != acc_ys))
+        ents = self.entities
+        for i, acc_x, acc_y in zip(changed.tolist(), new_xs[changed].tolist(),
+                                   new_ys[changed].tolist()):
+            ent = ents[i]
+            ent.acc_x = acc_x
+            ent.acc_y = acc_y
+
+    def update_projectiles(self, dt):
+        ids, xs, ys, radii = self.get_collidable_arrays()
+        blocking = None
+        if self.terrain is not None:
+            blocking = self.terrain.get_blocking()
+        self.projectile_hits = self.projectiles.update(
+            dt, ids, xs, ys, radii, blocking)
+
+    def update_combat(self):
+        hits = self.projectile_hits
+        if hits is not None and hits[1].size:
+            self.combat.apply_damage(
+                hits[1] & EntityAllocator.INDEX_MASK, hits[2])
+        ids, xs, ys, radii, rotations, teams, flags = (
+            self.get_collidable_arrays(COMBAT_FIELDS))
+        indices = ids & EntityAllocator.INDEX_MASK
+        attacking = (flags & EntityFlags.ATTACKING) != 0
+        self.combat.resolve_melee(
+            self.time, indices, xs, ys, radii, rotations, teams, attacking)
+        dead = ids[self.combat.health[indices] <= 0.]
+        if dead.size:
+            dead = dead.tolist()
+            self.events.append((SimulationEvents.DEATH, dead))
+            self.despawn_entities(dead)
+
+    def compute_checksum(self):
+        # crc of the state that matters for determinism, in entity order
+        ids, xs, ys, vel_xs, vel_ys, rotations, flags = (
+            self.get_entity_arrays(CHECKSUM_FIELDS))
+        checksum = 0
+        for array in (ids, xs, ys, vel_xs, vel_ys, rotations, flags,
+                      self.combat.health[ids & EntityAllocator.INDEX_MASK]):
+            checksum = zlib.crc32(array.tobytes(), checksum)
+        return checksum
+
+    def get_entity_arrays(self, fields):
+        ents = self.entities
+        return tuple(
+            np.fromiter(map(operator.attrgetter(field), ents),
+                        ENTITY_FIELD_TYPES[field], len(ents))
+            for field in fields)
+
+    def get_collidable_arrays(self, fields=('id', 'x', 'y', 'radius')):
+        ents = [ent for ent in self.entities
+                if (ent.flags & EntityFlags.NO_COLLIDE) == 0]
+        count = len(ents)
+        return tuple(
+            np.fromiter(map(operator.attrgetter(field), ents),
+                        ENTITY_FIELD_TYPES[field], count)
+            for field in fields)
+
+    def add_player(self, player):
+        self.players.append(player)
+
+    def remove_player(self, player):
+        self.players.remove(player)
 
     def spawn_entity(self, x, y, radius=.5, rotation=.0, flags=0,
-                     draw_model='default'):
+                     draw_model='default', team=0):
         ent = Entity()
-        ent.id = self.id_gen
+        ent.id = self.allocator.allocate()
         ent.x = x
         ent.y = y
         ent.radius = radius
         ent.rotation = rotation
         ent.flags = flags
+        ent.team = team
         ent.draw_model = draw_model
+        index = ent.id & EntityAllocator.INDEX_MASK
+        self.allocator.slots[index] = len(self.entities)
         self.entities.append(ent)
-        self.id_gen = self.id_gen + 1
+        self.combat.reset([index])
         return ent
 
+    def spawn_entities(self, xs, ys, radii=.5, rotations=0., flags=0,
+                       draw_models='default', teams=0):
+        # bulk spawn, every argument is either one value for all entities
+        # or a sequence with one value per entity
+        count = len(xs)
+        columns = [
+            np.broadcast_to(np.asarray(column), (count,)).tolist()
+            for column in (xs, ys, radii, rotations, flags, teams)]
+        if isinstance(draw_models, str):
+            draw_models = [draw_models] * count
+        ids = self.allocator.allocate_many(count)
+        slots = self.allocator.slots
+        first = len(self.entities)
+        new_ents = []
+        # skip Entity.__init__, every field gets assigned exactly once
+        new = Entity.__new__
+        for (ent_id, x, y, radius, rotation, ent_flags, team,
+             draw_model) in zip(ids, *(columns + [draw_models])):
+            ent = new(Entity)
+            ent.id = ent_id
+            ent.x = x
+            ent.y = y
+            ent.acc_x = ent.acc_y = ent.vel_x = ent.vel_y = 0.
+            ent.radius = radius
+            ent.rotation = rotation
+            ent.flags = ent_flags
+            ent.team = team
+            ent.draw_model = draw_model
+            new_ents.append(ent)
+        mask = EntityAllocator.INDEX_MASK
+        indices = [ent_id & mask for ent_id in ids]
+        for slot, index in enumerate(indices, first):
+            slots[index] = slot
+        self.entities.extend(new_ents)
+        self.combat.reset(indices)
+        return new_ents
+
+    def get_entity(self, ent_id):
+        slot = self.allocator.get_slot(ent_id)
+        if slot < 0:
+            return None
+        return self.entities[slot]
+
+    def is_alive(self, ent_id):
+        return self.allocator.is_alive(ent_id)
+
+    def despawn_entity(self, ent_id):
+        return bool(self.despawn_entities([ent_id]))
+
+    def remove_entity(self, ent_id):
+        # despawn without emitting an event
+        slot = self.allocator.get_slot(ent_id)
+        if slot < 0:
+            return False
+        # swap the last entity into the hole to keep the list dense
+        ents = self.entities
+        last = ents.pop()
+        if slot < len(ents):
+            ents[slot] = last
+            self.allocator.slots[last.id & EntityAllocator.INDEX_MASK] = slot
+        self.allocator.release(ent_id)
+        enemy = self.ai.enemies.get(ent_id)
+        if enemy is not None:
+            self.ai.remove_enemy(enemy)
+        for player in self.players:
+            if player.entity.id == ent_id:
+                self.players.remove(player)
+                break
+        return True
+
+    def despawn_entities(self, ent_ids):
+        despawned = [
+            ent_id for ent_id in ent_ids if self.remove_entity(ent_id)]
+        if despawned:
+            self.events.append((SimulationEvents.DESPAWN, despawned))
+        return despawned
+
+    def spawn_projectile(self, owner, speed, **kwargs):
+        vel_x = math.cos(owner.rotation) * speed
+        vel_y = math.sin(owner.rotation) * speed
+        return self.projectiles.spawn(
+            owner.x, owner.y, vel_x, vel_y, owner.id, **kwargs)
+
+    def spawn_enemy(self, x, y, **kwargs):
+        enemy = Enemy(self.spawn_entity(x, y, **kwargs))
+        self.ai.add_enemy(enemy)
+        return enemy
+
 
 class TileType(object):
 